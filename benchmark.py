@@ -0,0 +1,327 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline benchmarks
+# Drives the handlers in bot.py and the deployment, database, security and utils layers
+# in-process, with a FakeTeleBot standing in for telebot and synthetic ZIP fixtures, so no
+# Telegram token or network is needed. Everything runs in a temporary working directory.
+#   python benchmark.py [--quick] [--json results.json] [--compare previous.json]
+# --compare prints each metric against an earlier --json run and flags regressions.
+
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet',
+         'render', 'template', 'request', 'response', 'session', 'config', 'return', 'import', 'value')
+
+class FakeTeleBot:
+    # Records everything the bot sends and dispatches fake messages like telebot's polling loop
+
+    def __init__(self, token=None, *args, **kwargs):
+        self.token = token
+        self.handlers = []  # (commands, content_types, handler) in registration order
+        self.file_dir = os.path.abspath('telegram-files')  # Served through TELEGRAM_FILE_URL (file://)
+        self.sent = {}  # chat_id: [text, ...]
+        self._cond = threading.Condition()
+
+    def message_handler(self, commands=None, content_types=None, **kwargs):
+        def register(handler):
+            self.handlers.append((commands, content_types or ['text'], handler))
+            return handler
+        return register
+
+    def _record(self, chat_id, text):
+        with self._cond:
+            self.sent.setdefault(chat_id, []).append(text)
+            self._cond.notify_all()
+
+    def reply_to(self, message, text, **kwargs):
+        self._record(message.chat.id, text)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record(chat_id, text)
+
+    def send_document(self, chat_id, document, caption=None, **kwargs):
+        self._record(chat_id, caption or f"<document {getattr(document, 'name', '')}>")
+
+    def add_file(self, file_id, data):
+        os.makedirs(self.file_dir, exist_ok=True)
+        with open(os.path.join(self.file_dir, file_id), 'wb') as f:
+            f.write(data)
+
+    def get_file(self, file_id):
+        path = os.path.join(self.file_dir, file_id)
+        return types.SimpleNamespace(file_id=file_id, file_path=file_id, file_size=os.path.getsize(path))
+
+    def download_file(self, file_path):
+        with open(os.path.join(self.file_dir, file_path), 'rb') as f:
+            return f.read()
+
+    def polling(self, *args, **kwargs):
+        pass
+
+    infinity_polling = polling
+
+    def process_message(self, message):
+        if message.content_type == 'text' and message.text.startswith('/'):
+            command = message.text.split()[0][1:].split('@')[0]
+            for commands, _, handler in self.handlers:
+                if commands and command in commands:
+                    return handler(message)
+            return None
+        for commands, content_types, handler in self.handlers:
+            if not commands and message.content_type in content_types:
+                return handler(message)
+        return None
+
+    # Block until a message to chat_id satisfies predicate; returns it (or None on timeout)
+    def wait_for(self, chat_id, predicate, timeout, start=0):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for text in self.sent.get(chat_id, [])[start:]:
+                    if predicate(text):
+                        return text
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+def install_fake_telebot():
+    telebot = types.ModuleType('telebot')
+    telebot.TeleBot = FakeTeleBot
+    telebot_types = types.ModuleType('telebot.types')
+    telebot_types.Message = types.SimpleNamespace
+    telebot_types.Update = types.SimpleNamespace
+    telebot.types = telebot_types
+    sys.modules['telebot'] = telebot
+    sys.modules['telebot.types'] = telebot_types
+
+_message_ids = itertools.count(1)
+
+def make_message(user_id, text=None, document=None):
+    return types.SimpleNamespace(
+        message_id=next(_message_ids), from_user=types.SimpleNamespace(id=user_id), chat=types.SimpleNamespace(id=user_id),
+        content_type='document' if document is not None else 'text', text=text, document=document)
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {'count': len(ordered), 'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+def text_blob(size, rng):
+    words = []
+    total = 0
+    while total < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        total += len(word) + 1
+    return ' '.join(words).encode()
+
+def static_site_zip(rng, files=5, file_size=4096):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('index.html', b'<html><body>' + text_blob(file_size, rng) + b'</body></html>')
+        for i in range(files - 1):
+            zf.writestr(f'assets/page{i}.html', text_blob(file_size, rng))
+    return buffer.getvalue()
+
+def bench_deploys(app, rng, count, concurrency):
+    bot = app.bot
+    payload = static_site_zip(rng)
+    latencies = []
+    outcomes = {}
+    lock = threading.Lock()
+
+    def deploy(i):
+        user_id = 100000 + i
+        file_id = f'fixture-{i}'
+        bot.add_file(file_id, payload)
+        bot.process_message(make_message(user_id, '/deploy'))
+        start = len(bot.sent.get(user_id, []))
+        document = types.SimpleNamespace(file_name='site.zip', file_id=file_id, file_size=len(payload))
+        started = time.perf_counter()
+        bot.process_message(make_message(user_id, document=document))
+        final = bot.wait_for(user_id, lambda text: text.startswith(('Deployment successful', 'Service ', 'Error',
+                                                                     'Deployment limit', 'No capacity')),
+                             timeout=120, start=start)
+        elapsed = time.perf_counter() - started
+        outcome = 'ok' if final and final.startswith('Deployment successful') else 'failed'
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == 'ok':
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(deploy, range(count)))
+    wall = time.perf_counter() - started
+    result = {'deploys': count, 'concurrency': concurrency, 'deploys_per_sec': round(count / wall, 2)}
+    result.update(outcomes)
+    result.update(percentiles(latencies))
+    return result
+
+def bench_commands(app, rng, count, concurrency):
+    bot = app.bot
+    services = [(service['user_id'], service['service_id']) for service in app.get_running_services()]
+    if not services:
+        return {'skipped': 'no services deployed'}
+    commands = ('/getlink {sid}', '/stats {sid}', '/logs {sid} 20', '/cancel', '/getlink missing')
+    latencies = []
+    lock = threading.Lock()
+
+    def run(i):
+        user_id, service_id = services[i % len(services)]
+        text = commands[i % len(commands)].format(sid=service_id)
+        started = time.perf_counter()
+        bot.process_message(make_message(user_id, text))
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, range(count)))
+    wall = time.perf_counter() - started
+    result = {'commands': count, 'concurrency': concurrency, 'commands_per_sec': round(count / wall, 1)}
+    result.update(percentiles(latencies))
+    return result
+
+def bench_scanner(app, rng, size_mb):
+    path = os.path.abspath('scan_fixture.zip')
+    file_size = 256 * 1024
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(max(1, size_mb * 1024 * 1024 // file_size)):
+            zf.writestr(f'src/module{i}.py', text_blob(file_size, rng))
+    with zipfile.ZipFile(path) as zf:
+        total = sum(info.file_size for info in zf.infolist())
+    started = time.perf_counter()
+    is_malicious, reason = app.scan_archive(path)
+    scan_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    app.extract_archive(path, os.path.abspath('scan_extract'))
+    extract_seconds = time.perf_counter() - started
+    os.remove(path)
+    return {'uncompressed_mb': round(total / 1024 / 1024, 1), 'flagged': bool(is_malicious),
+            'scan_mb_per_sec': round(total / 1024 / 1024 / scan_seconds, 1),
+            'extract_mb_per_sec': round(total / 1024 / 1024 / extract_seconds, 1)}
+
+def bench_ports(app, rng, operations, levels=(0.0, 0.5, 0.9, 0.99)):
+    import utils
+    low, high = app.config.PORT_RANGE
+    all_ports = list(range(low, high + 1))
+    results = {}
+    with utils._port_lock:
+        saved = utils._free_ports
+    try:
+        for level in levels:
+            free = set(rng.sample(all_ports, max(1, int(len(all_ports) * (1 - level)))))
+            with utils._port_lock:
+                utils._free_ports = free
+            started = time.perf_counter()
+            for _ in range(operations):
+                app.release_port(app.get_unused_port())
+            elapsed = time.perf_counter() - started
+            results[f'fill_{int(level * 100)}pct_us'] = round(elapsed / operations * 1e6, 2)
+    finally:
+        with utils._port_lock:
+            utils._free_ports = saved
+    return results
+
+def bench_db(app, rng, operations):
+    results = {}
+
+    def measure(name, func):
+        started = time.perf_counter()
+        for i in range(operations):
+            func(i)
+        results[f'{name}_per_sec'] = round(operations / (time.perf_counter() - started))
+
+    base = 500000
+    measure('user_insert', lambda i: app.add_or_get_user(base + i))
+    measure('user_cached', lambda i: app.add_or_get_user(base + i % 100))
+    measure('user_uncached', lambda i: (app.invalidate_user_cache(base + i), app.add_or_get_user(base + i)))
+    services = [service['service_id'] for service in app.get_running_services()] or ['missing']
+    measure('service_get', lambda i: app.get_service(services[i % len(services)]))
+    measure('job_status_update', lambda i: app.update_job_status(1, 'done'))
+    measure('activity_log', lambda i: app.log_activity(base + i % 100, 'bench', 'benchmark'))
+    return results
+
+# Print each rate and latency against an earlier run; >10% worse is flagged
+def compare(current, previous):
+    lines = []
+    for section, metrics in current.items():
+        if section == 'meta' or not isinstance(metrics, dict):
+            continue
+        for key, value in metrics.items():
+            old = previous.get(section, {}).get(key)
+            if not key.endswith(('_per_sec', '_ms', '_us')) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old * 100
+            worse = change < -10 if key.endswith('_per_sec') else change > 10
+            lines.append(f"{section}.{key}: {old} -> {value} ({change:+.1f}%){'  REGRESSION' if worse else ''}")
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the deployment bot')
+    parser.add_argument('--quick', action='store_true', help='smaller workloads for a fast sanity run')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='compare against results from an earlier --json run')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    scale = 0.1 if args.quick else 1
+    rng = random.Random(args.seed)
+    json_path = os.path.abspath(args.json) if args.json else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        os.chdir(workdir)
+        import config
+        # Keep the run self-contained: no listeners besides the services, no background sweeps
+        config.PROXY_ENABLED = False
+        config.METRICS_ENABLED = False
+        config.IDLE_SUSPEND_ENABLED = False
+        config.RATE_LIMITS = {tier: {budget: (10 ** 9, 10 ** 9) for budget in ('command', 'expensive')}
+                              for tier in ('free', 'premium')}
+        config.MAX_QUEUED_JOBS = 10 ** 6
+        config.PORT_RANGE = (20000, 29999)
+        config.HEALTH_CHECK_INTERVAL = 3600
+        config.TELEGRAM_FILE_URL = 'file://' + os.path.join(workdir, 'telegram-files', '{1}')
+        install_fake_telebot()
+        import bot as app
+
+        results = {'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'quick': args.quick, 'seed': args.seed}}
+        results['deploy'] = bench_deploys(app, rng, max(5, int(100 * scale)), concurrency=8)
+        results['commands'] = bench_commands(app, rng, max(100, int(5000 * scale)), concurrency=8)
+        results['scanner'] = bench_scanner(app, rng, max(4, int(64 * scale)))
+        results['ports'] = bench_ports(app, rng, max(100, int(5000 * scale)))
+        results['db'] = bench_db(app, rng, max(200, int(5000 * scale)))
+
+    print(json.dumps(results, indent=2))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if compare_path:
+        with open(compare_path) as f:
+            print(compare(results, json.load(f)))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
+import functools
+import io
 import os
 import threading
 import time
-from collections import deque
 
 import telebot
 from telebot.types import Message
@@ -9,6 +10,18 @@ from telebot.types import Message
 import config
 from database import *
 from deployment import *
+from frontend import run_frontend
+from health import *
+from jobs import *
+from limits import *
+from metrics import *
+from proxy import *
+from ratelimit import *
+from service_logs import *
+from tracing import *
+from uploads import *
+from idle import *
+from restore import *
 from utils import *
 
 # Setup logging
@@ -18,29 +31,16 @@ logging.basicConfig(filename=os.path.join(config.LOGS_DIR, 'system.log'), level=
 
 # Initialize DB
 init_db()
+start_log_writer()
+load_ports()
+start_proxy()
 
 # Bot instance
-bot = telebot.TeleBot(config.BOT_TOKEN)
+bot = telebot.TeleBot(config.BOT_TOKEN, threaded=False)  # The frontend runs handlers on its own pool
 
 # States for file uploads (per user)
 user_states = {}  # user_id: 'waiting_deploy' or 'waiting_update_{service_id}'
 
-# Rate limiting
-rate_limits = {}  # user_id: deque of timestamps
-
-def check_rate_limit(user_id):
-    now = time.time()
-    if user_id not in rate_limits:
-        rate_limits[user_id] = deque()
-    queue = rate_limits[user_id]
-    # Remove old timestamps
-    while queue and queue[0] < now - 60:
-        queue.popleft()
-    if len(queue) >= config.RATE_LIMIT_COMMANDS:
-        return False
-    queue.append(now)
-    return True
-
 # Decorator for command handlers: check ban, rate limit
 def command_handler(func):
     def wrapper(message: Message):
@@ -48,12 +48,17 @@ def command_handler(func):
         if get_ban(user_id):
             bot.reply_to(message, "You are banned from using this bot.")
             return
-        if not check_rate_limit(user_id):
-            bot.reply_to(message, "Rate limit exceeded. Please slow down.")
+        command = message.text.split()[0][1:].split('@')[0].lower() if message.text else ''
+        tier = 'premium' if add_or_get_user(user_id)['is_premium'] else 'free'
+        allowed, wait = consume(user_id, budget_for(command), tier)
+        if not allowed:
+            bot.reply_to(message, f"Rate limit exceeded. Please slow down (try again in {wait:.0f}s).")
             return
         try:
-            func(message)
+            with HANDLER_SECONDS.time(handler=func.__name__):
+                func(message)
         except Exception as e:
+            HANDLER_ERRORS.inc(handler=func.__name__)
             logging.error(f"Error in handler: {str(e)}")
             bot.reply_to(message, "An error occurred. Please try again.")
     return wrapper
@@ -72,37 +77,38 @@ def handle_document(message: Message):
         del user_states[user_id]
         return
 
-    state = user_states[user_id]
-    file_info = bot.get_file(message.document.file_id)
-    
-    # Download file as bytes (new correct way)
-    try:
-        downloaded_file = bot.download_file(file_info.file_path)
-    except Exception as e:
-        bot.reply_to(message, f"Failed to download file: {str(e)}")
-        del user_states[user_id]
+    # Refuse oversized files before using up the state, so the user can just send a smaller one
+    is_premium = add_or_get_user(user_id)['is_premium']
+    error = check_upload_size(message.document.file_size, is_premium)
+    if error:
+        bot.reply_to(message, error)
         return
-    
-    # Save to temporary ZIP path
-    zip_path = f'temp_{user_id}_{int(time.time())}.zip'
+
+    state = user_states.pop(user_id)
+    if state == 'waiting_deploy':
+        kind, service_id = 'deploy', None
+    else:
+        kind, service_id = 'update', state.split('_')[2]
+    trace = start_trace(kind, user_id)
+    zip_path = f'temp_{user_id}_{message.message_id}_{int(time.time())}.zip'
+    # The job exists (and can be cancelled) right away; it waits for the download on the upload pool
+    download = functools.partial(receive_upload, message, zip_path, is_premium, trace)
     try:
-        with open(zip_path, 'wb') as f:
-            f.write(downloaded_file)
-    except Exception as e:
-        bot.reply_to(message, f"Failed to save file: {str(e)}")
-        del user_states[user_id]
+        job_id, position = submit_job(kind, user_id, message.chat.id, zip_path, service_id, trace=trace,
+                                      download=download)
+    except QueueFullError:
+        bot.reply_to(message, "The deployment queue is full. Please try again in a few minutes.")
         return
-    
-    bot.reply_to(message, "File received! Processing your deployment..." if 'deploy' in state else "File received! Updating your project...")
-    
-    if state == 'waiting_deploy':
-        threading.Thread(target=deploy_project, args=(user_id, zip_path, bot, message.chat.id)).start()
-    elif state.startswith('waiting_update_'):
-        service_id = state.split('_')[2]
-        threading.Thread(target=update_project, args=(user_id, service_id, zip_path, bot, message.chat.id)).start()
-    
-    del user_states[user_id]
 
+    action = "deployment" if kind == 'deploy' else "update"
+    bot.reply_to(message, f"File received! Your {action} is job #{job_id}, position {position} in the queue. "
+                          f"Send /cancel to cancel it while it waits.")
+
+def receive_upload(message, zip_path, is_premium, trace):
+    started = time.perf_counter()
+    file_info = bot.get_file(message.document.file_id)
+    size = download_to_file(bot, file_info, zip_path, max_upload_bytes(is_premium))
+    add_span(trace, 'download', time.perf_counter() - started, bytes=size)
 
 # User commands
 @bot.message_handler(commands=['deploy'])
@@ -129,6 +135,21 @@ def handle_update(message: Message):
     user_states[user_id] = f'waiting_update_{service_id}'
     bot.reply_to(message, f"Please upload the updated ZIP file for {service_id}.")
 
+@bot.message_handler(commands=['cancel'])
+@command_handler
+def handle_cancel(message: Message):
+    user_id = message.from_user.id
+    if user_states.pop(user_id, None):
+        bot.reply_to(message, "Upload cancelled.")
+        return
+    cancelled = cancel_jobs(user_id)
+    if cancelled:
+        bot.reply_to(message, f"Cancelled {cancelled} queued job(s).")
+    elif get_running_jobs(user_id):
+        bot.reply_to(message, "Your job is already running and can no longer be cancelled.")
+    else:
+        bot.reply_to(message, "Nothing to cancel.")
+
 @bot.message_handler(commands=['getlink'])
 @command_handler
 def handle_getlink(message: Message):
@@ -142,8 +163,84 @@ def handle_getlink(message: Message):
     if not service or service['user_id'] != user_id:
         bot.reply_to(message, "Invalid service ID or not yours.")
         return
-    link = f"http://{config.SERVER_IP}:{service['port']}"
-    bot.reply_to(message, f"Link for {service_id}: {link}")
+    link = service_link(service_id, service['port'])
+    text = f"Link for {service_id}: {link}"
+    if service['health_status']:
+        healthy = service['health_status'] == 'healthy'
+        text += f"\nHealth: {describe_health(healthy, service['health_detail'])} (checked {service['health_checked_at']})"
+    bot.reply_to(message, text)
+
+@bot.message_handler(commands=['stats'])
+@command_handler
+def handle_stats(message: Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.reply_to(message, "Usage: /stats SERVICE_ID")
+        return
+    service_id = parts[1]
+    user_id = message.from_user.id
+    service = get_service(service_id)
+    if not service or (service['user_id'] != user_id and user_id != config.ADMIN_ID):
+        bot.reply_to(message, "Invalid service ID or not yours.")
+        return
+    process = processes.get(service_id)
+    if process is None or process.poll() is not None:
+        bot.reply_to(message, f"{service_id} is not running.")
+        return
+    if process.pid is None:
+        bot.reply_to(message, f"{service_id} has no process of its own (static site or suspended while idle).")
+        return
+    usage = get_usage(service_id)  # Only the sampler thread samples; it owns the CPU deltas
+    if not usage:
+        bot.reply_to(message, f"{service_id} has not been sampled yet; try again in {config.RESOURCE_SAMPLE_INTERVAL}s.")
+        return
+    limits = config.RESOURCE_LIMITS[tier_for(service_id)]
+    bot.reply_to(message, f"{format_usage(service_id, usage)}\n"
+                          f"Limits: {limits['memory_mb']} MB, {limits['cpu_percent']}% CPU, "
+                          f"{limits['pids']} tasks, {limits['open_files']} open files")
+
+@bot.message_handler(commands=['top'])
+@command_handler
+def handle_top(message: Message):
+    if message.from_user.id != config.ADMIN_ID:
+        bot.reply_to(message, "Admin only.")
+        return
+    parts = message.text.split()
+    n = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+    ranked = top_usage(n)
+    if not ranked:
+        bot.reply_to(message, "No usage data yet.")
+        return
+    bot.reply_to(message, '\n'.join(format_usage(service_id, usage) for service_id, usage in ranked))
+
+@bot.message_handler(commands=['logs'])
+@command_handler
+def handle_logs(message: Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.reply_to(message, "Usage: /logs SERVICE_ID [LINES]")
+        return
+    service_id = parts[1]
+    user_id = message.from_user.id
+    service = get_service(service_id)
+    if not service or (service['user_id'] != user_id and user_id != config.ADMIN_ID):
+        bot.reply_to(message, "Invalid service ID or not yours.")
+        return
+    n = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else config.LOG_TAIL_DEFAULT
+    n = max(1, min(n, config.LOG_TAIL_MAX))
+    data = tail_log(service_id, n)
+    if not data:
+        bot.reply_to(message, f"No log output for {service_id} yet.")
+        return
+    text = data.decode('utf-8', errors='replace')
+    if len(text) <= config.LOG_TAIL_MESSAGE_CHARS:
+        bot.reply_to(message, text)
+    else:
+        document = io.BytesIO(data)
+        document.name = f'{service_id}.log'
+        usage_kb = get_log_usage(service_id) // 1024
+        bot.send_document(message.chat.id, document,
+                          caption=f"Last {n} lines of {service_id} ({usage_kb} KB of logs kept)")
 
 @bot.message_handler(commands=['stop'])
 @command_handler
@@ -177,26 +274,48 @@ def handle_redeploy(message: Message):
     if not service or service['user_id'] != user_id:
         bot.reply_to(message, "Invalid service ID or not yours.")
         return
+    if (config.BLUE_GREEN_UPDATES and service['status'] == 'running' and is_process_running(service_id)
+            and not is_held(service_id)):
+        # Keep serving from the old process until the new one is ready
+        bot.reply_to(message, f"Redeploying {service_id} without downtime...")
+        threading.Thread(target=_blue_green_redeploy, args=(message, service), daemon=True).start()
+        return
     if service['status'] != 'stopped':
         stop_process(service_id)
     project_type = service['project_type']
-    path = service['path']
-    port = service['port']
-    if project_type == 'flask':
-        venv_path = os.path.join(path, 'venv')
-        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
-        env = os.environ.copy()
-        env['PORT'] = str(port)
-    else:
-        cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
-        env = None
-    start_process(service_id, cmd, env, project_type)
+    process = launch_service(service_id, project_type, service['path'], service['port'])
     user = add_or_get_user(user_id)
     if user['is_premium']:
         start_watchdog(service_id)
     update_status(service_id, 'running')
     update_last_restart(service_id, datetime.now())
-    bot.reply_to(message, f"Redeployed {service_id}")
+    reply_when_ready(message, service_id, process, project_type, service['path'], service['port'],
+                     f"Redeployed {service_id}")
+    bot.send_message(config.ADMIN_ID, f"User {user_id} redeployed {service_id}")
+    log_activity(user_id, 'redeploy', service_id)
+
+# Wait for readiness on its own thread, so neither the handler worker nor the user's
+# queued updates sit out HEALTH_READY_TIMEOUT, then reply with the result
+def reply_when_ready(message: Message, service_id, process, project_type, path, port, text):
+    def wait():
+        try:
+            ready, detail = check_readiness(service_id, process, project_type, path, port)
+            bot.reply_to(message, f"{text}\nHealth: {describe_health(ready, detail)}")
+        except Exception as e:
+            logging.error(f"Readiness check of {service_id} failed: {str(e)}")
+    threading.Thread(target=wait, name=f'ready-{service_id}', daemon=True).start()
+
+def _blue_green_redeploy(message: Message, service):
+    service_id = service['service_id']
+    user_id = service['user_id']
+    port = blue_green_switch(service)
+    if port is None:
+        bot.reply_to(message, f"Redeploy of {service_id} did not become ready in time. The previous process is still running.")
+        log_activity(user_id, 'redeploy', f"{service_id} rolled back")
+        return
+    link = service_link(service_id, port)
+    health = describe_health(True, get_service(service_id)['health_detail'])
+    bot.reply_to(message, f"Redeployed {service_id}\nLink: {link}\nHealth: {health}")
     bot.send_message(config.ADMIN_ID, f"User {user_id} redeployed {service_id}")
     log_activity(user_id, 'redeploy', service_id)
 
@@ -216,6 +335,10 @@ def handle_delete(message: Message):
     stop_process(service_id)
     shutil.rmtree(service['path'], ignore_errors=True)
     delete_service(service_id)
+    delete_logs(service_id)
+    delete_variants(service_id)
+    remove_route(service_id)
+    release_port(service['port'])
     decrement_deployment_count(user_id)
     bot.reply_to(message, f"Deleted {service_id}")
     bot.send_message(config.ADMIN_ID, f"User {user_id} deleted {service_id}")
@@ -245,23 +368,14 @@ def handle_maintenance(message: Message):
     else:
         # Restart as in redeploy
         project_type = service['project_type']
-        path = service['path']
-        port = service['port']
-        if project_type == 'flask':
-            venv_path = os.path.join(path, 'venv')
-            cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
-            env = os.environ.copy()
-            env['PORT'] = str(port)
-        else:
-            cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
-            env = None
-        start_process(service_id, cmd, env, project_type)
+        process = launch_service(service_id, project_type, service['path'], service['port'])
         user = add_or_get_user(user_id)
         if user['is_premium']:
             start_watchdog(service_id)
         update_status(service_id, 'running')
         update_last_restart(service_id, datetime.now())
-        bot.reply_to(message, f"Maintenance mode OFF for {service_id}")
+        reply_when_ready(message, service_id, process, project_type, service['path'], service['port'],
+                         f"Maintenance mode OFF for {service_id}")
     bot.send_message(config.ADMIN_ID, f"User {user_id} set maintenance {mode} for {service_id}")
     log_activity(user_id, 'maintenance', f"{service_id} {mode}")
 
@@ -344,23 +458,14 @@ def handle_unsuspend(message: Message):
         bot.reply_to(message, "Invalid service ID.")
         return
     project_type = service['project_type']
-    path = service['path']
-    port = service['port']
-    if project_type == 'flask':
-        venv_path = os.path.join(path, 'venv')
-        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
-        env = os.environ.copy()
-        env['PORT'] = str(port)
-    else:
-        cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
-        env = None
-    start_process(service_id, cmd, env, project_type)
+    process = launch_service(service_id, project_type, service['path'], service['port'])
     user = add_or_get_user(service['user_id'])
     if user['is_premium']:
         start_watchdog(service_id)
     update_status(service_id, 'running')
     update_last_restart(service_id, datetime.now())
-    bot.reply_to(message, f"Unsuspended {service_id}")
+    reply_when_ready(message, service_id, process, project_type, service['path'], service['port'],
+                     f"Unsuspended {service_id}")
     bot.send_message(service['user_id'], f"Your service {service_id} has been unsuspended.")
     log_activity(service['user_id'], 'unsuspend', service_id)
 
@@ -404,28 +509,77 @@ def handle_removepremium(message: Message):
     bot.send_message(user_id, "Your premium status has been removed.")
     log_activity(user_id, 'removepremium', '')
 
-# Restart running services on bot start
-running_services = get_running_services()
-for service in running_services:
-    project_type = service['project_type']
-    path = service['path']
-    port = service['port']
-    if project_type == 'flask':
-        venv_path = os.path.join(path, 'venv')
-        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
-        env = os.environ.copy()
-        env['PORT'] = str(port)
+@bot.message_handler(commands=['metrics'])
+@command_handler
+def handle_metrics(message: Message):
+    if message.from_user.id != config.ADMIN_ID:
+        bot.reply_to(message, "Admin only.")
+        return
+    bot.reply_to(message, summary())
+
+@bot.message_handler(commands=['deploytrace'])
+@command_handler
+def handle_deploytrace(message: Message):
+    if message.from_user.id != config.ADMIN_ID:
+        bot.reply_to(message, "Admin only.")
+        return
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.reply_to(message, "Usage: /deploytrace SERVICE_ID (or #JOB_ID)")
+        return
+    target = parts[1]
+    if target.lstrip('#').isdigit():
+        trace = get_latest_trace(job_id=int(target.lstrip('#')))
     else:
-        cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
-        env = None
-    start_process(service['service_id'], cmd, env, project_type)
-    user = add_or_get_user(service['user_id'])
-    if user['is_premium']:
-        start_watchdog(service['service_id'])
-    logging.info(f"Restarted service {service['service_id']} on bot start")
+        trace = get_latest_trace(service_id=target)
+    if not trace:
+        bot.reply_to(message, f"No deploy trace for {target}.")
+        return
+    bot.reply_to(message, format_trace(trace)[:4000])
+
+@bot.message_handler(commands=['profilenext'])
+@command_handler
+def handle_profilenext(message: Message):
+    if message.from_user.id != config.ADMIN_ID:
+        bot.reply_to(message, "Admin only.")
+        return
+    profile_next_job()
+    bot.reply_to(message, "The next deploy/update job will run under cProfile. See /deploytrace afterwards.")
+
+@bot.message_handler(commands=['restorestatus'])
+@command_handler
+def handle_restorestatus(message: Message):
+    if message.from_user.id != config.ADMIN_ID:
+        bot.reply_to(message, "Admin only.")
+        return
+    bot.reply_to(message, format_restore_status())
+
+# Prometheus endpoint for the bot's own counters and latencies
+start_metrics_server()
+
+# One supervisor thread restarts crashed premium services
+start_supervisor(bot)
+
+# Sample CPU, memory and open files of service processes for /stats and /top
+start_sampler(processes)
+
+# Rotate, compress and expire service logs
+start_log_rotation()
+
+# Probe live services periodically; watched ones that stay unhealthy are restarted
+start_health_monitor()
+
+# Deploy workers pick up queued uploads (including ones queued before a restart)
+start_scheduler(bot)
+
+# Suspend services nobody is using and wake them on the next request
+start_idle_manager()
+
+# Restart running services in the background; the bot answers commands meanwhile
+start_restore(bot)
 
 # Start polling
 if __name__ == '__main__':
     os.makedirs(config.DEPLOYMENTS_DIR, exist_ok=True)
     logging.info("Bot started")
-    bot.polling(none_stop=True)
+    run_frontend(bot)
@@ -8,7 +8,103 @@ PORT_RANGE = (8000, 9000)  # Range for assigning random ports
 DB_FILE = 'bot.db'  # SQLite database file
 DEPLOYMENTS_DIR = 'deployments'  # Base dir for user projects
 LOGS_DIR = 'logs'  # Dir for logs
-RATE_LIMIT_COMMANDS = 10  # Max commands per minute per user
+RATE_LIMIT_COMMANDS = 10  # Max commands per minute per free user (see RATE_LIMITS)
 MAX_DEPLOYS_FREE = 1  # Max deployments for free users
 MAX_DEPLOYS_PREMIUM = 5  # Max for premium
 WATCHDOG_INTERVAL = 10  # Seconds between process checks in watchdog
+DB_BUSY_TIMEOUT = 30  # Seconds a connection waits on a locked database
+DB_CACHE_SIZE_KB = 8192  # SQLite page cache per connection
+ACTIVITY_LOG_QUEUE_SIZE = 10000  # Max activity log rows waiting to be written
+ACTIVITY_LOG_BATCH_SIZE = 200  # Rows per write transaction
+ACTIVITY_LOG_FLUSH_INTERVAL = 1.0  # Max seconds a row waits before being written
+USER_CACHE_TTL = 300  # Seconds a cached user/ban lookup is trusted
+USER_CACHE_MAX_ENTRIES = 50000  # Max cached users (and bans) held in memory
+SCAN_CHUNK_SIZE = 64 * 1024  # Bytes read per step when scanning uploads
+SCAN_WORKERS = 4  # Files scanned in parallel
+MAX_ARCHIVE_FILES = 5000  # Max entries in an uploaded ZIP
+MAX_ARCHIVE_UNCOMPRESSED = 500 * 1024 * 1024  # Max total extracted size of an upload (bytes)
+MAX_COMPRESSION_RATIO = 100  # Max uncompressed/compressed ratio per entry
+VENV_CACHE_DIR = 'venv_cache'  # Prebuilt venvs keyed by requirements.txt hash
+WHEEL_CACHE_DIR = 'venv_cache/wheels'  # Shared pip wheel/download cache
+VENV_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024  # Disk budget for cached venvs
+VENV_CACHE_HARDLINK = False  # Hardlink instead of copy (saves disk, but tenants then share files)
+INCREMENTAL_UPDATES = True  # /update rewrites only changed files and keeps the venv if requirements match
+DEPLOY_WORKERS = 2  # Deploys/updates processed at the same time
+MAX_QUEUED_JOBS = 100  # Uploads waiting for a deploy worker before new ones are refused
+MAX_CONCURRENT_JOBS_PER_USER = 1  # Deploys/updates one user can have running at once
+BLUE_GREEN_UPDATES = True  # Start the new version beside the old one and switch when it is ready
+BLUE_GREEN_READY_TIMEOUT = 30  # Seconds a new version has to start accepting connections
+BLUE_GREEN_DRAIN_SECONDS = 5  # Seconds the old version keeps serving after the switch
+PROXY_ENABLED = True  # Serve all services through one reverse proxy port
+PROXY_HOST = '0.0.0.0'  # Proxy listen address
+PROXY_PORT = 9080  # Proxy listen port (keep outside PORT_RANGE)
+PROXY_DOMAIN = ''  # If set, <service_id>.<PROXY_DOMAIN> routes by host name instead of /s/<service_id>/
+PROXY_POOL_SIZE = 8  # Idle keep-alive connections kept per backend
+PROXY_POOL_IDLE_TIMEOUT = 30  # Seconds an idle upstream connection is kept
+PROXY_CONNECT_TIMEOUT = 5  # Seconds to connect to a backend
+PROXY_READ_TIMEOUT = 60  # Seconds to wait for a backend response
+PROXY_KEEPALIVE_TIMEOUT = 75  # Seconds an idle client connection is kept open
+PROXY_BUFFER_SIZE = 64 * 1024  # Bytes copied per read when streaming bodies
+PROXY_MAX_HEADER_BYTES = 64 * 1024  # Max size of a request/response head
+SHARED_STATIC_SERVER = True  # Serve static sites from one in-process server instead of http.server per site
+STATIC_MAX_AGE = 60  # Cache-Control max-age for static files (seconds)
+STATIC_COMPRESS_MIN_BYTES = 1024  # Smallest file that gets .gz/.br variants
+STATIC_VARIANT_DIR = 'static_variants'  # Precompressed .gz/.br variants, per service, outside user trees
+STATIC_META_CACHE_SIZE = 10000  # Cached file stat entries
+STATIC_META_CACHE_TTL = 2  # Seconds a cached stat is trusted
+STATIC_KEEPALIVE_TIMEOUT = 30  # Seconds an idle static connection is kept open
+STATIC_MAX_HEADER_BYTES = 16 * 1024  # Max size of a static request head
+IDLE_SUSPEND_ENABLED = True  # Stop services with no traffic and start them again on the next request (needs PROXY_ENABLED)
+IDLE_SUSPEND_AFTER = 1800  # Seconds without traffic before a service is suspended
+IDLE_SUSPEND_FREE_ONLY = True  # Keep premium services always running
+IDLE_CHECK_INTERVAL = 60  # Seconds between idle sweeps
+IDLE_WAKE_TIMEOUT = 30  # Seconds a woken service has to accept connections
+IDLE_CLIENT_WAIT_TIMEOUT = 45  # Seconds a client of a held port waits for the wake before it is dropped
+RESTORE_CONCURRENCY = 4  # Services started in parallel when the bot restarts
+RESTORE_STAGGER = 0.2  # Seconds between service starts during restoration
+HEALTH_CHECK_FILE = 'health.json'  # Optional per-project probe settings
+HEALTH_READY_TIMEOUT = 30  # Seconds a started service has to pass its readiness probe
+HEALTH_CHECK_INTERVAL = 60  # Seconds between periodic health checks
+HEALTH_PROBE_TIMEOUT = 2  # Seconds per probe attempt
+HEALTH_RETRIES = 3  # Attempts per periodic check before it counts as failed
+HEALTH_FAILURE_THRESHOLD = 3  # Failed checks in a row before a watched service is restarted
+HEALTH_WORKERS = 8  # Parallel probes during a periodic check
+RESOURCE_LIMITS = {  # Per-tier limits applied to every service process
+    'free': {'memory_mb': 256, 'cpu_percent': 50, 'pids': 64, 'open_files': 256},
+    'premium': {'memory_mb': 1024, 'cpu_percent': 200, 'pids': 256, 'open_files': 1024},
+}
+CGROUP_ROOT = '/sys/fs/cgroup/deploybot'  # cgroup v2 directory for service cgroups (needs write access)
+RESOURCE_SAMPLE_INTERVAL = 10  # Seconds between usage samples for /stats and /top
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate a service log once it reaches this size
+LOG_ROTATE_INTERVAL = 24 * 3600  # ...or after this many seconds
+LOG_RETENTION_BYTES = 50 * 1024 * 1024  # Compressed rotated logs kept per service
+LOG_CHECK_INTERVAL = 60  # Seconds between rotation checks
+LOG_TAIL_DEFAULT = 50  # Lines returned by /logs without a count
+LOG_TAIL_MAX = 1000  # Most lines /logs returns
+LOG_TAIL_MESSAGE_CHARS = 3500  # Longer tails are sent as a document
+METRICS_ENABLED = True  # Serve Prometheus metrics for the bot itself
+METRICS_HOST = '127.0.0.1'  # Keep local; scrape through an SSH tunnel or a local agent
+METRICS_PORT = 9101  # Port for the /metrics endpoint
+TRACE_LOG = 'logs/deploy_traces.jsonl'  # One JSON line per finished deploy/update job
+PROFILE_DIR = 'logs/profiles'  # cProfile output of jobs run after /profilenext
+BOT_MODE = 'polling'  # 'polling' (getUpdates) or 'webhook'
+BOT_WORKERS = 16  # Threads running handlers; one user's updates are still handled in order
+MAX_PENDING_UPDATES = 1000  # Updates waiting for a handler before new ones are dropped
+POLL_TIMEOUT = 30  # Long polling timeout in seconds
+WEBHOOK_URL = ''  # Public HTTPS URL Telegram posts to, ending in WEBHOOK_PATH
+WEBHOOK_HOST = '127.0.0.1'  # Local address of the webhook receiver (behind the TLS terminator)
+WEBHOOK_PORT = 8443  # Local port of the webhook receiver
+WEBHOOK_PATH = '/telegram-webhook'  # Path the receiver accepts updates on
+WEBHOOK_SECRET = ''  # Secret token Telegram sends back; random per start when empty
+WEBHOOK_MAX_BODY = 1024 * 1024  # Largest update accepted, in bytes
+RATE_LIMITS = {  # Per-tier token buckets: burst size and refill per minute for each budget
+    'free': {'command': (RATE_LIMIT_COMMANDS, RATE_LIMIT_COMMANDS), 'expensive': (3, 2)},
+    'premium': {'command': (30, 30), 'expensive': (10, 6)},
+}
+EXPENSIVE_COMMANDS = ('deploy', 'update', 'redeploy')  # Commands charged to the 'expensive' budget
+RATE_LIMIT_MAX_ENTRIES = 50000  # Buckets kept in memory; least recently used are dropped first
+MAX_UPLOAD_BYTES = {'free': 10 * 1024 * 1024, 'premium': 20 * 1024 * 1024}  # Largest ZIP accepted per tier (the cloud Bot API serves at most 20 MB)
+UPLOAD_WORKERS = 4  # Uploads downloaded at once; more wait their turn
+UPLOAD_TIMEOUT = 120  # Seconds without data before a download is abandoned
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Bytes read from Telegram per step
+TELEGRAM_FILE_URL = ''  # Download URL template ('{0}' token, '{1}' file path); empty uses telebot's (set for a local Bot API server)
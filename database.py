@@ -1,11 +1,18 @@
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 import config
+from metrics import ACTIVITY_LOG_DROPPED, ACTIVITY_LOG_QUEUED, ACTIVITY_LOG_WRITTEN, DB_QUERY_SECONDS
 
 # Initialize the database and create tables if they don't exist
 def init_db():
-    conn = sqlite3.connect(config.DB_FILE)
+    conn = get_conn()
     cursor = conn.cursor()
     
     # Users table: tracks premium status and deployment count
@@ -51,145 +58,502 @@ def init_db():
             timestamp DATETIME
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-# Helper to get a connection
+    # Bring older databases up to the current schema
+    migrate()
+
+# Connection management
+# Each thread keeps one connection open instead of connecting per call.
+# Connections run in autocommit mode; multi-statement writes go through transaction().
+_local = threading.local()
+
+# Times every statement run through Connection.execute/executemany, by leading keyword
+class _TimedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=_statement_kind(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=_statement_kind(sql))
+
+def _statement_kind(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+def _connect():
+    conn = sqlite3.connect(config.DB_FILE, timeout=config.DB_BUSY_TIMEOUT, isolation_level=None,
+                           factory=_TimedConnection)
+    # WAL lets readers run while a writer holds the lock; NORMAL sync is durable enough under WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT * 1000)}')
+    conn.execute(f'PRAGMA cache_size=-{int(config.DB_CACHE_SIZE_KB)}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+# Helper to get a connection (reused for the lifetime of the calling thread)
 def get_conn():
-    return sqlite3.connect(config.DB_FILE)
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+# Close the calling thread's connection, e.g. before a worker thread exits
+def close_conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+# Run several statements as one write transaction that commits once.
+# Nested use joins the outer transaction. Cache entries invalidated inside it are
+# invalidated again once it ends, so a reader can't re-cache the pre-commit row.
+@contextmanager
+def transaction():
+    conn = get_conn()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    _local.stale_users = set()
+    try:
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        stale, _local.stale_users = _local.stale_users, None
+        for user_id in stale:
+            _invalidate(user_id)
+
+# The old allocator could hand one port to two services. Keep each port on one service
+# (a running one first, then the oldest) and move the others to free ports in PORT_RANGE;
+# with none left, a service is stopped with no port and has to be deployed again.
+def _reassign_duplicate_ports(conn):
+    rows = conn.execute('''
+        SELECT service_id, port FROM services
+        WHERE port IN (SELECT port FROM services WHERE port IS NOT NULL GROUP BY port HAVING COUNT(*) > 1)
+        ORDER BY port, status != 'running', created_at, rowid
+    ''').fetchall()
+    used = {row[0] for row in conn.execute('SELECT DISTINCT port FROM services WHERE port IS NOT NULL')}
+    free = (port for port in range(config.PORT_RANGE[0], config.PORT_RANGE[1] + 1) if port not in used)
+    kept = set()
+    for service_id, port in rows:
+        if port not in kept:
+            kept.add(port)
+            continue
+        new_port = next(free, None)
+        if new_port is None:
+            conn.execute("UPDATE services SET port = NULL, status = 'stopped' WHERE service_id = ?", (service_id,))
+            logging.warning(f"Service {service_id} shared port {port} and was stopped: no free port left")
+        else:
+            conn.execute('UPDATE services SET port = ? WHERE service_id = ?', (new_port, service_id))
+            logging.warning(f"Service {service_id} shared port {port}; moved to port {new_port}")
+
+# Schema migrations
+# Ordered (version, steps) pairs. A step is an SQL string or a callable taking the connection.
+# Each version runs in its own transaction. Append new versions; never edit one that has shipped.
+MIGRATIONS = [
+    (1, [
+        # Hot lookups: services per user, running services, port allocation, activity per user
+        'CREATE INDEX IF NOT EXISTS idx_services_user_id ON services(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_services_status ON services(status)',
+        _reassign_duplicate_ports,  # Added after release: databases with duplicates failed here
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_services_port ON services(port)',
+        'CREATE INDEX IF NOT EXISTS idx_activity_logs_user_id ON activity_logs(user_id, timestamp)',
+    ]),
+    (2, [
+        # Deployment jobs: queued/running deploys and updates, kept across restarts
+        '''
+        CREATE TABLE IF NOT EXISTS deploy_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            kind TEXT,  -- deploy or update
+            service_id TEXT,
+            zip_path TEXT,
+            priority INTEGER,
+            status TEXT,  -- queued, running, done, failed, cancelled
+            phase TEXT,
+            created_at DATETIME,
+            started_at DATETIME,
+            finished_at DATETIME
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_deploy_jobs_status ON deploy_jobs(status)',
+    ]),
+    (3, [
+        # Last observed traffic, used to suspend idle services
+        'ALTER TABLE services ADD COLUMN last_request DATETIME',
+    ]),
+    (4, [
+        # Result of the latest readiness/health probe
+        'ALTER TABLE services ADD COLUMN health_status TEXT',
+        'ALTER TABLE services ADD COLUMN health_detail TEXT',
+        'ALTER TABLE services ADD COLUMN health_checked_at DATETIME',
+    ]),
+    (5, [
+        # Phase timings of each deploy/update job (see tracing.py)
+        '''
+        CREATE TABLE IF NOT EXISTS deploy_traces (
+            trace_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER,
+            service_id TEXT,
+            user_id INTEGER,
+            kind TEXT,
+            result TEXT,
+            started_at DATETIME,
+            seconds REAL,
+            spans TEXT,
+            profile_path TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_deploy_traces_service_id ON deploy_traces(service_id, trace_id)',
+        'CREATE INDEX IF NOT EXISTS idx_deploy_traces_job_id ON deploy_traces(job_id)',
+    ]),
+]
+
+def get_schema_version():
+    row = get_conn().execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def migrate():
+    get_conn().execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at DATETIME
+        )
+    ''')
+    for version, steps in MIGRATIONS:
+        with transaction() as conn:
+            # Re-check under the write lock in case another process migrated first
+            if version <= get_schema_version():
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute('INSERT INTO schema_version (version, applied_at) VALUES (?, ?)',
+                         (version, datetime.now()))
+        logging.info(f"Applied database migration {version}")
+
+# User and ban cache
+# The ban check and user lookup run on every command, so both are served from memory.
+# Writes invalidate entries explicitly; the TTL only bounds staleness from outside writers.
+# The generation counter stops a read that raced with an invalidation from caching stale data.
+_cache_lock = threading.Lock()
+_cache_generation = 0
+_user_cache = {}  # user_id: (expires_at, user dict)
+_ban_cache = {}  # user_id: (expires_at, ban row or None)
+
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return True, entry[1]
+    return False, None
+
+def _cache_put(cache, key, value, generation):
+    now = time.monotonic()
+    with _cache_lock:
+        if generation != _cache_generation:
+            return
+        if len(cache) >= config.USER_CACHE_MAX_ENTRIES:
+            for k in [k for k, (expires_at, _) in cache.items() if expires_at <= now]:
+                del cache[k]
+            if len(cache) >= config.USER_CACHE_MAX_ENTRIES:
+                cache.clear()
+        cache[key] = (now + config.USER_CACHE_TTL, value)
+
+def invalidate_user_cache(user_id=None):
+    stale = getattr(_local, 'stale_users', None)
+    if stale is not None:
+        stale.add(user_id)
+    _invalidate(user_id)
+
+def _invalidate(user_id):
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        if user_id is None:
+            _user_cache.clear()
+            _ban_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+            _ban_cache.pop(user_id, None)
 
 # User functions
 def add_or_get_user(user_id):
+    hit, user = _cache_get(_user_cache, user_id)
+    if hit:
+        return dict(user)
+    generation = _cache_generation
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    if not user:
-        cursor.execute('INSERT INTO users (user_id) VALUES (?)', (user_id,))
-        conn.commit()
-        user = (user_id, False, 0)
-    conn.close()
-    return {'user_id': user[0], 'is_premium': user[1], 'deployment_count': user[2]}
+    row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    if not row:
+        conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+        row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    user = {'user_id': row[0], 'is_premium': row[1], 'deployment_count': row[2]}
+    _cache_put(_user_cache, user_id, user, generation)
+    return dict(user)
 
-def update_premium(user_id, is_premium):
+# Load many users with one query (missing ones are not created) and warm the cache
+def get_users(user_ids):
+    user_ids = list(user_ids)
+    users = {}
+    generation = _cache_generation
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_premium = ? WHERE user_id = ?', (is_premium, user_id))
-    conn.commit()
-    conn.close()
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f'SELECT * FROM users WHERE user_id IN ({placeholders})', chunk):
+            user = {'user_id': row[0], 'is_premium': row[1], 'deployment_count': row[2]}
+            _cache_put(_user_cache, row[0], user, generation)
+            users[row[0]] = dict(user)
+    return users
+
+def update_premium(user_id, is_premium):
+    get_conn().execute('UPDATE users SET is_premium = ? WHERE user_id = ?', (is_premium, user_id))
+    invalidate_user_cache(user_id)
 
 def get_deployment_count(user_id):
     user = add_or_get_user(user_id)
     return user['deployment_count']
 
 def increment_deployment_count(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET deployment_count = deployment_count + 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_conn().execute('UPDATE users SET deployment_count = deployment_count + 1 WHERE user_id = ?', (user_id,))
+    invalidate_user_cache(user_id)
 
 def decrement_deployment_count(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET deployment_count = deployment_count - 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_conn().execute('UPDATE users SET deployment_count = deployment_count - 1 WHERE user_id = ?', (user_id,))
+    invalidate_user_cache(user_id)
 
 # Service functions
+def _service_row(service):
+    return {
+        'service_id': service[0], 'user_id': service[1], 'port': service[2], 'status': service[3],
+        'created_at': service[4], 'last_restart': service[5], 'project_type': service[6], 'path': service[7],
+        'last_request': service[8], 'health_status': service[9], 'health_detail': service[10],
+        'health_checked_at': service[11]
+    }
+
 def add_service(service_id, user_id, port, status, created_at, last_restart, project_type, path):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('''
+    get_conn().execute('''
         INSERT INTO services (service_id, user_id, port, status, created_at, last_restart, project_type, path)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ''', (service_id, user_id, port, status, created_at, last_restart, project_type, path))
-    conn.commit()
-    conn.close()
 
 def get_service(service_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM services WHERE service_id = ?', (service_id,))
-    service = cursor.fetchone()
-    conn.close()
+    service = get_conn().execute('SELECT * FROM services WHERE service_id = ?', (service_id,)).fetchone()
     if service:
-        return {
-            'service_id': service[0], 'user_id': service[1], 'port': service[2], 'status': service[3],
-            'created_at': service[4], 'last_restart': service[5], 'project_type': service[6], 'path': service[7]
-        }
+        return _service_row(service)
     return None
 
 def update_status(service_id, status):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE services SET status = ? WHERE service_id = ?', (status, service_id))
-    conn.commit()
-    conn.close()
+    get_conn().execute('UPDATE services SET status = ? WHERE service_id = ?', (status, service_id))
 
 def update_last_restart(service_id, last_restart):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE services SET last_restart = ? WHERE service_id = ?', (last_restart, service_id))
-    conn.commit()
-    conn.close()
+    get_conn().execute('UPDATE services SET last_restart = ? WHERE service_id = ?', (last_restart, service_id))
+
+# Point a service at a new port and directory (blue/green switch)
+def update_service_location(service_id, port, path):
+    get_conn().execute('UPDATE services SET port = ?, path = ? WHERE service_id = ?', (port, path, service_id))
+
+# rows: [(health_status, health_detail, health_checked_at, service_id), ...]
+def update_health(rows):
+    with transaction() as conn:
+        conn.executemany('''
+            UPDATE services SET health_status = ?, health_detail = ?, health_checked_at = ? WHERE service_id = ?
+        ''', rows)
+
+# rows: [(last_request, service_id), ...]
+def update_last_requests(rows):
+    with transaction() as conn:
+        conn.executemany('UPDATE services SET last_request = ? WHERE service_id = ?', rows)
 
 def get_services_for_user(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT service_id FROM services WHERE user_id = ?', (user_id,))
-    services = cursor.fetchall()
-    conn.close()
+    services = get_conn().execute('SELECT service_id FROM services WHERE user_id = ?', (user_id,)).fetchall()
     return [s[0] for s in services]
 
+def get_all_service_ports():
+    return get_conn().execute('SELECT service_id, port FROM services').fetchall()
+
 def get_running_services():
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM services WHERE status = "running"')
-    services = cursor.fetchall()
-    conn.close()
-    return [{
-        'service_id': s[0], 'user_id': s[1], 'port': s[2], 'status': s[3],
-        'created_at': s[4], 'last_restart': s[5], 'project_type': s[6], 'path': s[7]
-    } for s in services]
+    services = get_conn().execute("SELECT * FROM services WHERE status = 'running'").fetchall()
+    return [_service_row(s) for s in services]
 
 def delete_service(service_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM services WHERE service_id = ?', (service_id,))
-    conn.commit()
-    conn.close()
+    get_conn().execute('DELETE FROM services WHERE service_id = ?', (service_id,))
 
 # Ban functions
 def ban_user(user_id, reason):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO bans (user_id, reason, banned_at) VALUES (?, ?, ?)',
-                   (user_id, reason, datetime.now()))
-    conn.commit()
-    conn.close()
+    get_conn().execute('INSERT OR REPLACE INTO bans (user_id, reason, banned_at) VALUES (?, ?, ?)',
+                       (user_id, reason, datetime.now()))
+    invalidate_user_cache(user_id)
 
 def unban_user(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM bans WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_conn().execute('DELETE FROM bans WHERE user_id = ?', (user_id,))
+    invalidate_user_cache(user_id)
 
 def get_ban(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bans WHERE user_id = ?', (user_id,))
-    ban = cursor.fetchone()
-    conn.close()
+    hit, ban = _cache_get(_ban_cache, user_id)
+    if hit:
+        return ban
+    generation = _cache_generation
+    ban = get_conn().execute('SELECT * FROM bans WHERE user_id = ?', (user_id,)).fetchone()
+    _cache_put(_ban_cache, user_id, ban, generation)
     return ban
 
+# Deployment job functions
+def _job_row(job):
+    return {
+        'job_id': job[0], 'user_id': job[1], 'chat_id': job[2], 'kind': job[3], 'service_id': job[4],
+        'zip_path': job[5], 'priority': job[6], 'status': job[7], 'phase': job[8],
+        'created_at': job[9], 'started_at': job[10], 'finished_at': job[11]
+    }
+
+def add_job(user_id, chat_id, kind, service_id, zip_path, priority):
+    cursor = get_conn().execute('''
+        INSERT INTO deploy_jobs (user_id, chat_id, kind, service_id, zip_path, priority, status, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)
+    ''', (user_id, chat_id, kind, service_id, zip_path, priority, datetime.now()))
+    return cursor.lastrowid
+
+def update_job_status(job_id, status):
+    if status == 'running':
+        get_conn().execute('UPDATE deploy_jobs SET status = ?, started_at = ? WHERE job_id = ?',
+                           (status, datetime.now(), job_id))
+    elif status == 'queued':
+        get_conn().execute('UPDATE deploy_jobs SET status = ? WHERE job_id = ?', (status, job_id))
+    else:
+        get_conn().execute('UPDATE deploy_jobs SET status = ?, finished_at = ? WHERE job_id = ?',
+                           (status, datetime.now(), job_id))
+
+def update_job_phase(job_id, phase):
+    get_conn().execute('UPDATE deploy_jobs SET phase = ? WHERE job_id = ?', (phase, job_id))
+
+def get_jobs_by_status(status):
+    jobs = get_conn().execute('SELECT * FROM deploy_jobs WHERE status = ? ORDER BY job_id', (status,)).fetchall()
+    return [_job_row(j) for j in jobs]
+
+# Deploy trace functions
+def _trace_row(trace):
+    return {
+        'trace_id': trace[0], 'job_id': trace[1], 'service_id': trace[2], 'user_id': trace[3], 'kind': trace[4],
+        'result': trace[5], 'started_at': trace[6], 'seconds': trace[7], 'spans': trace[8], 'profile_path': trace[9]
+    }
+
+def add_trace(job_id, service_id, user_id, kind, result, started_at, seconds, spans, profile_path):
+    get_conn().execute('''
+        INSERT INTO deploy_traces (job_id, service_id, user_id, kind, result, started_at, seconds, spans, profile_path)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, service_id, user_id, kind, result, datetime.fromtimestamp(started_at), seconds, spans,
+          profile_path))
+
+# Latest trace for a service ID, or for a job when given its number
+def get_latest_trace(service_id=None, job_id=None):
+    if job_id is not None:
+        trace = get_conn().execute('SELECT * FROM deploy_traces WHERE job_id = ? ORDER BY trace_id DESC LIMIT 1',
+                                   (job_id,)).fetchone()
+    else:
+        trace = get_conn().execute('SELECT * FROM deploy_traces WHERE service_id = ? ORDER BY trace_id DESC LIMIT 1',
+                                   (service_id,)).fetchone()
+    return _trace_row(trace) if trace else None
+
 # Activity log
+# Rows are queued and written by a background thread in batched transactions so
+# callers never wait on audit I/O. Without a running writer, rows are written inline.
+_log_queue = queue.Queue(maxsize=config.ACTIVITY_LOG_QUEUE_SIZE)
+_log_thread = None
+_LOG_STOP = object()
+
 def log_activity(user_id, action, details):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO activity_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)',
-                   (user_id, action, details, datetime.now()))
-    conn.commit()
-    conn.close()
+    row = (user_id, action, details, datetime.now())
+    if _log_thread is None:
+        _write_log_batch([row])
+        return
+    try:
+        _log_queue.put_nowait(row)
+    except queue.Full:
+        ACTIVITY_LOG_DROPPED.inc()
+        logging.warning(f"Activity log queue full, dropped {action} for user {user_id}")
+
+def _write_log_batch(rows):
+    try:
+        with transaction() as conn:
+            conn.executemany('INSERT INTO activity_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)',
+                             rows)
+        ACTIVITY_LOG_WRITTEN.inc(len(rows))
+    except sqlite3.Error as e:
+        ACTIVITY_LOG_DROPPED.inc(len(rows))
+        logging.error(f"Failed to write {len(rows)} activity log rows: {str(e)}")
+
+def _log_writer_loop():
+    stopping = False
+    while not stopping:
+        row = _log_queue.get()
+        if row is _LOG_STOP:
+            break
+        batch = [row]
+        # Collect until the batch is full or the flush interval has passed
+        deadline = time.monotonic() + config.ACTIVITY_LOG_FLUSH_INTERVAL
+        while len(batch) < config.ACTIVITY_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = _log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if row is _LOG_STOP:
+                stopping = True
+                break
+            batch.append(row)
+        _write_log_batch(batch)
+    close_conn()
+
+def start_log_writer():
+    global _log_thread
+    if _log_thread is not None:
+        return
+    _log_thread = threading.Thread(target=_log_writer_loop, name='activity-log-writer', daemon=True)
+    _log_thread.start()
+    atexit.register(stop_log_writer)
+
+# Flush everything queued so far and stop the writer; later rows are written inline
+def stop_log_writer(timeout=10):
+    global _log_thread
+    thread = _log_thread
+    if thread is None:
+        return
+    _log_thread = None
+    deadline = time.monotonic() + timeout
+    try:
+        _log_queue.put(_LOG_STOP, timeout=timeout)
+    except queue.Full:
+        # The writer died (or is stuck) with the queue full; the rows are written below
+        logging.error("Activity log writer is not draining its queue")
+    thread.join(max(0, deadline - time.monotonic()))
+    # Rows that raced in behind the stop marker, or that a dead writer left behind
+    leftover = []
+    while True:
+        try:
+            row = _log_queue.get_nowait()
+        except queue.Empty:
+            break
+        if row is not _LOG_STOP:
+            leftover.append(row)
+    if leftover:
+        _write_log_batch(leftover)
+
+ACTIVITY_LOG_QUEUED.set_callback(_log_queue.qsize)
@@ -1,41 +1,72 @@
 import os
+import queue
+import selectors
 import shutil
 import subprocess
 import threading
 import time
-import zipfile
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 from database import *
-from security import scan_for_malicious_content
-from utils import generate_service_id, get_unused_port
+from health import check_health, describe_health, load_check, wait_until_healthy
+from limits import apply_limits
+from metrics import PROCESS_EXITS, PROCESSES, SUPERVISOR_RESTARTS, WATCHDOGS
+from tracing import set_trace_service, span
+from service_logs import open_log
+from proxy import service_link, set_route
+from static_server import delete_variants, serve_site
+from security import ArchiveRejected, extract_archive, scan_archive, sync_archive
+from venv_cache import copy_venv, setup_venv
+from utils import generate_service_id, get_unused_port, release_port, PortExhaustedError
 
 # Global dicts for managing processes and watchdogs
 processes = {}  # service_id: subprocess.Popen
-watchdogs = {}  # service_id: threading.Thread
+watchdogs = {}  # service_id: True while the supervisor should auto-restart it
+PROCESSES.set_callback(lambda: len(processes))
+WATCHDOGS.set_callback(lambda: len(watchdogs))
 
-def deploy_project(user_id, zip_path, bot, chat_id):
-    # Extract ZIP to temp dir
-    temp_dir = f'temp_deploy_{user_id}_{time.time()}'
-    os.makedirs(temp_dir, exist_ok=True)
+# Check an uploaded ZIP in-stream and extract it to temp_dir only if it passes
+# (temp_dir=None only checks). Returns False after notifying and cleaning up if rejected.
+def _ingest_upload(user_id, zip_path, temp_dir, bot, chat_id, kind):
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-    except Exception as e:
+        with span('scan', bytes=os.path.getsize(zip_path)):
+            is_malicious, reason = scan_archive(zip_path)
+    except ArchiveRejected as e:
         bot.send_message(chat_id, f"Error extracting ZIP: {str(e)}")
-        shutil.rmtree(temp_dir)
         os.remove(zip_path)
-        return
-
-    # Scan for malicious content
-    is_malicious, reason = scan_for_malicious_content(temp_dir)
+        return False
     if is_malicious:
         ban_user(user_id, reason)
         bot.send_message(chat_id, f"You have been banned: {reason}")
-        bot.send_message(config.ADMIN_ID, f"User {user_id} banned for malicious upload: {reason}")
+        bot.send_message(config.ADMIN_ID, f"User {user_id} banned for malicious {kind}: {reason}")
+        os.remove(zip_path)
+        return False
+    if temp_dir is None:
+        return True
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        with span('extract') as attrs:
+            attrs['bytes'] = extract_archive(zip_path, temp_dir)
+    except Exception as e:
+        bot.send_message(chat_id, f"Error extracting ZIP: {str(e)}")
         shutil.rmtree(temp_dir)
         os.remove(zip_path)
+        return False
+    return True
+
+# Tell the caller (e.g. the job scheduler) which phase a deploy or update reached
+def _report_phase(progress, phase):
+    if progress is not None:
+        progress(phase)
+
+# Returns True once the service is deployed and started
+def deploy_project(user_id, zip_path, bot, chat_id, progress=None):
+    # Validate and scan the archive, then extract to temp dir
+    _report_phase(progress, 'scanning')
+    temp_dir = f'temp_deploy_{user_id}_{time.time()}'
+    if not _ingest_upload(user_id, zip_path, temp_dir, bot, chat_id, 'upload'):
         return
 
     # Check deployment limits
@@ -49,6 +80,7 @@ def deploy_project(user_id, zip_path, bot, chat_id):
 
     # Setup service
     service_id = generate_service_id()
+    set_trace_service(service_id)
     user_dir = os.path.join(config.DEPLOYMENTS_DIR, f'user_{user_id}')
     os.makedirs(user_dir, exist_ok=True)
     service_dir = os.path.join(user_dir, service_id)
@@ -57,24 +89,17 @@ def deploy_project(user_id, zip_path, bot, chat_id):
     # Detect project type
     if os.path.exists(os.path.join(service_dir, 'app.py')) and os.path.exists(os.path.join(service_dir, 'requirements.txt')):
         project_type = 'flask'
-        # Create venv and install requirements
+        # Create venv and install requirements (served from the venv cache when possible)
         venv_path = os.path.join(service_dir, 'venv')
-        subprocess.run(['python', '-m', 'venv', venv_path], check=True)
-        pip_path = os.path.join(venv_path, 'bin', 'pip')
         req_path = os.path.join(service_dir, 'requirements.txt')
-        install_process = subprocess.run([pip_path, 'install', '-r', req_path])
-        if install_process.returncode != 0:
+        _report_phase(progress, 'installing dependencies')
+        if not setup_venv(req_path, venv_path):
             bot.send_message(chat_id, "Error installing requirements.txt")
             shutil.rmtree(service_dir)
             os.remove(zip_path)
             return
-        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(service_dir, 'app.py')]
-        env = os.environ.copy()
-        env['PORT'] = ''  # Will set later
     elif os.path.exists(os.path.join(service_dir, 'index.html')):
         project_type = 'static'
-        cmd = ['python', '-m', 'http.server', '--directory', service_dir]
-        env = None
     else:
         bot.send_message(chat_id, "Unsupported project type. Need app.py + requirements.txt (Flask) or index.html (static).")
         shutil.rmtree(service_dir)
@@ -82,145 +107,495 @@ def deploy_project(user_id, zip_path, bot, chat_id):
         return
 
     # Assign port and start
-    port = get_unused_port()
+    try:
+        with span('port'):
+            port = get_unused_port()
+    except PortExhaustedError as e:
+        bot.send_message(chat_id, "No capacity left for new deployments. Please try again later.")
+        bot.send_message(config.ADMIN_ID, f"Deployment by user {user_id} failed: {str(e)}")
+        shutil.rmtree(service_dir)
+        os.remove(zip_path)
+        return
     now = datetime.now()
-    add_service(service_id, user_id, port, 'running', now, now, project_type, service_dir)
-    increment_deployment_count(user_id)
-
-    if project_type == 'static':
-        cmd.append(str(port))
-    else:
-        env['PORT'] = str(port)
+    try:
+        with transaction():
+            add_service(service_id, user_id, port, 'running', now, now, project_type, service_dir)
+            increment_deployment_count(user_id)
+    except Exception:
+        release_port(port)
+        raise
+    set_route(service_id, port)
 
-    start_process(service_id, cmd, env, project_type)
+    _report_phase(progress, 'starting')
+    with span('start'):
+        process = launch_service(service_id, project_type, service_dir, port)
     if user['is_premium']:
         start_watchdog(service_id)
+    with span('ready'):
+        ready, detail = check_readiness(service_id, process, project_type, service_dir, port)
 
-    link = f"http://{config.SERVER_IP}:{port}"
-    bot.send_message(chat_id, f"Deployment successful! Service ID: {service_id}\nLink: {link}\nNote: For Flask, ensure app.py uses port=int(os.environ.get('PORT', 5000)) and host='0.0.0.0'")
-    bot.send_message(config.ADMIN_ID, f"New deployment by user {user_id}: {service_id} ({project_type}) on port {port}")
-    log_activity(user_id, 'deploy', f"Service {service_id} deployed")
+    link = service_link(service_id, port)
+    if ready:
+        bot.send_message(chat_id, f"Deployment successful! Service ID: {service_id}\nLink: {link}\nHealth: {describe_health(ready, detail)}\nNote: For Flask, ensure app.py uses port=int(os.environ.get('PORT', 5000)) and host='0.0.0.0'")
+    else:
+        bot.send_message(chat_id, f"Deployment successful! Service ID: {service_id}\nWarning: not ready yet ({detail})\nLink: {link}\nNote: For Flask, ensure app.py uses port=int(os.environ.get('PORT', 5000)) and host='0.0.0.0'")
+    bot.send_message(config.ADMIN_ID, f"New deployment by user {user_id}: {service_id} ({project_type}) on port {port}, {describe_health(ready, detail)}")
+    log_activity(user_id, 'deploy', f"Service {service_id} deployed ({'ready' if ready else 'not ready'})")
     os.remove(zip_path)
+    return True
 
-def update_project(user_id, service_id, zip_path, bot, chat_id):
+# Returns True once the updated service is running again
+def update_project(user_id, service_id, zip_path, bot, chat_id, progress=None):
     service = get_service(service_id)
     if not service or service['user_id'] != user_id:
         bot.send_message(chat_id, "Invalid service ID or not yours.")
         os.remove(zip_path)
         return
 
-    # Stop current process if running
-    stop_process(service_id)
-    update_status(service_id, 'stopped')
-
-    # Extract to temp
-    temp_dir = f'temp_update_{user_id}_{time.time()}'
-    os.makedirs(temp_dir, exist_ok=True)
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-    except Exception as e:
-        bot.send_message(chat_id, f"Error extracting ZIP: {str(e)}")
-        shutil.rmtree(temp_dir)
-        os.remove(zip_path)
+    # Validate and scan before touching the running service
+    _report_phase(progress, 'scanning')
+    if not _ingest_upload(user_id, zip_path, None, bot, chat_id, 'update'):
         return
 
-    # Scan
-    is_malicious, reason = scan_for_malicious_content(temp_dir)
-    if is_malicious:
-        ban_user(user_id, reason)
-        bot.send_message(chat_id, f"You have been banned: {reason}")
-        bot.send_message(config.ADMIN_ID, f"User {user_id} banned for malicious update: {reason}")
-        shutil.rmtree(temp_dir)
-        os.remove(zip_path)
-        return
+    # Blue/green: build the new version beside the live one and switch once it is ready
+    # A held service has nothing to keep serving; it is simply started with the new version
+    blue_green = (config.BLUE_GREEN_UPDATES and service['status'] == 'running' and is_process_running(service_id)
+                  and not is_held(service_id))
+    if blue_green:
+        target_dir = _next_service_dir(service)
+    else:
+        # Stop current process if running
+        stop_process(service_id)
+        update_status(service_id, 'stopped')
+        target_dir = service['path']
 
-    # Clear old dir and move new
-    shutil.rmtree(service['path'])
-    shutil.move(temp_dir, service['path'])
+    project_type = service['project_type']
+    venv_path = os.path.join(target_dir, 'venv')
+    _report_phase(progress, 'applying changes')
+    if config.INCREMENTAL_UPDATES and os.path.isdir(service['path']):
+        # Rewrite only the files that differ, keeping the venv in place
+        with span('sync') as attrs:
+            if blue_green:
+                # Hardlink the live tree; sync_archive replaces files by rename, never in place
+                shutil.copytree(service['path'], target_dir, symlinks=True, copy_function=os.link,
+                                ignore=lambda d, names: ['venv'] if d == service['path'] else [])
+            changes = sync_archive(zip_path, target_dir, preserve=('venv',))
+            attrs['files'] = sum(len(paths) for paths in changes.values())
+        old_venv = os.path.join(service['path'], 'venv')
+        rebuild_venv = ('requirements.txt' in changes['added'] + changes['changed']
+                        or not os.path.isdir(old_venv))
+        if blue_green and project_type == 'flask' and not rebuild_venv:
+            with span('venv_clone'):
+                copy_venv(old_venv, venv_path, os.path.abspath(old_venv))
+        summary = (f"{len(changes['added'])} added, {len(changes['changed'])} changed, "
+                   f"{len(changes['removed'])} removed")
+    else:
+        # Clear old dir and extract the new tree
+        if not blue_green:
+            shutil.rmtree(target_dir, ignore_errors=True)
+        os.makedirs(target_dir, exist_ok=True)
+        with span('extract') as attrs:
+            attrs['bytes'] = extract_archive(zip_path, target_dir)
+        rebuild_venv = True
+        summary = "full replace"
 
     # Re-setup if flask
-    project_type = service['project_type']
-    if project_type == 'flask':
-        venv_path = os.path.join(service['path'], 'venv')
-        subprocess.run(['python', '-m', 'venv', venv_path], check=True)
-        pip_path = os.path.join(venv_path, 'bin', 'pip')
-        req_path = os.path.join(service['path'], 'requirements.txt')
-        install_process = subprocess.run([pip_path, 'install', '-r', req_path])
-        if install_process.returncode != 0:
-            bot.send_message(chat_id, "Error installing requirements.txt")
+    if project_type == 'flask' and rebuild_venv:
+        shutil.rmtree(venv_path, ignore_errors=True)
+        req_path = os.path.join(target_dir, 'requirements.txt')
+        _report_phase(progress, 'installing dependencies')
+        if not setup_venv(req_path, venv_path):
+            bot.send_message(chat_id, "Error installing requirements.txt" +
+                             (". The previous version is still running." if blue_green else ""))
+            if blue_green:
+                shutil.rmtree(target_dir, ignore_errors=True)
+            os.remove(zip_path)
+            return
+    elif project_type == 'flask':
+        summary += ", dependencies unchanged"
+
+    _report_phase(progress, 'starting')
+    if blue_green:
+        with span('switch'):
+            port = blue_green_switch(service, target_dir)
+        if port is None:
+            shutil.rmtree(target_dir, ignore_errors=True)
+            bot.send_message(chat_id, f"Update of {service_id} did not become ready in time and was rolled back. "
+                                      f"The previous version is still running.")
+            bot.send_message(config.ADMIN_ID, f"Update of {service_id} by user {user_id} rolled back")
+            log_activity(user_id, 'update', f"Service {service_id} update rolled back")
             os.remove(zip_path)
             return
-        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(service['path'], 'app.py')]
+    else:
+        # Restart in place
+        port = service['port']
+        update_status(service_id, 'running')
+        with span('start'):
+            process = launch_service(service_id, project_type, target_dir, port)
+        user = add_or_get_user(user_id)
+        if user['is_premium']:
+            start_watchdog(service_id)
+        update_last_restart(service_id, datetime.now())
+        with span('ready'):
+            ready, detail = check_readiness(service_id, process, project_type, target_dir, port)
+        if not ready:
+            link = service_link(service_id, port)
+            bot.send_message(chat_id, f"Update successful for {service_id}!\nWarning: not ready yet ({detail})\n"
+                                      f"Link: {link}\nChanges: {summary}")
+            bot.send_message(config.ADMIN_ID, f"User {user_id} updated service {service_id} ({summary}), not ready")
+            log_activity(user_id, 'update', f"Service {service_id} updated ({summary}), not ready")
+            os.remove(zip_path)
+            return True
+
+    link = service_link(service_id, port)
+    health = describe_health(True, get_service(service_id)['health_detail'])  # Recorded by the readiness check
+    bot.send_message(chat_id, f"Update successful for {service_id}! Link: {link}\nChanges: {summary}\nHealth: {health}")
+    bot.send_message(config.ADMIN_ID, f"User {user_id} updated service {service_id} ({summary})")
+    log_activity(user_id, 'update', f"Service {service_id} updated ({summary})")
+    os.remove(zip_path)
+    return True
+
+# Blue/green switching
+# The new version runs under a temporary key on a fresh port. Once it accepts connections
+# the service row is pointed at it, and the old process is drained and stopped in the background.
+def is_process_running(service_id):
+    process = processes.get(service_id)
+    return process is not None and process.poll() is None
+
+# Held (scaled-to-zero) services have a placeholder listener in processes, not a process
+def is_held(service_id):
+    process = processes.get(service_id)
+    return getattr(process, 'held', False) and process.poll() is None
+
+# Sibling directory for the next version of a service
+def _next_service_dir(service):
+    parent = os.path.dirname(service['path'])
+    return os.path.join(parent, f"{service['service_id']}-{int(time.time() * 1000)}")
+
+# Wait until a freshly started process accepts TCP connections (or passes the given check)
+def wait_until_ready(process, port, timeout, check=None):
+    check = check or {'type': 'tcp', 'path': '/', 'timeout': 1, 'retries': 1}
+    return wait_until_healthy(process, port, check, timeout)[0]
+
+# Probe a started service until it passes its readiness check and store the result
+# Returns (ready, detail)
+def check_readiness(service_id, process, project_type, path, port):
+    ready, detail = wait_until_healthy(process, port, load_check(path, project_type), config.HEALTH_READY_TIMEOUT)
+    _record_health([(service_id, ready, detail)])
+    return ready, detail
+
+def _record_health(results):
+    now = datetime.now()
+    update_health([('healthy' if ok else 'unhealthy', detail, now, service_id) for service_id, ok, detail in results])
+
+_switch_locks = {}  # service_id: threading.Lock, one switch per service at a time
+_switch_locks_lock = threading.Lock()
+
+# Start the service from new_path (default: its current path) on a new port and switch
+# to it once ready. Returns the new port, or None if it never became ready (the old
+# version keeps running)
+def blue_green_switch(service, new_path=None):
+    service_id = service['service_id']
+    with _switch_locks_lock:
+        lock = _switch_locks.setdefault(service_id, threading.Lock())
+    with lock:
+        # An earlier switch may have moved the service while this one waited
+        service = get_service(service_id) or service
+        return _switch(service, new_path or service['path'])
+
+def _switch(service, new_path):
+    service_id = service['service_id']
+    try:
+        port = get_unused_port()
+    except PortExhaustedError as e:
+        logging.error(f"Blue/green switch for {service_id} failed: {str(e)}")
+        return None
+    next_key = f'{service_id}.next.{port}'
+    process = launch_service(service_id, service['project_type'], new_path, port, key=next_key)
+    check = load_check(new_path, service['project_type'])
+    ready, detail = wait_until_healthy(process, port, check, config.BLUE_GREEN_READY_TIMEOUT)
+    if not ready:
+        logging.warning(f"New version of {service_id} never became ready ({detail}), rolling back")
+        stop_process(next_key)
+        release_port(port)
+        return None
+    _record_health([(service_id, ready, detail)])
+
+    with transaction():
+        update_service_location(service_id, port, new_path)
+        update_last_restart(service_id, datetime.now())
+    set_route(service_id, port)
+    old_process = processes.get(service_id)
+    processes[service_id] = processes.pop(next_key)
+    _supervisor_send('unwatch', next_key)
+    _supervisor_send('watch', service_id, process)
+    logging.info(f"Switched {service_id} to port {port}")
+
+    threading.Thread(target=_retire_version, daemon=True,
+                     args=(service_id, old_process, service['port'], service['path'], new_path)).start()
+    return port
+
+# Drain and stop the previous version after a switch
+def _retire_version(service_id, old_process, old_port, old_path, new_path):
+    time.sleep(config.BLUE_GREEN_DRAIN_SECONDS)
+    if old_process is not None:
+        _terminate(old_process)
+    release_port(old_port)
+    if os.path.abspath(old_path) != os.path.abspath(new_path):
+        shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f"Retired previous version of {service_id}")
+
+# Build the launch command for a stored service
+def build_command(project_type, path, port):
+    if project_type == 'flask':
+        venv_path = os.path.join(path, 'venv')
+        cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
         env = os.environ.copy()
-        env['PORT'] = str(service['port'])
+        env['PORT'] = str(port)
     else:
-        cmd = ['python', '-m', 'http.server', str(service['port']), '--directory', service['path']]
+        cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
         env = None
+    return cmd, env
 
-    # Restart
-    update_status(service_id, 'running')
-    start_process(service_id, cmd, env, project_type)
-    user = add_or_get_user(user_id)
-    if user['is_premium']:
-        start_watchdog(service_id)
-    update_last_restart(service_id, datetime.now())
-
-    link = f"http://{config.SERVER_IP}:{service['port']}"
-    bot.send_message(chat_id, f"Update successful for {service_id}! Link: {link}")
-    bot.send_message(config.ADMIN_ID, f"User {user_id} updated service {service_id}")
-    log_activity(user_id, 'update', f"Service {service_id} updated")
-    os.remove(zip_path)
+# Start a stored service; static sites go to the shared static server when it is enabled
+def launch_service(service_id, project_type, path, port, key=None):
+    if project_type == 'static' and config.SHARED_STATIC_SERVER:
+        key = key or service_id
+        site = serve_site(service_id, port, path)
+        processes[key] = site
+        _supervisor_send('watch', key, site)
+        logging.info(f"Serving {key} from the shared static server on port {port}")
+        return site
+    cmd, env = build_command(project_type, path, port)
+    return start_process(service_id, cmd, env, project_type, key=key)
 
-def start_process(service_id, cmd, env, project_type):
+# key overrides the processes entry (e.g. for a blue/green candidate); the log stays per service
+def start_process(service_id, cmd, env, project_type, key=None):
     # Start the process in background, log to per-service file
-    log_file = os.path.join(config.LOGS_DIR, f'{service_id}.log')
-    with open(log_file, 'a') as log:
-        process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    key = key or service_id
+    with span('spawn'):
+        with open_log(service_id) as log:
+            process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        apply_limits(service_id, process.pid)
+    processes[key] = process
+    _supervisor_send('watch', key, process)
+    logging.info(f"Started process for {key} ({project_type})")
+    return process
+
+def _terminate(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+# Put a new handle in place for a service and stop the previous process
+def replace_process(service_id, process):
+    old = processes.get(service_id)
     processes[service_id] = process
-    logging.info(f"Started process for {service_id} ({project_type})")
+    _supervisor_send('watch', service_id, process)
+    if old is not None and old is not process:
+        _terminate(old)
 
 def stop_process(service_id):
-    if service_id in processes:
-        processes[service_id].terminate()
-        try:
-            processes[service_id].wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            processes[service_id].kill()
-        del processes[service_id]
+    # Remove from processes first so the supervisor treats the exit as intentional
+    watchdogs.pop(service_id, None)
+    process = processes.pop(service_id, None)
+    if process is not None:
+        _terminate(process)
         logging.info(f"Stopped process for {service_id}")
-    # Watchdog will stop naturally since process is gone
 
 def start_watchdog(service_id):
     if service_id in watchdogs:
-        return  # Already running
-    thread = threading.Thread(target=watchdog_func, args=(service_id,), daemon=True)
-    thread.start()
-    watchdogs[service_id] = thread
+        return  # Already supervised
+    watchdogs[service_id] = True
+    start_supervisor()
     logging.info(f"Started watchdog for {service_id}")
 
-def watchdog_func(service_id):
-    # Basic watchdog: check every interval if process died, restart if status is running
+# Process supervisor
+# A single thread watches every child in `processes` and wakes as soon as one exits,
+# using a pidfd per child where the kernel supports it and polling otherwise.
+# Services in `watchdogs` are restarted if their stored status is still 'running'.
+# Other threads talk to it through a command queue plus a wakeup pipe, so the
+# selector is only ever touched by the supervisor thread.
+_supervisor_commands = queue.Queue()
+_supervisor_lock = threading.Lock()
+_supervisor_thread = None
+_supervisor_wakeup = None  # (read_fd, write_fd)
+_supervisor_bot = None  # Used to notify the admin about auto-restarts
+
+def start_supervisor(bot=None):
+    global _supervisor_thread, _supervisor_wakeup, _supervisor_bot
+    with _supervisor_lock:
+        if bot is not None:
+            _supervisor_bot = bot
+        if _supervisor_thread is not None:
+            return
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        _supervisor_wakeup = (read_fd, write_fd)
+        _supervisor_thread = threading.Thread(target=_supervisor_loop, name='supervisor', daemon=True)
+        _supervisor_thread.start()
+    # Pick up children started before the supervisor existed
+    for service_id, process in list(processes.items()):
+        _supervisor_send('watch', service_id, process)
+    logging.info("Process supervisor started")
+
+def _supervisor_send(*command):
+    if _supervisor_wakeup is None:
+        return
+    _supervisor_commands.put(command)
+    try:
+        os.write(_supervisor_wakeup[1], b'\0')
+    except BlockingIOError:
+        pass  # Pipe already full, the supervisor is going to wake anyway
+
+def _open_pidfd(process):
+    if not hasattr(os, 'pidfd_open') or process.pid is None:
+        return None
+    try:
+        return os.pidfd_open(process.pid)
+    except ProcessLookupError:
+        return None  # Already gone; poll() will report it
+    except OSError:
+        return None  # Kernel without pidfd support, fall back to polling
+
+def _supervisor_loop():
+    selector = selectors.DefaultSelector()
+    selector.register(_supervisor_wakeup[0], selectors.EVENT_READ, None)
+    watched = {}  # service_id: (process, pidfd or None, started_at)
+    restarts = {}  # service_id: monotonic time the restart is due
+
+    def unwatch(service_id):
+        entry = watched.pop(service_id, None)
+        if entry and entry[1] is not None:
+            selector.unregister(entry[1])
+            os.close(entry[1])
+
     while True:
-        service = get_service(service_id)
-        if not service or service['status'] != 'running':
-            break  # Stop watchdog if service deleted or not running
-        if service_id not in processes or processes[service_id].poll() is not None:
-            logging.warning(f"Process died for {service_id}, restarting")
-            project_type = service['project_type']
-            path = service['path']
-            port = service['port']
-            if project_type == 'flask':
-                venv_path = os.path.join(path, 'venv')
-                cmd = [os.path.join(venv_path, 'bin', 'python'), os.path.join(path, 'app.py')]
-                env = os.environ.copy()
-                env['PORT'] = str(port)
+        now = time.monotonic()
+        timeout = None
+        if restarts:
+            timeout = max(0, min(restarts.values()) - now)
+        if any(entry[1] is None for entry in watched.values()):
+            timeout = min(timeout if timeout is not None else config.WATCHDOG_INTERVAL, config.WATCHDOG_INTERVAL)
+        exited = []
+        for key, _ in selector.select(timeout):
+            if key.data is None:
+                try:
+                    while os.read(_supervisor_wakeup[0], 4096):
+                        pass
+                except BlockingIOError:
+                    pass
             else:
-                cmd = ['python', '-m', 'http.server', str(port), '--directory', path]
-                env = None
-            start_process(service_id, cmd, env, project_type)
-            update_last_restart(service_id, datetime.now())
-            bot.send_message(config.ADMIN_ID, f"Auto-restarted service {service_id} for user {service['user_id']}")
-        time.sleep(config.WATCHDOG_INTERVAL)
-    if service_id in watchdogs:
-        del watchdogs[service_id]
+                exited.append(key.data)
+
+        while True:
+            try:
+                command = _supervisor_commands.get_nowait()
+            except queue.Empty:
+                break
+            if command[0] == 'watch':
+                _, service_id, process = command
+                unwatch(service_id)
+                restarts.pop(service_id, None)
+                pidfd = _open_pidfd(process)
+                if pidfd is not None:
+                    selector.register(pidfd, selectors.EVENT_READ, (service_id, process))
+                watched[service_id] = (process, pidfd, time.monotonic())
+            elif command[0] == 'unwatch':
+                unwatch(command[1])
+
+        for service_id, (process, pidfd, _) in watched.items():
+            if pidfd is None and process.poll() is not None:
+                exited.append((service_id, process))
+
+        for service_id, process in exited:
+            entry = watched.get(service_id)
+            if not entry or entry[0] is not process:
+                continue  # Replaced by a newer process
+            started_at = entry[2]
+            unwatch(service_id)
+            returncode = process.poll()
+            if processes.get(service_id) is not process:
+                continue  # Stopped on purpose
+            logging.warning(f"Process died for {service_id} (exit code {returncode})")
+            PROCESS_EXITS.inc()
+            if service_id in watchdogs:
+                # Back off crash loops to at most one restart per interval
+                restarts[service_id] = max(time.monotonic(), started_at + config.WATCHDOG_INTERVAL)
+
+        now = time.monotonic()
+        for service_id in [sid for sid, due in restarts.items() if due <= now]:
+            del restarts[service_id]
+            try:
+                _restart_service(service_id)
+            except Exception as e:
+                SUPERVISOR_RESTARTS.inc(result='failed')
+                logging.error(f"Supervisor failed to restart {service_id}: {str(e)}")
+
+def _restart_service(service_id):
+    service = get_service(service_id)
+    if not service or service['status'] != 'running' or service_id not in watchdogs:
+        watchdogs.pop(service_id, None)
+        return  # Desired state is no longer running
+    process = processes.get(service_id)
+    if process is not None and process.poll() is None:
+        return  # Already restarted by someone else
+    logging.warning(f"Restarting {service_id}")
+    launch_service(service_id, service['project_type'], service['path'], service['port'])
+    update_last_restart(service_id, datetime.now())
+    SUPERVISOR_RESTARTS.inc(result='restarted')
+    if _supervisor_bot is not None:
+        _supervisor_bot.send_message(config.ADMIN_ID, f"Auto-restarted service {service_id} for user {service['user_id']}")
+
+# Periodic health checks
+# Every HEALTH_CHECK_INTERVAL seconds each live service is probed (HEALTH_WORKERS at a
+# time) and the result is stored on its row. A watched service that fails
+# HEALTH_FAILURE_THRESHOLD checks in a row is killed so the supervisor restarts it.
+_health_failures = {}  # service_id: failed checks in a row
+_health_thread = None
+
+def start_health_monitor():
+    global _health_thread
+    if _health_thread is not None:
+        return
+    _health_thread = threading.Thread(target=_health_loop, name='health-monitor', daemon=True)
+    _health_thread.start()
+
+def _health_loop():
+    with ThreadPoolExecutor(max_workers=config.HEALTH_WORKERS, thread_name_prefix='health') as pool:
+        while True:
+            time.sleep(config.HEALTH_CHECK_INTERVAL)
+            try:
+                _health_sweep(pool)
+            except Exception as e:
+                logging.error(f"Health check sweep failed: {str(e)}")
+
+def _health_sweep(pool):
+    checks = []
+    for service in get_running_services():
+        service_id = service['service_id']
+        process = processes.get(service_id)
+        if process is None or process.poll() is not None or getattr(process, 'held', False):
+            continue  # Dead processes are the supervisor's job; probing a held port would wake it
+        check = load_check(service['path'], service['project_type'])
+        checks.append((service_id, process, pool.submit(check_health, service['port'], check)))
+
+    results = []
+    for service_id, process, future in checks:
+        ok, detail = future.result()
+        results.append((service_id, ok, detail))
+        if ok:
+            _health_failures.pop(service_id, None)
+            continue
+        failures = _health_failures[service_id] = _health_failures.get(service_id, 0) + 1
+        logging.warning(f"Health check failed for {service_id} ({failures} in a row): {detail}")
+        if failures >= config.HEALTH_FAILURE_THRESHOLD and service_id in watchdogs and processes.get(service_id) is process:
+            del _health_failures[service_id]
+            logging.warning(f"Restarting unhealthy service {service_id}")
+            _terminate(process)  # The supervisor sees the exit and restarts it
+    if results:
+        _record_health(results)
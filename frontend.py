@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import hmac
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.types import Update
+
+import config
+from metrics import BOT_UPDATES, BOT_UPDATES_PENDING
+
+# Update frontend
+# Replaces bot.polling(): an asyncio loop receives updates, either by long polling
+# getUpdates or through a webhook receiver, and hands each one to the (synchronous)
+# handlers on a pool of BOT_WORKERS threads. Updates from different users run
+# concurrently; updates from the same user run one after another, in the order
+# Telegram sent them, so per-user state (user_states, rate limits) is never raced.
+# Once MAX_PENDING_UPDATES are waiting, polling stops asking for more and the webhook
+# answers 429, so Telegram keeps the backlog instead of the bot dropping it.
+# The webhook receiver speaks plain HTTP; put it behind the TLS terminator that serves
+# WEBHOOK_URL.
+
+def _update_key(update):
+    for name in ('message', 'edited_message', 'callback_query'):
+        item = getattr(update, name, None)
+        if item is None:
+            continue
+        user = getattr(item, 'from_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(item, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return ('update', update.update_id)
+
+class UpdateDispatcher:
+    def __init__(self, bot):
+        self.bot = bot
+        self.pool = ThreadPoolExecutor(max_workers=config.BOT_WORKERS, thread_name_prefix='handler')
+        self._tails = {}  # key: task handling the newest update of that user/chat
+        self._pending = 0
+        self._room = asyncio.Event()  # Set while fewer than MAX_PENDING_UPDATES are pending
+        self._room.set()
+        BOT_UPDATES_PENDING.set_callback(lambda: self._pending)
+
+    def full(self):
+        return self._pending >= config.MAX_PENDING_UPDATES
+
+    async def wait_for_room(self):
+        while self.full():
+            self._room.clear()
+            await self._room.wait()
+
+    # Schedule an update behind earlier ones from the same user; must run on the loop
+    def submit(self, update):
+        key = _update_key(update)
+        self._pending += 1
+        task = asyncio.ensure_future(self._run(update, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+
+    def _forget(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, update, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])  # Order only; its outcome doesn't matter here
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.pool, self.bot.process_new_updates, [update])
+            BOT_UPDATES.inc(result='handled')
+        except Exception as e:
+            BOT_UPDATES.inc(result='failed')
+            logging.error(f"Update {update.update_id} failed: {str(e)}")
+        finally:
+            self._pending -= 1
+            if not self.full():
+                self._room.set()
+
+async def _poll(bot, dispatcher):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, bot.remove_webhook)
+    offset = None
+    logging.info("Receiving updates by long polling")
+    while True:
+        if dispatcher.full():
+            logging.warning(f"{config.MAX_PENDING_UPDATES} updates pending; pausing getUpdates")
+            await dispatcher.wait_for_room()
+        try:
+            updates = await loop.run_in_executor(None, functools.partial(
+                bot.get_updates, offset=offset, timeout=config.POLL_TIMEOUT,
+                long_polling_timeout=config.POLL_TIMEOUT))
+        except Exception as e:
+            logging.error(f"getUpdates failed: {str(e)}")
+            await asyncio.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatcher.submit(update)
+
+async def _send(writer, status, body=b''):
+    writer.write(f'HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+async def _webhook_client(dispatcher, secret, reader, writer):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        lines = head[:-4].decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(parts) != 3 or parts[0] != 'POST' or parts[1].split('?', 1)[0] != config.WEBHOOK_PATH:
+            await _send(writer, '404 Not Found')
+            return
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), secret):
+            await _send(writer, '403 Forbidden')
+            return
+        if dispatcher.full():
+            # Telegram redelivers it later; acknowledging now would lose it
+            BOT_UPDATES.inc(result='deferred')
+            await _send(writer, '429 Too Many Requests')
+            return
+        length = int(headers.get('content-length', '0'))
+        if length <= 0 or length > config.WEBHOOK_MAX_BODY:
+            await _send(writer, '413 Payload Too Large')
+            return
+        body = await asyncio.wait_for(reader.readexactly(length), 10)
+        update = Update.de_json(body.decode('utf-8'))
+        # Acknowledge first: Telegram retries (and delays later updates) until it gets a 200
+        await _send(writer, '200 OK')
+        dispatcher.submit(update)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning(f"Rejected webhook request: {str(e)}")
+        await _send(writer, '400 Bad Request')
+    finally:
+        writer.close()
+
+async def _serve_webhook(bot, dispatcher):
+    loop = asyncio.get_running_loop()
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = await asyncio.start_server(functools.partial(_webhook_client, dispatcher, secret),
+                                        config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await loop.run_in_executor(None, functools.partial(
+        bot.set_webhook, url=config.WEBHOOK_URL, secret_token=secret, max_connections=config.BOT_WORKERS,
+        drop_pending_updates=False))
+    logging.info(f"Receiving updates by webhook on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+    async with server:
+        await server.serve_forever()
+
+async def _main(bot):
+    dispatcher = UpdateDispatcher(bot)
+    if config.BOT_MODE == 'webhook' and config.WEBHOOK_URL:
+        await _serve_webhook(bot, dispatcher)
+        return
+    if config.BOT_MODE == 'webhook':
+        logging.error("BOT_MODE is 'webhook' but WEBHOOK_URL is empty; falling back to polling")
+    await _poll(bot, dispatcher)
+
+# Receive and dispatch updates until interrupted (blocks, like bot.polling)
+def run_frontend(bot):
+    asyncio.run(_main(bot))
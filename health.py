@@ -0,0 +1,86 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import time
+
+import config
+
+# Readiness and health probes
+# A service is healthy when its port answers a probe: a TCP connect by default, or an
+# HTTP GET that must return 2xx/3xx. Static sites are probed with GET /. A project can
+# choose its own probe by shipping HEALTH_CHECK_FILE, e.g.
+#   {"type": "http", "path": "/health", "timeout": 2, "retries": 3}
+
+# Probe settings for a service directory
+def load_check(path, project_type):
+    check = {'type': 'http' if project_type == 'static' else 'tcp', 'path': '/',
+             'timeout': config.HEALTH_PROBE_TIMEOUT, 'retries': config.HEALTH_RETRIES}
+    check_file = os.path.join(path, config.HEALTH_CHECK_FILE)
+    if not os.path.exists(check_file):
+        return check
+    try:
+        with open(check_file, 'r', encoding='utf-8') as f:
+            custom = json.load(f)
+        if custom.get('type', check['type']) not in ('tcp', 'http'):
+            raise ValueError(f"unknown probe type {custom['type']}")
+        check['type'] = custom.get('type', check['type'])
+        check['path'] = '/' + str(custom.get('path', '/')).lstrip('/')
+        check['timeout'] = min(float(custom.get('timeout', check['timeout'])), config.HEALTH_PROBE_TIMEOUT * 5)
+        check['retries'] = max(1, min(int(custom.get('retries', check['retries'])), 10))
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        logging.warning(f"Ignoring invalid {check_file}: {str(e)}")
+    return check
+
+# One probe attempt; returns (ok, detail)
+def probe(port, check):
+    started = time.monotonic()
+    try:
+        if check['type'] == 'http':
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=check['timeout'])
+            try:
+                conn.request('GET', check['path'], headers={'User-Agent': 'health-check', 'Connection': 'close'})
+                status = conn.getresponse().status
+            finally:
+                conn.close()
+            elapsed = (time.monotonic() - started) * 1000
+            if 200 <= status < 400:
+                return True, f"HTTP {status} in {elapsed:.0f} ms"
+            return False, f"HTTP {status} from {check['path']}"
+        with socket.create_connection(('127.0.0.1', port), timeout=check['timeout']):
+            pass
+        return True, f"port open in {(time.monotonic() - started) * 1000:.0f} ms"
+    except socket.timeout:
+        return False, f"no answer within {check['timeout']:g}s"
+    except ConnectionRefusedError:
+        return False, "connection refused (is the app listening on PORT?)"
+    except (OSError, http.client.HTTPException) as e:
+        return False, str(e) or e.__class__.__name__
+
+# Probe up to check['retries'] times; used for periodic checks
+def check_health(port, check):
+    ok, detail = False, 'not checked'
+    for attempt in range(check['retries']):
+        if attempt:
+            time.sleep(0.5)
+        ok, detail = probe(port, check)
+        if ok:
+            break
+    return ok, detail
+
+# Probe a freshly started process until it answers, exits or timeout passes
+def wait_until_healthy(process, port, check, timeout):
+    deadline = time.monotonic() + timeout
+    detail = 'not checked'
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False, f"process exited with code {process.poll()}"
+        ok, detail = probe(port, check)
+        if ok:
+            return True, detail
+        time.sleep(0.2)
+    return False, f"not ready after {timeout}s: {detail}"
+
+def describe_health(ok, detail):
+    return f"ready ({detail})" if ok else f"not ready: {detail}"
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import threading
+import time
+
+import config
+from database import add_or_get_user, get_running_services, update_last_requests
+from deployment import (is_held, is_process_running, launch_service, processes, replace_process, start_watchdog,
+                        wait_until_ready, watchdogs)
+from metrics import IDLE_COLD_START_SECONDS, IDLE_HELD, IDLE_WAKE_FAILURES
+from proxy import set_idle_hooks
+
+# Scale-to-zero
+# Services that have seen no traffic for IDLE_SUSPEND_AFTER seconds have their process
+# stopped and their port taken over by a HeldService: a listening socket on the shared
+# idle loop that costs no process. The first connection to a held port (or the first
+# proxied request) starts the backend again, waits for it to accept connections and
+# then pipes the waiting clients through. Traffic is seen through the proxy and by
+# looking for established connections in /proc/net/tcp before suspending. Without the
+# proxy only connections open at sweep time would be seen, so a service serving short
+# requests would look idle; suspending is therefore only enabled with PROXY_ENABLED.
+
+_last_seen = {}  # service_id: time.time() of last observed traffic
+_dirty = set()  # service_ids whose last_seen has not been written to the DB yet
+_wake_locks = {}  # service_id: threading.Lock
+_wake_locks_lock = threading.Lock()
+_loop = None
+_thread = None
+
+class HeldService:
+    pid = None  # No child process; the supervisor falls back to poll()
+    held = True  # Marker for is_held(); health checks skip it (a probe would wake the service)
+
+    def __init__(self, service, watchdog):
+        self.service_id = service['service_id']
+        self.service = service
+        self.port = service['port']
+        self.watchdog = watchdog  # Restore the premium watchdog on wake
+        self.returncode = None
+        self.args = ['held', str(self.port)]
+        self._server = None
+        self._waking = False
+        self._awake = asyncio.Event()
+        self._closed = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            self.returncode = -15
+            self.close_listener()
+            _loop.call_soon_threadsafe(self._awake.set)  # Waiting clients give up
+
+    kill = terminate
+
+    def wait(self, timeout=None):
+        self._closed.wait(timeout)
+        return self.returncode
+
+    # Stop listening so the backend can bind the port (safe from any thread)
+    def close_listener(self):
+        done = threading.Event()
+
+        def close():
+            if self._server is not None:
+                self._server.close()
+            self._closed.set()
+            done.set()
+
+        _loop.call_soon_threadsafe(close)
+        done.wait(5)
+
+def _ensure_loop():
+    global _loop, _thread
+    if _thread is not None:
+        return
+    _loop = asyncio.new_event_loop()
+    _thread = threading.Thread(target=_loop.run_forever, name='idle-holder', daemon=True)
+    _thread.start()
+
+def touch(service_id):
+    _last_seen[service_id] = time.time()
+    _dirty.add(service_id)
+
+def _wake_lock(service_id):
+    with _wake_locks_lock:
+        return _wake_locks.setdefault(service_id, threading.Lock())
+
+# Put a service on hold: its port is kept open by a HeldService instead of a process
+def hold_service(service):
+    _ensure_loop()
+    service_id = service['service_id']
+    holder = HeldService(service, watchdog=service_id in watchdogs)
+
+    async def listen():
+        holder._server = await asyncio.start_server(
+            lambda r, w: _held_client(holder, r, w), '0.0.0.0', holder.port)
+
+    old = processes.get(service_id)
+    if old is not None:
+        # Swap first so the supervisor treats the exit as intentional, then free the port
+        replace_process(service_id, holder)
+    else:
+        processes[service_id] = holder
+    asyncio.run_coroutine_threadsafe(listen(), _loop).result(timeout=10)
+    logging.info(f"Suspended idle service {service_id}, holding port {holder.port}")
+    return holder
+
+# Start a held service's backend; blocks until it accepts connections
+# Returns True if the service is running (or was not held)
+def wake(service_id):
+    with _wake_lock(service_id):
+        holder = processes.get(service_id)
+        if not isinstance(holder, HeldService):
+            return is_process_running(service_id)
+        started = time.monotonic()
+        service = holder.service
+        ready = False
+        try:
+            holder.close_listener()
+            process = launch_service(service_id, service['project_type'], service['path'], service['port'])
+            holder.returncode = 0
+            if holder.watchdog:
+                start_watchdog(service_id)
+            ready = wait_until_ready(process, service['port'], config.IDLE_WAKE_TIMEOUT)
+            elapsed = time.monotonic() - started
+            IDLE_COLD_START_SECONDS.observe(elapsed)
+            touch(service_id)
+            logging.info(f"Woke {service_id} in {elapsed * 1000:.0f} ms (ready={ready})")
+        except Exception as e:
+            # Leave an exited handle behind so the supervisor (and /stats) see the service as dead
+            logging.error(f"Failed to wake {service_id}: {str(e)}")
+            IDLE_WAKE_FAILURES.inc()
+            if holder.returncode is None:
+                holder.returncode = 1
+        finally:
+            holder._waking = False
+            _loop.call_soon_threadsafe(holder._awake.set)  # Waiting clients connect or give up
+        return ready
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            chunk = await reader.read(64 * 1024)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+# A client hit a held port: wake the backend once and hand the connection over
+async def _held_client(holder, reader, writer):
+    if not holder._waking:
+        holder._waking = True
+        asyncio.get_running_loop().run_in_executor(None, wake, holder.service_id)
+    try:
+        await asyncio.wait_for(holder._awake.wait(), config.IDLE_CLIENT_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        writer.close()
+        return
+    try:
+        up_reader, up_writer = await asyncio.open_connection('127.0.0.1', holder.port)
+    except OSError:
+        writer.close()
+        return
+    await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+
+# Proxy hook: record traffic and report whether the service must be woken first
+def _on_proxy_request(service_id):
+    touch(service_id)
+    return is_held(service_id)
+
+# Local ports that currently have established TCP connections
+def _busy_ports():
+    ports = set()
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == '01':  # ESTABLISHED
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except (OSError, StopIteration, IndexError, ValueError):
+            pass
+    return ports
+
+def _suspend_enabled():
+    return config.IDLE_SUSPEND_ENABLED and config.PROXY_ENABLED
+
+def _eligible(service):
+    if service['project_type'] == 'static' and config.SHARED_STATIC_SERVER:
+        return False  # Costs nothing to keep serving
+    if config.IDLE_SUSPEND_FREE_ONLY and add_or_get_user(service['user_id'])['is_premium']:
+        return False
+    return True
+
+def _last_request_time(service):
+    last = service.get('last_request')
+    if not last:
+        return None
+    try:
+        return time.mktime(time.strptime(str(last)[:19], '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return None
+
+# Should a service restored at startup go straight on hold?
+def should_start_held(service):
+    if not _suspend_enabled() or not _eligible(service):
+        return False
+    last = _last_request_time(service)
+    return last is not None and time.time() - last > config.IDLE_SUSPEND_AFTER
+
+def _flush_last_seen():
+    if not _dirty:
+        return
+    rows = []
+    for service_id in list(_dirty):
+        _dirty.discard(service_id)
+        rows.append((time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(_last_seen[service_id])), service_id))
+    update_last_requests(rows)
+
+def _sweep():
+    now = time.time()
+    busy = _busy_ports()
+    for service in get_running_services():
+        service_id = service['service_id']
+        if is_held(service_id) or not is_process_running(service_id):
+            continue
+        if service['port'] in busy:
+            touch(service_id)
+            continue
+        if service_id not in _last_seen:
+            # First sight since startup: fall back to the stored time, or start the clock now
+            _last_seen[service_id] = _last_request_time(service) or now
+        if now - _last_seen[service_id] > config.IDLE_SUSPEND_AFTER and _eligible(service):
+            with _wake_lock(service_id):
+                if is_process_running(service_id) and not is_held(service_id):
+                    hold_service(service)
+    _flush_last_seen()
+
+def _sweeper():
+    while True:
+        time.sleep(config.IDLE_CHECK_INTERVAL)
+        try:
+            _sweep()
+        except Exception as e:
+            logging.error(f"Idle sweep failed: {str(e)}")
+
+def start_idle_manager():
+    if not config.IDLE_SUSPEND_ENABLED:
+        return
+    if not config.PROXY_ENABLED:
+        logging.warning("Idle suspend needs PROXY_ENABLED to see traffic; services will keep running")
+        return
+    _ensure_loop()
+    set_idle_hooks(_on_proxy_request, wake)
+    threading.Thread(target=_sweeper, name='idle-sweeper', daemon=True).start()
+    logging.info("Idle suspend manager started")
+
+IDLE_HELD.set_callback(lambda: sum(1 for process in list(processes.values()) if isinstance(process, HeldService)))
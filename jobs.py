@@ -0,0 +1,218 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+import config
+from database import add_job, add_or_get_user, get_jobs_by_status, update_job_phase, update_job_status
+from deployment import deploy_project, update_project
+from metrics import DEPLOY_RESULTS, JOBS_QUEUED, JOBS_RUNNING
+from tracing import activate, add_span, start_trace
+from uploads import submit_upload
+
+# Deployment scheduler
+# Uploads become rows in deploy_jobs and wait in memory for one of DEPLOY_WORKERS threads.
+# Premium jobs are picked before free ones, each user has at most
+# MAX_CONCURRENT_JOBS_PER_USER jobs running, and the chat is told its queue position
+# and each phase as the job moves through deploy_project/update_project.
+# A job can be queued while its upload is still downloading; it is only picked once the
+# download has finished, so /cancel and queue positions see it from the start.
+
+PRIORITY_PREMIUM = 0
+PRIORITY_FREE = 1
+
+_cond = threading.Condition()
+_queue = []  # Waiting jobs, ordered by (priority, seq)
+_running = {}  # job_id: job
+_running_per_user = {}  # user_id: count
+_seq = itertools.count()
+_workers = []
+_bot = None
+
+JOBS_QUEUED.set_callback(lambda: len(_queue))
+JOBS_RUNNING.set_callback(lambda: len(_running))
+
+class QueueFullError(RuntimeError):
+    pass
+
+def _sort_key(job):
+    return (job['priority'], job['seq'])
+
+def start_scheduler(bot):
+    global _bot
+    if _workers:
+        return
+    _bot = bot
+    # Jobs interrupted by a restart can't be resumed safely; queued ones are picked up again
+    for job in get_jobs_by_status('running'):
+        update_job_status(job['job_id'], 'failed')
+        _notify(job, "Your deployment was interrupted by a server restart. Please upload again.")
+        _remove_zip(job)
+    with _cond:
+        known = {job['job_id'] for job in _queue}
+    for job in get_jobs_by_status('queued'):
+        if job['job_id'] in known:
+            continue
+        if os.path.exists(job['zip_path']):
+            _enqueue(job)
+        else:
+            update_job_status(job['job_id'], 'failed')
+    for i in range(config.DEPLOY_WORKERS):
+        thread = threading.Thread(target=_worker, name=f'deploy-worker-{i}', daemon=True)
+        thread.start()
+        _workers.append(thread)
+    logging.info(f"Deployment scheduler started with {config.DEPLOY_WORKERS} workers")
+
+def _enqueue(job):
+    with _cond:
+        _append(job)
+
+# Caller holds _cond
+def _append(job):
+    job['seq'] = next(_seq)
+    job['queued_at'] = time.perf_counter()
+    _queue.append(job)
+    _queue.sort(key=_sort_key)
+    _cond.notify()
+
+# Queue a deploy ('deploy') or update ('update') of an uploaded ZIP
+# trace carries spans recorded before the job was queued (e.g. the download)
+# download, if given, is called on the upload pool to write zip_path; the job waits for it
+# Returns (job_id, queue position); raises QueueFullError when the queue is at capacity
+def submit_job(kind, user_id, chat_id, zip_path, service_id=None, trace=None, download=None):
+    with _cond:
+        if len(_queue) >= config.MAX_QUEUED_JOBS:
+            raise QueueFullError("Deployment queue is full")
+    user = add_or_get_user(user_id)
+    priority = PRIORITY_PREMIUM if user['is_premium'] else PRIORITY_FREE
+    job_id = add_job(user_id, chat_id, kind, service_id, zip_path, priority)
+    job = {'job_id': job_id, 'user_id': user_id, 'chat_id': chat_id, 'kind': kind,
+           'service_id': service_id, 'zip_path': zip_path, 'priority': priority, 'trace': trace}
+    if download is not None:
+        update_job_phase(job_id, 'downloading')
+    # Check capacity again, append and read the position in one step; a worker may take it right after
+    with _cond:
+        if len(_queue) >= config.MAX_QUEUED_JOBS:
+            full = True
+        else:
+            full = False
+            if download is not None:
+                job['download'] = submit_upload(download)
+                job['download'].add_done_callback(lambda future: _download_done(job))
+            _append(job)
+            position = _queue.index(job) + 1
+    if full:
+        update_job_status(job_id, 'cancelled')
+        raise QueueFullError("Deployment queue is full")
+    return job_id, position
+
+def _download_done(job):
+    with _cond:
+        # Wake workers skipping it; a job cancelled meanwhile leaves its file behind
+        _cond.notify_all()
+        cancelled = job.get('cancelled')
+    if cancelled:
+        _remove_zip(job)
+
+# Cancel a user's waiting jobs (running jobs finish); returns how many were cancelled
+def cancel_jobs(user_id):
+    with _cond:
+        cancelled = [job for job in _queue if job['user_id'] == user_id]
+        _queue[:] = [job for job in _queue if job['user_id'] != user_id]
+        for job in cancelled:
+            job['cancelled'] = True
+            if job.get('download') is not None:
+                job['download'].cancel()  # Only stops a download that hasn't started
+    for job in cancelled:
+        update_job_status(job['job_id'], 'cancelled')
+        _remove_zip(job)
+    return len(cancelled)
+
+def get_running_jobs(user_id=None):
+    with _cond:
+        return [dict(job) for job in _running.values() if user_id is None or job['user_id'] == user_id]
+
+# Highest-priority waiting job whose user is below the concurrency limit and whose upload is on disk
+def _next_job():
+    for i, job in enumerate(_queue):
+        if job.get('download') is not None and not job['download'].done():
+            continue
+        if _running_per_user.get(job['user_id'], 0) < config.MAX_CONCURRENT_JOBS_PER_USER:
+            return _queue.pop(i)
+    return None
+
+def _notify(job, text):
+    if _bot is None:
+        return
+    try:
+        _bot.send_message(job['chat_id'], text)
+    except Exception as e:
+        logging.error(f"Failed to notify chat {job['chat_id']} about job {job['job_id']}: {str(e)}")
+
+def _remove_zip(job):
+    try:
+        os.remove(job['zip_path'])
+    except OSError:
+        pass
+
+def _worker():
+    while True:
+        with _cond:
+            job = _next_job()
+            while job is None:
+                _cond.wait()
+                job = _next_job()
+            _running[job['job_id']] = job
+            _running_per_user[job['user_id']] = _running_per_user.get(job['user_id'], 0) + 1
+        _run_job(job)
+        with _cond:
+            del _running[job['job_id']]
+            _running_per_user[job['user_id']] -= 1
+            if not _running_per_user[job['user_id']]:
+                del _running_per_user[job['user_id']]
+            # A job of this user may have been skipped while they were at the limit
+            _cond.notify_all()
+
+def _run_job(job):
+    job_id = job['job_id']
+    trace = job.get('trace') or start_trace(job['kind'], job['user_id'])
+    trace.job_id = job_id
+    trace.service_id = job['service_id']
+    add_span(trace, 'queue', time.perf_counter() - job['queued_at'])
+    with activate(trace):
+        _execute_job(job, trace)
+
+def _execute_job(job, trace):
+    job_id = job['job_id']
+    download = job.get('download')
+    if download is not None and download.exception() is not None:
+        trace.result = 'failed'
+        update_job_status(job_id, 'failed')
+        DEPLOY_RESULTS.inc(kind=job['kind'], result='failed')
+        _notify(job, f"Failed to download file: {str(download.exception())}")
+        return
+    update_job_status(job_id, 'running')
+    _notify(job, f"Job #{job_id} started.")
+
+    def progress(phase):
+        job['phase'] = phase
+        update_job_phase(job_id, phase)
+        _notify(job, f"Job #{job_id}: {phase}...")
+
+    try:
+        if job['kind'] == 'deploy':
+            ok = deploy_project(job['user_id'], job['zip_path'], _bot, job['chat_id'], progress=progress)
+        else:
+            ok = update_project(job['user_id'], job['service_id'], job['zip_path'], _bot, job['chat_id'],
+                                progress=progress)
+        trace.result = 'done' if ok else 'failed'
+        update_job_status(job_id, trace.result)
+        DEPLOY_RESULTS.inc(kind=job['kind'], result=trace.result)
+    except Exception as e:
+        logging.error(f"Job {job_id} ({job['kind']}) failed: {str(e)}")
+        trace.result = 'error'
+        update_job_status(job_id, 'failed')
+        DEPLOY_RESULTS.inc(kind=job['kind'], result='error')
+        _notify(job, f"Job #{job_id} failed. Please try again.")
+        _remove_zip(job)
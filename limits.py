@@ -0,0 +1,179 @@
+import logging
+import os
+import resource
+import threading
+import time
+
+import config
+from database import add_or_get_user, get_service
+
+# Resource governance and usage sampling
+# Every spawned service process gets the limits of its owner's tier (RESOURCE_LIMITS).
+# With cgroup v2 the process is moved into CGROUP_ROOT/<service_id>-<pid>, which caps
+# memory, CPU bandwidth and the number of tasks for it and everything it forks. Without
+# cgroups (or without permission to use them) memory falls back to RLIMIT_AS. The open
+# file limit is always set with prlimit. Limits are applied right after the spawn, so a
+# child gets a few microseconds unconstrained before the moves land.
+# A sampler reads /proc/<pid> for every process in one pass and keeps the latest usage.
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_cgroups_ok = None  # None until probed
+_cgroups_lock = threading.Lock()
+_usage = {}  # service key: latest sample
+_cpu_seen = {}  # pid: (cpu ticks, monotonic time) from the previous sample
+_sampler = None
+
+def tier_for(service_id):
+    service = get_service(service_id)
+    if service and add_or_get_user(service['user_id'])['is_premium']:
+        return 'premium'
+    return 'free'
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+# Create CGROUP_ROOT and enable the controllers we need; False if cgroup v2 isn't usable
+def _cgroups_available():
+    global _cgroups_ok
+    with _cgroups_lock:
+        if _cgroups_ok is None:
+            try:
+                parent = os.path.dirname(config.CGROUP_ROOT)
+                with open(os.path.join(parent, 'cgroup.controllers')) as f:
+                    available = f.read().split()
+                wanted = [name for name in ('cpu', 'memory', 'pids') if name in available]
+                os.makedirs(config.CGROUP_ROOT, exist_ok=True)
+                _write(os.path.join(parent, 'cgroup.subtree_control'), ' '.join('+' + name for name in wanted))
+                _write(os.path.join(config.CGROUP_ROOT, 'cgroup.subtree_control'),
+                       ' '.join('+' + name for name in wanted))
+                _cgroups_ok = True
+                logging.info(f"cgroup v2 limits enabled under {config.CGROUP_ROOT} ({', '.join(wanted)})")
+            except OSError as e:
+                _cgroups_ok = False
+                logging.warning(f"cgroup v2 not usable, falling back to rlimits: {str(e)}")
+        return _cgroups_ok
+
+def _join_cgroup(service_id, pid, limits):
+    path = os.path.join(config.CGROUP_ROOT, f'{service_id}-{pid}')
+    os.makedirs(path, exist_ok=True)
+    settings = {
+        'memory.max': str(limits['memory_mb'] * 1024 * 1024),
+        'memory.swap.max': '0',
+        'cpu.max': f"{limits['cpu_percent'] * 1000} 100000",
+        'pids.max': str(limits['pids']),
+    }
+    for name, value in settings.items():
+        try:
+            _write(os.path.join(path, name), value)
+        except OSError:
+            pass  # Controller not enabled on this host
+    _write(os.path.join(path, 'cgroup.procs'), str(pid))
+
+# Apply the tier limits to a freshly spawned process
+def apply_limits(service_id, pid):
+    limits = config.RESOURCE_LIMITS[tier_for(service_id)]
+    try:
+        resource.prlimit(pid, resource.RLIMIT_NOFILE, (limits['open_files'], limits['open_files']))
+        resource.prlimit(pid, resource.RLIMIT_CORE, (0, 0))
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not set rlimits for {service_id} (pid {pid}): {str(e)}")
+    if _cgroups_available():
+        try:
+            _join_cgroup(service_id, pid, limits)
+            return
+        except OSError as e:
+            logging.warning(f"Could not place {service_id} (pid {pid}) in a cgroup: {str(e)}")
+    try:
+        # Address space is a rough stand-in for memory; leave headroom for mapped libraries
+        limit = limits['memory_mb'] * 2 * 1024 * 1024
+        resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not set memory limit for {service_id} (pid {pid}): {str(e)}")
+
+# Remove cgroups whose processes have all exited
+def _prune_cgroups():
+    try:
+        names = os.listdir(config.CGROUP_ROOT)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(config.CGROUP_ROOT, name)
+        try:
+            with open(os.path.join(path, 'cgroup.events')) as f:
+                if 'populated 0' in f.read():
+                    os.rmdir(path)
+        except OSError:
+            pass
+
+def _read_proc(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        # The command name may contain spaces; fields resume after the closing parenthesis
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu_ticks = int(fields[11]) + int(fields[12])  # utime + stime
+    rss = int(fields[21]) * _PAGE_SIZE
+    try:
+        open_files = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        open_files = None
+    return cpu_ticks, rss, open_files
+
+# Sample every process in one pass; processes is the deployment.processes mapping
+def sample_usage(processes):
+    now = time.monotonic()
+    usage = {}
+    seen = {}
+    for key, process in list(processes.items()):
+        pid = process.pid
+        if pid is None or process.poll() is not None:
+            continue  # In-process handles (static sites, held ports) use no process of their own
+        try:
+            cpu_ticks, rss, open_files = _read_proc(pid)
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu_percent = None
+        previous = _cpu_seen.get(pid)
+        if previous and now > previous[1]:
+            cpu_percent = (cpu_ticks - previous[0]) / _CLOCK_TICKS / (now - previous[1]) * 100
+        seen[pid] = (cpu_ticks, now)
+        usage[key] = {'pid': pid, 'cpu_percent': cpu_percent, 'cpu_seconds': cpu_ticks / _CLOCK_TICKS,
+                      'rss_bytes': rss, 'open_files': open_files, 'sampled_at': time.time()}
+    _cpu_seen.clear()
+    _cpu_seen.update(seen)
+    _usage.clear()
+    _usage.update(usage)
+    return usage
+
+def get_usage(service_id):
+    return _usage.get(service_id)
+
+# Services using the most CPU (then memory) in the latest sample
+def top_usage(n=10):
+    ranked = sorted(_usage.items(), key=lambda item: (item[1]['cpu_percent'] or 0, item[1]['rss_bytes']),
+                    reverse=True)
+    return ranked[:n]
+
+def format_usage(service_id, usage):
+    cpu = f"{usage['cpu_percent']:.1f}%" if usage['cpu_percent'] is not None else 'n/a'
+    files = usage['open_files'] if usage['open_files'] is not None else 'n/a'
+    return (f"{service_id}: CPU {cpu} ({usage['cpu_seconds']:.0f}s total), "
+            f"RSS {usage['rss_bytes'] / 1024 / 1024:.1f} MB, open files {files}")
+
+def _sampler_loop(processes):
+    while True:
+        try:
+            sample_usage(processes)
+            if _cgroups_ok:
+                _prune_cgroups()
+        except Exception as e:
+            logging.error(f"Resource sampling failed: {str(e)}")
+        time.sleep(config.RESOURCE_SAMPLE_INTERVAL)
+
+def start_sampler(processes):
+    global _sampler
+    if _sampler is not None:
+        return
+    _sampler = threading.Thread(target=_sampler_loop, args=(processes,), name='resource-sampler', daemon=True)
+    _sampler.start()
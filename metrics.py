@@ -0,0 +1,275 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# Instrumentation
+# Counters, gauges and latency histograms kept in memory and served in the Prometheus
+# text format on METRICS_HOST:METRICS_PORT (/metrics). Every metric the bot exports is
+# declared at the bottom of this file; modules import the ones they update. Gauges over
+# state owned elsewhere (e.g. the number of processes) are read through callbacks at
+# scrape time so nothing has to keep them in sync.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_server = None
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, key, (), value) for key, value in items]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self._callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(self.labelnames, labels)] = value
+
+    # callback() returns a number, or {label tuple: number} for labelled gauges
+    def set_callback(self, callback):
+        self._callback = callback
+
+    def samples(self):
+        if self._callback is not None:
+            try:
+                result = self._callback()
+            except Exception as e:
+                logging.error(f"Metric callback for {self.name} failed: {str(e)}")
+                return []
+            items = result.items() if isinstance(result, dict) else [((), result)]
+            return [(self.name, key, (), value) for key, value in items]
+        return super().samples()
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label key: [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, seconds, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += seconds
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    # {label key: (count, sum)}
+    def totals(self):
+        with self._lock:
+            return {key: (sum(values[:-1]), values[-1]) for key, values in self._values.items()}
+
+    # Approximate quantile from the bucket bounds
+    def quantile(self, q, key=()):
+        with self._lock:
+            values = list(self._values.get(key, ()))
+        if not values:
+            return None
+        counts = values[:-1]
+        target = q * sum(counts)
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            if running >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(values)) for key, values in self._values.items()]
+        samples = []
+        for key, values in items:
+            running = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                running += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                samples.append((self.name + '_bucket', key, (('le', le),), running))
+            samples.append((self.name + '_count', key, (), running))
+            samples.append((self.name + '_sum', key, (), values[-1]))
+        return samples
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, key, extra, value in metric.samples():
+            lines.append(f'{name}{_format_labels(metric.labelnames, key, extra)} {value:g}')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood system.log
+
+def start_metrics_server():
+    global _server
+    if _server is not None or not config.METRICS_ENABLED:
+        return
+    try:
+        _server = ThreadingHTTPServer((config.METRICS_HOST, config.METRICS_PORT), _MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint could not bind {config.METRICS_HOST}:{config.METRICS_PORT}: {str(e)}")
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Metrics endpoint listening on {config.METRICS_HOST}:{config.METRICS_PORT}")
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return 'n/a'
+    if seconds == float('inf'):
+        return f'>{DEFAULT_BUCKETS[-1]}s'
+    return f'{seconds * 1000:.0f}ms' if seconds < 1 else f'{seconds:g}s'
+
+def _gauge_value(gauge):
+    samples = gauge.samples()
+    return sum(sample[3] for sample in samples)
+
+# Short human-readable digest for the admin /metrics command
+def summary():
+    lines = [f"Processes: {_gauge_value(PROCESSES):g}, watchdogs: {_gauge_value(WATCHDOGS):g}, "
+             f"restarts: {SUPERVISOR_RESTARTS.total():g}, process exits: {PROCESS_EXITS.total():g}",
+             f"Jobs queued: {_gauge_value(JOBS_QUEUED):g}, running: {_gauge_value(JOBS_RUNNING):g}",
+             f"Free ports: {_gauge_value(PORTS_FREE):g}"]
+    handlers = HANDLER_SECONDS.totals()
+    if handlers:
+        lines.append("Handlers (count, avg, p95):")
+        for key, (count, total) in sorted(handlers.items(), key=lambda item: -item[1][0])[:10]:
+            p95 = HANDLER_SECONDS.quantile(0.95, key)
+            lines.append(f"  {key[0]}: {count}, {_format_seconds(total / count)}, {_format_seconds(p95)}")
+    phases = DEPLOY_PHASE_SECONDS.totals()
+    if phases:
+        lines.append("Deploy phases (count, avg):")
+        for key, (count, total) in sorted(phases.items()):
+            lines.append(f"  {key[0]}: {count}, {_format_seconds(total / count)}")
+    db = DB_QUERY_SECONDS.totals()
+    if db:
+        count = sum(c for c, _ in db.values())
+        total = sum(t for _, t in db.values())
+        lines.append(f"DB statements: {count}, avg {_format_seconds(total / count)}")
+    wakes = IDLE_COLD_START_SECONDS.totals().get(())
+    if _gauge_value(IDLE_HELD) or wakes or IDLE_WAKE_FAILURES.total():
+        count, total = wakes or (0, 0.0)
+        line = f"Idle held: {_gauge_value(IDLE_HELD):g}, cold starts: {count}"
+        if count:
+            line += (f", avg {_format_seconds(total / count)}, "
+                     f"p95 {_format_seconds(IDLE_COLD_START_SECONDS.quantile(0.95))}")
+        failed = IDLE_WAKE_FAILURES.total()
+        if failed:
+            line += f", failed: {failed:g}"
+        lines.append(line)
+    lookups = VENV_CACHE_LOOKUPS.total()
+    if lookups:
+        lines.append(f"Venv cache: {VENV_CACHE_LOOKUPS.value(result='hit'):g} hits / {lookups:g} lookups, "
+                     f"{_gauge_value(VENV_CACHE_ENTRIES):g} entries, {_gauge_value(VENV_CACHE_BYTES) / 2**20:.0f} MB")
+    dropped = ACTIVITY_LOG_DROPPED.total()
+    if dropped or _gauge_value(ACTIVITY_LOG_QUEUED):
+        lines.append(f"Activity log: {ACTIVITY_LOG_WRITTEN.total():g} written, {dropped:g} dropped, "
+                     f"{_gauge_value(ACTIVITY_LOG_QUEUED):g} queued")
+    errors = HANDLER_ERRORS.total()
+    if errors:
+        lines.append(f"Handler errors: {errors:g}")
+    return '\n'.join(lines)
+
+# Metrics exported by the bot
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in command handlers', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Command handlers that raised', ['handler'])
+DEPLOY_PHASE_SECONDS = Histogram('deploy_phase_seconds', 'Time spent in each deploy/update phase', ['phase'])
+DEPLOY_RESULTS = Counter('deploy_results_total', 'Finished deploy/update jobs', ['kind', 'result'])
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'SQLite statement latency', ['statement'],
+                             buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+JOBS_QUEUED = Gauge('deploy_jobs_queued', 'Deploy/update jobs waiting for a worker')
+JOBS_RUNNING = Gauge('deploy_jobs_running', 'Deploy/update jobs being processed')
+BOT_UPDATES = Counter('bot_updates_total', 'Telegram updates by outcome', ['result'])
+RATE_LIMITED = Counter('bot_rate_limited_total', 'Commands refused by the rate limiter', ['budget', 'tier'])
+RATE_LIMIT_BUCKETS = Gauge('bot_rate_limit_buckets', 'Rate limiter buckets held in memory')
+BOT_UPDATES_PENDING = Gauge('bot_updates_pending', 'Updates received but not yet handled')
+PROCESSES = Gauge('deploy_processes', 'Entries in the processes table')
+WATCHDOGS = Gauge('deploy_watchdogs', 'Services the supervisor auto-restarts')
+PROCESS_EXITS = Counter('supervisor_process_exits_total', 'Unexpected service process exits')
+SUPERVISOR_RESTARTS = Counter('supervisor_restarts_total', 'Services restarted by the supervisor', ['result'])
+IDLE_HELD = Gauge('idle_held_services', 'Services suspended behind a held port')
+IDLE_COLD_START_SECONDS = Histogram('idle_cold_start_seconds', 'Time from the first request to a held service until it is ready')
+IDLE_WAKE_FAILURES = Counter('idle_wake_failures_total', 'Held services that could not be started again')
+VENV_CACHE_LOOKUPS = Counter('venv_cache_lookups_total', 'Deploys that looked up a cached venv', ['result'])
+VENV_CACHE_BUILD_FAILURES = Counter('venv_cache_build_failures_total', 'Cache entries that failed to build')
+VENV_CACHE_EVICTIONS = Counter('venv_cache_evictions_total', 'Cache entries evicted to stay under VENV_CACHE_MAX_BYTES')
+VENV_CACHE_ENTRIES = Gauge('venv_cache_entries', 'Prebuilt venvs in the cache')
+VENV_CACHE_BYTES = Gauge('venv_cache_bytes', 'Disk used by prebuilt venvs')
+ACTIVITY_LOG_WRITTEN = Counter('activity_log_written_total', 'Activity log rows written to the database')
+ACTIVITY_LOG_DROPPED = Counter('activity_log_dropped_total', 'Activity log rows lost to a full queue or a failed write')
+ACTIVITY_LOG_QUEUED = Gauge('activity_log_queued', 'Activity log rows waiting for the writer')
+STATIC_META_CACHE_ENTRIES = Gauge('static_meta_cache_entries', 'File stat results cached by the shared static server')
+PORTS_FREE = Gauge('deploy_ports_free', 'Unassigned ports left in PORT_RANGE')
+PROXY_ROUTES = Gauge('proxy_routes', 'Services in the proxy route table')
+PROXY_POOLED_CONNECTIONS = Gauge('proxy_pooled_connections', 'Idle keep-alive connections to backends')
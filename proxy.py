@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import threading
+import time
+
+import config
+from database import get_all_service_ports
+from metrics import PROXY_POOLED_CONNECTIONS, PROXY_ROUTES
+
+# Reverse proxy
+# One asyncio server on PROXY_PORT forwards HTTP/1.1 traffic to service backends, so only
+# one port has to be open to the world. Requests are routed by path prefix (/s/<service_id>/...)
+# or, when PROXY_DOMAIN is set, by host name (<service_id>.<PROXY_DOMAIN>). The route table
+# maps service_id to backend port and is updated in place by deploy/switch/delete.
+# Bodies are streamed in both directions and upstream connections are kept alive and reused.
+
+_routes = {}  # service_id: backend port
+_pool = {}  # port: [(reader, writer, idle_since)], only touched from the proxy loop
+_loop = None
+_thread = None
+_activity_hook = None  # callable(service_id) -> True if the service must be woken first
+_wake_hook = None  # Blocking callable(service_id), run in a worker thread
+
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate', 'proxy-authorization',
+              'te', 'trailer', 'transfer-encoding', 'upgrade'}
+
+class _BadRequest(Exception):
+    pass
+
+# Route table
+def load_routes():
+    _routes.clear()
+    _routes.update(get_all_service_ports())
+
+def set_route(service_id, port):
+    _routes[service_id] = port
+
+def remove_route(service_id):
+    _routes.pop(service_id, None)
+
+# Let the idle manager see traffic and wake suspended services before they are proxied to
+def set_idle_hooks(activity_hook, wake_hook):
+    global _activity_hook, _wake_hook
+    _activity_hook = activity_hook
+    _wake_hook = wake_hook
+
+# Public URL of a service
+def service_link(service_id, port):
+    if not config.PROXY_ENABLED:
+        return f"http://{config.SERVER_IP}:{port}"
+    if config.PROXY_DOMAIN:
+        return f"http://{service_id}.{config.PROXY_DOMAIN}"
+    return f"http://{config.SERVER_IP}:{config.PROXY_PORT}/s/{service_id}/"
+
+def start_proxy():
+    global _thread
+    if _thread is not None or not config.PROXY_ENABLED:
+        return
+    load_routes()
+    ready = threading.Event()
+    _thread = threading.Thread(target=_run_loop, args=(ready,), name='proxy', daemon=True)
+    _thread.start()
+    ready.wait(5)
+
+def _run_loop(ready):
+    global _loop
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    try:
+        server = _loop.run_until_complete(asyncio.start_server(
+            _handle_client, config.PROXY_HOST, config.PROXY_PORT, limit=config.PROXY_MAX_HEADER_BYTES))
+    except OSError as e:
+        logging.error(f"Proxy failed to listen on port {config.PROXY_PORT}: {str(e)}")
+        ready.set()
+        return
+    logging.info(f"Proxy listening on {config.PROXY_HOST}:{config.PROXY_PORT}")
+    ready.set()
+    try:
+        _loop.run_until_complete(server.serve_forever())
+    except Exception as e:
+        logging.error(f"Proxy stopped: {str(e)}")
+
+# HTTP message helpers
+async def _read_head(reader):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None  # Clean close between requests
+        raise _BadRequest("Truncated request")
+    except asyncio.LimitOverrunError:
+        raise _BadRequest("Headers too large")
+    lines = head[:-4].decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise _BadRequest("Malformed header")
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+def _header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def _header_values(headers, name):
+    return [value for key, value in headers if key.lower() == name]
+
+# Refuse request framing that could be read differently here and upstream (RFC 9112 6.3)
+def _check_framing(headers):
+    lengths = _header_values(headers, 'content-length')
+    encodings = [token.strip().lower() for value in _header_values(headers, 'transfer-encoding')
+                 for token in value.split(',') if token.strip()]
+    if encodings:
+        if encodings != ['chunked']:
+            raise _BadRequest("Unsupported Transfer-Encoding")
+        if lengths:
+            raise _BadRequest("Both Content-Length and Transfer-Encoding")
+    elif lengths and (len(set(lengths)) > 1 or not lengths[0].isdigit()):
+        raise _BadRequest("Invalid Content-Length")
+
+def _connection_tokens(headers):
+    value = _header(headers, 'connection') or ''
+    return {token.strip().lower() for token in value.split(',') if token.strip()}
+
+def _build_head(first_line, headers):
+    lines = [first_line] + [f'{name}: {value}' for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def _copy_exact(reader, writer, length):
+    while length > 0:
+        chunk = await reader.read(min(length, config.PROXY_BUFFER_SIZE))
+        if not chunk:
+            raise ConnectionError("Peer closed mid-body")
+        writer.write(chunk)
+        await writer.drain()
+        length -= len(chunk)
+
+async def _copy_chunked(reader, writer):
+    while True:
+        size_line = await reader.readline()
+        if not size_line:
+            raise ConnectionError("Peer closed mid-body")
+        writer.write(size_line)
+        size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+        if size == 0:
+            # Trailers, terminated by an empty line
+            while True:
+                line = await reader.readline()
+                writer.write(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            await writer.drain()
+            return
+        await _copy_exact(reader, writer, size + 2)
+
+async def _copy_until_eof(reader, writer):
+    while True:
+        chunk = await reader.read(config.PROXY_BUFFER_SIZE)
+        if not chunk:
+            return
+        writer.write(chunk)
+        await writer.drain()
+
+# Stream a message body according to its framing; returns False if it was delimited by EOF
+async def _relay_body(reader, writer, headers, until_eof):
+    if 'chunked' in (_header(headers, 'transfer-encoding') or '').lower():
+        await _copy_chunked(reader, writer)
+    elif _header(headers, 'content-length') is not None:
+        await _copy_exact(reader, writer, int(_header(headers, 'content-length')))
+    elif until_eof:
+        await _copy_until_eof(reader, writer)
+        return False
+    return True
+
+async def _pipe(reader, writer):
+    try:
+        await _copy_until_eof(reader, writer)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+# Upstream connection pool
+async def _acquire(port):
+    idle = _pool.get(port, [])
+    now = time.monotonic()
+    while idle:
+        reader, writer, idle_since = idle.pop()
+        if reader.at_eof() or writer.is_closing() or now - idle_since > config.PROXY_POOL_IDLE_TIMEOUT:
+            writer.close()
+            continue
+        return reader, writer, True
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port),
+                                            config.PROXY_CONNECT_TIMEOUT)
+    return reader, writer, False
+
+def _release(port, reader, writer):
+    idle = _pool.setdefault(port, [])
+    if len(idle) >= config.PROXY_POOL_SIZE:
+        writer.close()
+        return
+    idle.append((reader, writer, time.monotonic()))
+
+def _resolve(method_path, headers):
+    method, _, rest = method_path.partition(' ')
+    target, _, version = rest.rpartition(' ')
+    if not target or not version.startswith('HTTP/'):
+        raise _BadRequest("Malformed request line")
+    host = (_header(headers, 'host') or '').split(':')[0].lower()
+    if config.PROXY_DOMAIN and host.endswith('.' + config.PROXY_DOMAIN):
+        service_id = host[:-len(config.PROXY_DOMAIN) - 1]
+        return method, target, version, service_id, ''
+    if target.startswith('/s/'):
+        service_id, slash, remainder = target[3:].partition('/')
+        service_id, _, query = service_id.partition('?')
+        path = '/' + remainder if slash else '/'
+        if query:
+            path += '?' + query
+        return method, path, version, service_id, f'/s/{service_id}'
+    return method, target, version, None, ''
+
+async def _send_error(writer, status, text):
+    body = f'{text}\n'.encode()
+    writer.write(_build_head(f'HTTP/1.1 {status}', [
+        ('Content-Type', 'text/plain'), ('Content-Length', str(len(body))), ('Connection', 'close')]) + body)
+    await writer.drain()
+
+async def _handle_client(client_reader, client_writer):
+    peer = client_writer.get_extra_info('peername')
+    client_ip = peer[0] if peer else ''
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(_read_head(client_reader), config.PROXY_KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            if request is None:
+                return
+            first_line, headers = request
+            method, path, version, service_id, prefix = _resolve(first_line, headers)
+            port = _routes.get(service_id)
+            if port is None:
+                await _send_error(client_writer, '404 Not Found', 'Unknown service')
+                return
+            if _activity_hook is not None and _activity_hook(service_id):
+                await asyncio.get_running_loop().run_in_executor(None, _wake_hook, service_id)
+                port = _routes.get(service_id, port)
+            keep_client = await _forward(client_reader, client_writer, method, path, version, headers,
+                                         port, prefix, client_ip)
+            if not keep_client:
+                return
+    except _BadRequest as e:
+        await _send_error(client_writer, '400 Bad Request', str(e))
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        pass
+    except Exception as e:
+        logging.error(f"Proxy error: {str(e)}")
+    finally:
+        client_writer.close()
+
+# Forward one request/response exchange; returns True if the client connection can be reused
+async def _forward(client_reader, client_writer, method, path, version, headers, port, prefix, client_ip):
+    _check_framing(headers)
+    request_tokens = _connection_tokens(headers)
+    upgrade = 'upgrade' in request_tokens and _header(headers, 'upgrade')
+    if (_header(headers, 'expect') or '').lower() == '100-continue':
+        # Answer the expectation here so the client starts sending the body we stream upstream
+        client_writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        await client_writer.drain()
+    out_headers = [(k, v) for k, v in headers
+                   if k.lower() not in HOP_BY_HOP and k.lower() not in request_tokens and k.lower() != 'expect']
+    if _header(headers, 'transfer-encoding'):
+        out_headers.append(('Transfer-Encoding', 'chunked'))
+    forwarded_for = _header(headers, 'x-forwarded-for')
+    out_headers = [(k, v) for k, v in out_headers if k.lower() != 'x-forwarded-for']
+    out_headers.append(('X-Forwarded-For', f'{forwarded_for}, {client_ip}' if forwarded_for else client_ip))
+    if prefix:
+        out_headers.append(('X-Forwarded-Prefix', prefix))
+    if upgrade:
+        out_headers += [('Connection', 'Upgrade'), ('Upgrade', upgrade)]
+    head = _build_head(f'{method} {path} HTTP/1.1', out_headers)
+    has_body = _header(headers, 'content-length') not in (None, '0') or _header(headers, 'transfer-encoding')
+
+    # A pooled connection may have been closed by the backend; retry once on a fresh one
+    for attempt in range(2):
+        try:
+            up_reader, up_writer, reused = await _acquire(port)
+        except (OSError, asyncio.TimeoutError):
+            await _send_error(client_writer, '503 Service Unavailable', 'Service is not running')
+            return False
+        try:
+            up_writer.write(head)
+            await up_writer.drain()
+            if has_body:
+                await _relay_body(client_reader, up_writer, headers, until_eof=False)
+            response = await asyncio.wait_for(_read_head(up_reader), config.PROXY_READ_TIMEOUT)
+            # Skip interim responses (100 Continue, 103 Early Hints)
+            while response is not None and response[0].split(' ', 2)[1:2] in (['100'], ['102'], ['103']):
+                response = await asyncio.wait_for(_read_head(up_reader), config.PROXY_READ_TIMEOUT)
+            if response is None:
+                raise ConnectionError("Backend closed the connection")
+            break
+        except (ConnectionError, OSError, _BadRequest, asyncio.IncompleteReadError):
+            up_writer.close()
+            if reused and not has_body and attempt == 0:
+                continue
+            await _send_error(client_writer, '502 Bad Gateway', 'Bad response from service')
+            return False
+        except asyncio.TimeoutError:
+            up_writer.close()
+            await _send_error(client_writer, '504 Gateway Timeout', 'Service did not respond in time')
+            return False
+
+    status_line, response_headers = response
+    status = int(status_line.split(' ', 2)[1])
+    response_tokens = _connection_tokens(response_headers)
+
+    if status == 101 and upgrade:
+        # Protocol switch (e.g. websockets): splice the two sockets together
+        client_writer.write(_build_head(status_line, response_headers))
+        await client_writer.drain()
+        await asyncio.gather(_pipe(client_reader, up_writer), _pipe(up_reader, client_writer))
+        return False
+
+    client_writer.write(_build_head(status_line, [(k, v) for k, v in response_headers
+                                                  if k.lower() not in ('connection', 'keep-alive')]))
+    await client_writer.drain()
+    reusable = True
+    if method != 'HEAD' and status not in (204, 304) and status >= 200:
+        reusable = await _relay_body(up_reader, client_writer, response_headers, until_eof=True)
+    if reusable and 'close' not in response_tokens and status_line.startswith('HTTP/1.1'):
+        _release(port, up_reader, up_writer)
+    else:
+        up_writer.close()
+        if not reusable:
+            return False  # The client can only detect the end of this body by EOF
+    return version == 'HTTP/1.1' and 'close' not in request_tokens
+
+PROXY_ROUTES.set_callback(lambda: len(_routes))
+PROXY_POOLED_CONNECTIONS.set_callback(lambda: sum(len(idle) for idle in list(_pool.values())))
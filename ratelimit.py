@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from metrics import RATE_LIMIT_BUCKETS, RATE_LIMITED
+
+# Rate limiting
+# One token bucket per (user, budget): a bucket holds up to `burst` tokens and refills
+# at `per_minute` tokens a minute, so a check is O(1) whatever the window. Cheap
+# commands and expensive ones (EXPENSIVE_COMMANDS, which start jobs) draw from separate
+# budgets, sized per tier in RATE_LIMITS. A bucket idle long enough to refill completely
+# is indistinguishable from a new one and is dropped. Buckets are kept in one LRU lane
+# per refill window, so within a lane the least recently used bucket is always the first
+# to be full again and expiry only ever looks at lane heads. Past RATE_LIMIT_MAX_ENTRIES
+# the least recently used buckets that still hold a token go as well; a depleted bucket
+# is never dropped, as that would hand its user a fresh burst, so the table only outgrows
+# the cap by buckets that are all depleted, and those expire within one refill window.
+
+_lanes = {}  # refill window in seconds: OrderedDict((user_id, budget): [tokens, time.monotonic() of last refill, burst])
+_lane_of = {}  # (user_id, budget): refill window of the lane holding its bucket
+_lock = threading.Lock()
+
+EVICT_SCAN = 32  # Buckets looked at per lane when over the cap
+
+def budget_for(command):
+    return 'expensive' if command in config.EXPENSIVE_COMMANDS else 'command'
+
+def _pop(window, key):
+    del _lanes[window][key]
+    del _lane_of[key]
+
+# Tokens a bucket would hold now; its lane's window is burst / rate
+def _tokens(bucket, window, now):
+    return bucket[0] + (now - bucket[1]) / window * bucket[2]
+
+# Drop buckets that are full again, then, over the cap, the coldest ones that aren't depleted
+# (never current, the bucket just charged)
+def _evict(now, current):
+    for window, lane in _lanes.items():
+        while lane:
+            key, bucket = next(iter(lane.items()))
+            if now - bucket[1] < window:
+                break
+            _pop(window, key)
+    excess = len(_lane_of) - config.RATE_LIMIT_MAX_ENTRIES
+    for window, lane in _lanes.items():
+        if excess <= 0:
+            return
+        victims = []
+        for scanned, (key, bucket) in enumerate(lane.items()):
+            if len(victims) >= excess or scanned >= EVICT_SCAN:
+                break
+            if key != current and _tokens(bucket, window, now) >= 1:
+                victims.append(key)
+        for key in victims:
+            _pop(window, key)
+        excess -= len(victims)
+
+# Take one token; returns (allowed, seconds until the next token)
+def consume(user_id, budget, tier='free'):
+    burst, per_minute = config.RATE_LIMITS[tier][budget]
+    rate = per_minute / 60.0
+    window = burst / rate
+    now = time.monotonic()
+    key = (user_id, budget)
+    with _lock:
+        old_window = _lane_of.get(key)
+        bucket = _lanes[old_window].pop(key) if old_window is not None else [float(burst), now, burst]
+        # (Re)insert at the warm end of its lane; the lane changes with the user's tier
+        _lanes.setdefault(window, OrderedDict())[key] = bucket
+        _lane_of[key] = window
+        bucket[2] = burst
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+        wait = 0 if allowed else (1 - bucket[0]) / rate
+        _evict(now, key)
+    if not allowed:
+        RATE_LIMITED.inc(budget=budget, tier=tier)
+    return allowed, wait
+
+RATE_LIMIT_BUCKETS.set_callback(lambda: len(_lane_of))
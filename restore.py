@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from database import get_running_services, get_service, get_users
+from deployment import check_readiness, is_process_running, launch_service, start_watchdog
+from idle import hold_service, should_start_held
+
+# Startup restoration
+# Services marked running in the DB are started again in a background thread so the bot
+# answers commands while they come up. Premium services go first, at most
+# RESTORE_CONCURRENCY start at once with RESTORE_STAGGER seconds between launches, and
+# each one is tracked until it passes its readiness check. The admin gets a summary.
+
+_status = {'total': 0, 'ready': 0, 'held': 0, 'not_ready': 0, 'failed': 0, 'skipped': 0,
+           'started_at': None, 'finished_at': None}
+_failed = []  # service_ids that could not be started
+_lock = threading.Lock()
+_thread = None
+
+def _record(outcome, service_id=None):
+    with _lock:
+        _status[outcome] += 1
+        if outcome in ('failed', 'not_ready'):
+            _failed.append(service_id)
+
+def start_restore(bot):
+    global _thread
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_restore_all, args=(bot,), name='restore', daemon=True)
+    _thread.start()
+
+def _restore_all(bot):
+    _status['started_at'] = time.time()
+    services = get_running_services()
+    users = get_users({service['user_id'] for service in services})
+    premium = {user_id for user_id, user in users.items() if user['is_premium']}
+    services.sort(key=lambda service: service['user_id'] not in premium)
+    _status['total'] = len(services)
+    logging.info(f"Restoring {len(services)} services with {config.RESTORE_CONCURRENCY} workers")
+
+    with ThreadPoolExecutor(max_workers=config.RESTORE_CONCURRENCY, thread_name_prefix='restore') as pool:
+        for i, service in enumerate(services):
+            if i:
+                time.sleep(config.RESTORE_STAGGER)
+            pool.submit(_restore_one, service, service['user_id'] in premium)
+
+    _status['finished_at'] = time.time()
+    summary = format_restore_status()
+    logging.info(summary)
+    try:
+        bot.send_message(config.ADMIN_ID, summary)
+    except Exception as e:
+        logging.error(f"Failed to send restore summary: {str(e)}")
+
+def _restore_one(service, is_premium):
+    service_id = service['service_id']
+    try:
+        # The owner may have stopped, deleted or redeployed it since the list was read
+        current = get_service(service_id)
+        if not current or current['status'] != 'running' or is_process_running(service_id):
+            _record('skipped')
+            return
+        if is_premium:
+            start_watchdog(service_id)
+        if should_start_held(current):
+            hold_service(current)
+            _record('held')
+            return
+        process = launch_service(service_id, current['project_type'], current['path'], current['port'])
+        ready, detail = check_readiness(service_id, process, current['project_type'], current['path'], current['port'])
+        if ready:
+            _record('ready')
+            logging.info(f"Restarted service {service_id} on bot start")
+        else:
+            _record('not_ready', service_id)
+            logging.warning(f"Service {service_id} did not become ready after restart: {detail}")
+    except Exception as e:
+        _record('failed', service_id)
+        logging.error(f"Failed to restore service {service_id}: {str(e)}")
+
+def get_restore_status():
+    with _lock:
+        status = dict(_status)
+        status['failed_ids'] = list(_failed)
+    status['done'] = status['ready'] + status['held'] + status['not_ready'] + status['failed'] + status['skipped']
+    return status
+
+def format_restore_status():
+    status = get_restore_status()
+    if status['started_at'] is None:
+        return "Service restoration has not started."
+    elapsed = (status['finished_at'] or time.time()) - status['started_at']
+    state = 'finished' if status['finished_at'] else 'in progress'
+    text = (f"Service restoration {state}: {status['done']}/{status['total']} in {elapsed:.1f}s\n"
+            f"Ready: {status['ready']}, held idle: {status['held']}, not ready: {status['not_ready']}, "
+            f"failed: {status['failed']}, skipped: {status['skipped']}")
+    if status['failed_ids']:
+        shown = status['failed_ids'][:20]
+        more = len(status['failed_ids']) - len(shown)
+        text += "\nProblems: " + ', '.join(shown) + (f" (+{more} more)" if more else '')
+    return text
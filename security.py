@@ -1,23 +1,246 @@
+import hashlib
 import os
+import posixpath
+import shutil
+import stat
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Dangerous keywords looked for in uploaded scripts
+BAD_KEYWORDS = [
+    'rm -rf', 'sudo', 'os.system', 'subprocess', 'exec', 'eval',
+    'cryptomine', 'bitcoin', 'monero', 'mining', 'forkbomb'
+]
+SCRIPT_EXTENSIONS = ('.py', '.sh', '.bash')  # Focus on scripts
+
+# Chunks are lowercased once and searched for each keyword with bytes.find, which is
+# several times faster than one case-insensitive regex alternation
+_keywords = [kw.lower().encode() for kw in BAD_KEYWORDS]
+# A match can straddle two chunks by at most the longest keyword minus one byte
+_overlap = max(len(kw) for kw in BAD_KEYWORDS) - 1
+
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+def _get_scan_pool():
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = ThreadPoolExecutor(max_workers=config.SCAN_WORKERS, thread_name_prefix='scan')
+        return _scan_pool
+
+def is_script(name):
+    return name.endswith(SCRIPT_EXTENSIONS)
+
+# Scan a binary file object in fixed-size chunks
+# Returns a list of findings: {'file', 'offset', 'keyword'}
+def scan_stream(stream, name):
+    findings = []
+    tail = b''
+    offset = 0  # Offset of the first byte after tail
+    while True:
+        chunk = stream.read(config.SCAN_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer = tail + chunk.lower()
+        base = offset - len(tail)
+        found = []
+        for keyword in _keywords:
+            start = buffer.find(keyword)
+            while start != -1:
+                # Matches that end inside the tail were reported with the previous chunk
+                if start + len(keyword) > len(tail):
+                    found.append((start, keyword))
+                start = buffer.find(keyword, start + 1)
+        for start, keyword in sorted(found):
+            findings.append({'file': name, 'offset': base + start, 'keyword': keyword.decode()})
+        offset += len(chunk)
+        tail = buffer[-_overlap:] if _overlap else b''
+    return findings
+
+def scan_file(path, name=None):
+    name = name or os.path.basename(path)
+    try:
+        with open(path, 'rb') as f:
+            return scan_stream(f, name)
+    except Exception as e:
+        return [{'file': name, 'offset': None, 'keyword': None, 'error': str(e)}]
+
+# Scan every script under a directory in parallel and return all findings
+def scan_directory(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if is_script(file):
+                path = os.path.join(root, file)
+                paths.append((path, os.path.relpath(path, directory)))
+    if not paths:
+        return []
+    pool = _get_scan_pool()
+    findings = []
+    for result in pool.map(lambda item: scan_file(*item), paths):
+        findings.extend(result)
+    return findings
+
+def describe_finding(finding):
+    if finding.get('error'):
+        return f"Error reading file {finding['file']}: {finding['error']}"
+    return f"Malicious keyword '{finding['keyword']}' found in {finding['file']} at offset {finding['offset']}"
 
 # Scan a directory for malicious content
 # Checks script files for dangerous keywords
 # Returns (is_malicious, reason)
 def scan_for_malicious_content(directory):
-    bad_keywords = [
-        'rm -rf', 'sudo', 'os.system', 'subprocess', 'exec', 'eval',
-        'cryptomine', 'bitcoin', 'monero', 'mining', 'forkbomb'
-    ]
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(('.py', '.sh', '.bash')):  # Focus on scripts
-                path = os.path.join(root, file)
-                try:
-                    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read().lower()
-                        for kw in bad_keywords:
-                            if kw in content:
-                                return True, f"Malicious keyword '{kw}' found in {file}"
-                except Exception as e:
-                    return True, f"Error reading file {file}: {str(e)}"
+    findings = scan_directory(directory)
+    if findings:
+        reason = describe_finding(findings[0])
+        if len(findings) > 1:
+            reason += f" (+{len(findings) - 1} more)"
+        return True, reason
+    return False, ""
+
+# Archive ingestion
+# Uploads are validated from the ZIP central directory and their scripts scanned
+# straight from the compressed stream, so nothing touches disk until the archive passes.
+class ArchiveRejected(Exception):
+    pass
+
+def _check_member_name(name):
+    normalized = name.replace('\\', '/')
+    if normalized.startswith('/') or (len(normalized) > 1 and normalized[1] == ':'):
+        raise ArchiveRejected(f"Absolute path not allowed: {name}")
+    if '..' in normalized.split('/'):
+        raise ArchiveRejected(f"Path traversal not allowed: {name}")
+
+# Check archive limits without decompressing anything
+def inspect_archive(zip_ref):
+    members = zip_ref.infolist()
+    if len(members) > config.MAX_ARCHIVE_FILES:
+        raise ArchiveRejected(f"Too many files ({len(members)} > {config.MAX_ARCHIVE_FILES})")
+    total_size = 0
+    for info in members:
+        _check_member_name(info.filename)
+        if stat.S_ISLNK(info.external_attr >> 16):
+            raise ArchiveRejected(f"Symlinks not allowed: {info.filename}")
+        if info.flag_bits & 0x1:
+            raise ArchiveRejected(f"Encrypted files not allowed: {info.filename}")
+        total_size += info.file_size
+        # Small files can compress extremely well legitimately, only large ones can be bombs
+        if (info.file_size > 1024 * 1024 and info.compress_size
+                and info.file_size / info.compress_size > config.MAX_COMPRESSION_RATIO):
+            raise ArchiveRejected(f"Suspicious compression ratio for {info.filename}")
+    if total_size > config.MAX_ARCHIVE_UNCOMPRESSED:
+        raise ArchiveRejected(
+            f"Archive too large when extracted ({total_size // (1024 * 1024)} MB > "
+            f"{config.MAX_ARCHIVE_UNCOMPRESSED // (1024 * 1024)} MB)")
+    return members
+
+# Members that can't be decompressed reject the upload; only keyword matches are findings
+def _scan_member(zip_ref, info):
+    try:
+        with zip_ref.open(info) as f:
+            return scan_stream(f, info.filename)
+    except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError) as e:
+        raise ArchiveRejected(f"Unreadable file {info.filename}: {str(e)}")
+
+# Validate an uploaded ZIP and scan its scripts in-stream
+# Raises ArchiveRejected for broken or oversized archives, returns (is_malicious, reason)
+def scan_archive(zip_path):
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = inspect_archive(zip_ref)
+            scripts = [info for info in members if not info.is_dir() and is_script(info.filename)]
+            findings = []
+            for result in _get_scan_pool().map(lambda info: _scan_member(zip_ref, info), scripts):
+                findings.extend(result)
+    except zipfile.BadZipFile as e:
+        raise ArchiveRejected(f"Invalid ZIP file: {str(e)}")
+    if findings:
+        reason = describe_finding(findings[0])
+        if len(findings) > 1:
+            reason += f" (+{len(findings) - 1} more)"
+        return True, reason
     return False, ""
+
+def _member_path(info):
+    return posixpath.normpath(info.filename.replace('\\', '/'))
+
+# Extract an archive that already passed scan_archive; returns the number of bytes written
+def extract_archive(zip_path, dest_dir):
+    written = 0
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info in inspect_archive(zip_ref):
+            target = os.path.join(dest_dir, *_member_path(info).split('/'))
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, config.SCAN_CHUNK_SIZE)
+            written += info.file_size
+    return written
+
+def _hash_stream(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(config.SCAN_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+# Make dest_dir match an archive that already passed scan_archive, touching only what changed
+# Top-level names in preserve (e.g. the venv) are left alone.
+# Returns {'added': [...], 'changed': [...], 'removed': [...]} of relative paths
+def sync_archive(zip_path, dest_dir, preserve=()):
+    changes = {'added': [], 'changed': [], 'removed': []}
+    wanted = set()
+    wanted_dirs = set()
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info in inspect_archive(zip_ref):
+            rel_path = _member_path(info)
+            if rel_path.split('/')[0] in preserve:
+                continue
+            target = os.path.join(dest_dir, *rel_path.split('/'))
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                wanted_dirs.add(rel_path)
+                continue
+            wanted.add(rel_path)
+            if os.path.isfile(target):
+                # Same size is required for equality; only then compare content hashes
+                if os.path.getsize(target) == info.file_size:
+                    with zip_ref.open(info) as src, open(target, 'rb') as current:
+                        if _hash_stream(src) == _hash_stream(current):
+                            continue
+                changes['changed'].append(rel_path)
+            else:
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                changes['added'].append(rel_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Write beside the target and rename, so a running reader never sees a partial file
+            temp_path = target + '.partial'
+            with zip_ref.open(info) as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, config.SCAN_CHUNK_SIZE)
+            os.replace(temp_path, target)
+
+    for root, dirs, files in os.walk(dest_dir, topdown=True):
+        rel_root = os.path.relpath(root, dest_dir).replace(os.sep, '/')
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d not in preserve]
+            files = [f for f in files if f not in preserve]
+        for file in files:
+            rel_path = file if rel_root == '.' else f'{rel_root}/{file}'
+            if rel_path not in wanted:
+                os.remove(os.path.join(root, file))
+                changes['removed'].append(rel_path)
+    # Prune directories left empty by removals
+    for root, dirs, files in os.walk(dest_dir, topdown=False):
+        rel_root = os.path.relpath(root, dest_dir).replace(os.sep, '/')
+        if rel_root == '.' or rel_root in wanted_dirs or rel_root.split('/')[0] in preserve:
+            continue
+        if not os.listdir(root):
+            os.rmdir(root)
+    return changes
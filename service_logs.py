@@ -0,0 +1,149 @@
+import gzip
+import logging
+import os
+import threading
+import time
+
+import config
+
+# Per-service log files
+# Services write straight to LOGS_DIR/<service_id>.log through an O_APPEND descriptor.
+# A rotator thread copies a log into a gzip segment and truncates it in place
+# (copytruncate) once it passes LOG_MAX_BYTES or LOG_ROTATE_INTERVAL seconds. Lines
+# written between the copy and the truncate are lost; that is the price of not putting
+# a pump between every service and its log. Segments beyond LOG_RETENTION_BYTES per
+# service are deleted oldest first. Tails are read backwards from the end of the file.
+
+_rotated_at = {}  # service_id: time.time() of the last rotation (or first sight)
+_rotate_lock = threading.Lock()
+_thread = None
+
+def log_path(service_id):
+    return os.path.join(config.LOGS_DIR, f'{service_id}.log')
+
+# Append-only handle for a service's stdout/stderr
+def open_log(service_id):
+    os.makedirs(config.LOGS_DIR, exist_ok=True)
+    return open(log_path(service_id), 'ab')
+
+def _segments(service_id):
+    prefix = f'{service_id}.log.'
+    try:
+        names = os.listdir(config.LOGS_DIR)
+    except OSError:
+        return []
+    # Timestamped names sort oldest first
+    return sorted(os.path.join(config.LOGS_DIR, name) for name in names
+                  if name.startswith(prefix) and name.endswith('.gz'))
+
+def rotate_log(service_id):
+    path = log_path(service_id)
+    with _rotate_lock:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        if not size:
+            return False
+        now = time.time()
+        segment = f"{path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}.gz"
+        with open(path, 'rb') as src, gzip.open(segment + '.tmp', 'wb') as dst:
+            remaining = size
+            while remaining:
+                chunk = src.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+        os.replace(segment + '.tmp', segment)
+        # Writers use O_APPEND, so they carry on at the start of the truncated file
+        os.truncate(path, 0)
+        _rotated_at[service_id] = now
+    _enforce_retention(service_id)
+    return True
+
+def _enforce_retention(service_id):
+    segments = _segments(service_id)
+    sizes = {segment: os.path.getsize(segment) for segment in segments}
+    total = sum(sizes.values())
+    for segment in segments:
+        if total <= config.LOG_RETENTION_BYTES:
+            break
+        os.remove(segment)
+        total -= sizes[segment]
+
+def _due(service_id, now):
+    try:
+        size = os.path.getsize(log_path(service_id))
+    except OSError:
+        return False
+    if size >= config.LOG_MAX_BYTES:
+        return True
+    first_seen = _rotated_at.setdefault(service_id, now)
+    return size > 0 and now - first_seen >= config.LOG_ROTATE_INTERVAL
+
+def rotate_all():
+    now = time.time()
+    for name in os.listdir(config.LOGS_DIR):
+        if not name.endswith('.log') or name == 'system.log':
+            continue
+        service_id = name[:-len('.log')]
+        if _due(service_id, now):
+            try:
+                rotate_log(service_id)
+            except OSError as e:
+                logging.error(f"Failed to rotate log of {service_id}: {str(e)}")
+
+def _rotator():
+    while True:
+        time.sleep(config.LOG_CHECK_INTERVAL)
+        try:
+            rotate_all()
+        except Exception as e:
+            logging.error(f"Log rotation failed: {str(e)}")
+
+def start_log_rotation():
+    global _thread
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_rotator, name='log-rotator', daemon=True)
+    _thread.start()
+
+# Last n lines of a service's current log, read backwards in blocks from the end
+def tail_log(service_id, n):
+    block_size = 8192
+    try:
+        f = open(log_path(service_id), 'rb')
+    except OSError:
+        return b''
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        data = b''
+        # One extra newline: the file usually ends with one
+        while position > 0 and data.count(b'\n') <= n:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    lines = data.splitlines(keepends=True)
+    return b''.join(lines[-n:])
+
+def delete_logs(service_id):
+    with _rotate_lock:
+        _rotated_at.pop(service_id, None)
+        for path in [log_path(service_id)] + _segments(service_id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def get_log_usage(service_id):
+    paths = [log_path(service_id)] + _segments(service_id)
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass  # Rotated or deleted meanwhile
+    return total
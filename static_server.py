@@ -0,0 +1,330 @@
+import asyncio
+import email.utils
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
+
+import config
+from metrics import STATIC_META_CACHE_ENTRIES
+
+try:
+    import brotli  # Optional: enables .br variants
+except ImportError:
+    brotli = None
+
+# Shared static site server
+# Every static service is served from one asyncio loop in the bot process instead of one
+# `python -m http.server` per site. Each site keeps its own port (so links, the proxy and
+# readiness checks work unchanged) and is represented in `processes` by a StaticSite handle
+# that mimics the parts of subprocess.Popen the rest of the code uses.
+# Files go out with sendfile, carry ETag/Last-Modified and honour conditional GETs, and
+# gzip/brotli variants are precompressed when a site starts. Variants live outside the
+# user's tree, in STATIC_VARIANT_DIR/<service_id>/<relative path>.gz|.br, and carry their
+# source file's mtime, so a variant is fresh exactly when the two mtimes match. Blue/green
+# roots hardlink unchanged files, which keeps their variants valid across versions.
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_loop = None
+_thread = None
+_start_lock = threading.Lock()
+_meta_cache = OrderedDict()  # path: (checked_at, metadata or None), LRU bounded by STATIC_META_CACHE_SIZE
+
+class StaticSite:
+    pid = None  # No child process; the supervisor falls back to poll()
+
+    def __init__(self, service_id, port, root):
+        self.service_id = service_id
+        self.port = port
+        self.root = os.path.abspath(root)
+        self.returncode = None
+        self.args = ['static', str(port), self.root]
+        self._server = None
+        self._closed = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            self.returncode = -15
+            _loop.call_soon_threadsafe(self._close)
+
+    kill = terminate
+
+    def wait(self, timeout=None):
+        self._closed.wait(timeout)
+        return self.returncode
+
+    def _close(self):
+        if self._server is not None:
+            self._server.close()
+        self._closed.set()
+
+def _ensure_loop():
+    global _loop, _thread
+    with _start_lock:
+        if _thread is not None:
+            return
+        _loop = asyncio.new_event_loop()
+        _thread = threading.Thread(target=_loop.run_forever, name='static-server', daemon=True)
+        _thread.start()
+        logging.info("Shared static server started")
+
+# Start serving root on port; raises OSError if the port can't be bound
+def serve_site(service_id, port, root):
+    _ensure_loop()
+    precompress_site(service_id, root)
+    site = StaticSite(service_id, port, root)
+
+    async def start():
+        site._server = await asyncio.start_server(
+            lambda r, w: _handle_client(site, r, w), '0.0.0.0', port, limit=config.STATIC_MAX_HEADER_BYTES)
+
+    asyncio.run_coroutine_threadsafe(start(), _loop).result(timeout=10)
+    return site
+
+def _is_compressible(path):
+    content_type = mimetypes.guess_type(path)[0] or ''
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def _variant_dir(service_id):
+    return os.path.join(config.STATIC_VARIANT_DIR, str(service_id))
+
+def _variant_path(service_id, root, path, suffix):
+    return os.path.join(_variant_dir(service_id), os.path.relpath(path, root) + suffix)
+
+# Write .gz (and .br when brotli is installed) variants of compressible files that lack a
+# fresh one, and drop variants whose source is gone or no longer worth compressing
+def precompress_site(service_id, root):
+    root = os.path.abspath(root)
+    wanted = set()
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+                if st.st_size < config.STATIC_COMPRESS_MIN_BYTES or not _is_compressible(path):
+                    continue
+                for encoding, suffix in ENCODINGS:
+                    if encoding == 'br' and brotli is None:
+                        continue
+                    variant = _variant_path(service_id, root, path, suffix)
+                    wanted.add(variant)
+                    if os.path.exists(variant) and os.stat(variant).st_mtime_ns == st.st_mtime_ns:
+                        continue
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    compressed = brotli.compress(data) if encoding == 'br' else gzip.compress(data, mtime=0)
+                    if len(compressed) < len(data):
+                        os.makedirs(os.path.dirname(variant), exist_ok=True)
+                        with open(variant + '.tmp', 'wb') as f:
+                            f.write(compressed)
+                        os.utime(variant + '.tmp', ns=(st.st_atime_ns, st.st_mtime_ns))
+                        os.replace(variant + '.tmp', variant)
+            except OSError as e:
+                logging.warning(f"Could not precompress {path}: {str(e)}")
+    for dirpath, _, files in os.walk(_variant_dir(service_id)):
+        for name in files:
+            variant = os.path.join(dirpath, name)
+            if variant not in wanted:
+                try:
+                    os.remove(variant)
+                except OSError:
+                    pass
+
+def delete_variants(service_id):
+    shutil.rmtree(_variant_dir(service_id), ignore_errors=True)
+
+# Stat results (plus ETag and available variants) cached for STATIC_META_CACHE_TTL seconds
+# The cache lives on the loop; only misses stat the disk, in the default executor
+async def _metadata(site, path):
+    now = time.monotonic()
+    cached = _meta_cache.get(path)
+    if cached and now - cached[0] < config.STATIC_META_CACHE_TTL:
+        _meta_cache.move_to_end(path)
+        return cached[1]
+    meta = await asyncio.get_running_loop().run_in_executor(None, _stat_file, site, path)
+    _meta_cache[path] = (now, meta)
+    _meta_cache.move_to_end(path)
+    while len(_meta_cache) > config.STATIC_META_CACHE_SIZE:
+        _meta_cache.popitem(last=False)
+    return meta
+
+# None when the path doesn't name a readable file (including paths with a NUL byte)
+def _stat_file(site, path):
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if os.path.isdir(path):
+        return {'is_dir': True}
+    variants = {}
+    for encoding, suffix in ENCODINGS:
+        variant = _variant_path(site.service_id, site.root, path, suffix)
+        try:
+            vst = os.stat(variant)
+            if vst.st_mtime_ns == st.st_mtime_ns:
+                variants[encoding] = (variant, vst.st_size)
+        except OSError:
+            pass
+    return {
+        'is_dir': False,
+        'size': st.st_size,
+        'mtime': int(st.st_mtime),
+        'etag': f'"{st.st_mtime_ns:x}-{st.st_size:x}"',
+        'last_modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+        'content_type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        'variants': variants,
+    }
+
+async def _resolve_path(site, target):
+    path = unquote(target.split('?', 1)[0].split('#', 1)[0])
+    full = os.path.normpath(os.path.join(site.root, path.lstrip('/')))
+    if full != site.root and not full.startswith(site.root + os.sep):
+        return None, None
+    meta = await _metadata(site, full)
+    if meta and meta['is_dir']:
+        full = os.path.join(full, 'index.html')
+        meta = await _metadata(site, full)
+    return full, meta
+
+# Accept-Encoding as {coding: q}; a coding given without q has q=1
+def _parse_accept_encoding(value):
+    weights = {}
+    for item in value.split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        if not name:
+            continue
+        weight = 1.0
+        for param in params:
+            key, _, number = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(number)
+                except ValueError:
+                    weight = 0.0
+        weights[name.lower()] = weight
+    return weights
+
+# Best precompressed variant the client accepts (highest q, then ENCODINGS order), or None
+def _choose_encoding(value, variants):
+    weights = _parse_accept_encoding(value)
+    best, best_weight = None, 0.0
+    for encoding, _ in ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if encoding in variants and weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def _not_modified(headers, meta):
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or meta['etag'] in tags or ('W/' + meta['etag']) in tags
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return meta['mtime'] <= since
+    return False
+
+def _head(status, fields):
+    lines = [f'HTTP/1.1 {status}'] + [f'{name}: {value}' for name, value in fields]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def _send_simple(writer, status, text, keep_alive):
+    body = f'{text}\n'.encode()
+    writer.write(_head(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body))),
+                                ('Connection', 'keep-alive' if keep_alive else 'close')]) + body)
+    await writer.drain()
+
+async def _read_request(reader):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), config.STATIC_KEEPALIVE_TIMEOUT)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+        return None
+    lines = head[:-4].decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1], parts[2], headers
+
+async def _handle_client(site, reader, writer):
+    try:
+        while site.returncode is None:
+            request = await _read_request(reader)
+            if request is None:
+                return
+            method, target, version, headers = request
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+                await _send_simple(writer, '400 Bad Request', 'Request bodies are not supported', False)
+                return
+            if method not in ('GET', 'HEAD'):
+                await _send_simple(writer, '405 Method Not Allowed', 'Method not allowed', keep_alive)
+            else:
+                await _serve_file(site, writer, method, target, headers, keep_alive)
+            if not keep_alive:
+                return
+    except (ConnectionError, OSError):
+        pass
+    except Exception as e:
+        logging.error(f"Static server error for {site.service_id}: {str(e)}")
+    finally:
+        writer.close()
+
+async def _serve_file(site, writer, method, target, headers, keep_alive):
+    path, meta = await _resolve_path(site, target)
+    if meta is None or meta['is_dir']:
+        await _send_simple(writer, '404 Not Found', 'File not found', keep_alive)
+        return
+    fields = [
+        ('ETag', meta['etag']),
+        ('Last-Modified', meta['last_modified']),
+        ('Cache-Control', f'public, max-age={config.STATIC_MAX_AGE}'),
+        ('Vary', 'Accept-Encoding'),
+        ('Connection', 'keep-alive' if keep_alive else 'close'),
+    ]
+    if _not_modified(headers, meta):
+        writer.write(_head('304 Not Modified', fields))
+        await writer.drain()
+        return
+
+    send_path = path
+    encoding = _choose_encoding(headers.get('accept-encoding', ''), meta['variants'])
+    if encoding is not None:
+        send_path = meta['variants'][encoding][0]
+        fields.append(('Content-Encoding', encoding))
+    loop = asyncio.get_running_loop()
+    try:
+        f = await loop.run_in_executor(None, open, send_path, 'rb')
+    except OSError:
+        _meta_cache.pop(path, None)
+        await _send_simple(writer, '404 Not Found', 'File not found', keep_alive)
+        return
+    with f:
+        # The cached size may be stale; the length sent must match the open file
+        size = os.fstat(f.fileno()).st_size
+        fields += [('Content-Type', meta['content_type']), ('Content-Length', str(size))]
+        writer.write(_head('200 OK', fields))
+        await writer.drain()
+        if method == 'HEAD' or not size:
+            return
+        # Zero-copy from the page cache to the socket where the platform allows it
+        await loop.sendfile(writer.transport, f, 0, size)
+
+STATIC_META_CACHE_ENTRIES.set_callback(lambda: len(_meta_cache))
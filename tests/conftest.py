@@ -0,0 +1,20 @@
+import os
+import socket
+import sys
+
+import pytest
+
+# The bot's modules are flat top-level files next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # config paths (DB_FILE, LOGS_DIR, ...) are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,77 @@
+import socket
+import time
+
+import config
+import deployment
+import idle
+import metrics
+
+def _held_service(path, port, service_id='svc1'):
+    service = {'service_id': service_id, 'user_id': 1, 'port': port, 'project_type': 'static', 'path': str(path)}
+    return service, idle.hold_service(service)
+
+def _request(port, timeout=10):
+    with socket.create_connection(('127.0.0.1', port), timeout=timeout) as s:
+        s.sendall(b'GET / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+def test_wake_on_first_connection(workdir, free_port, monkeypatch):
+    monkeypatch.setattr(config, 'SHARED_STATIC_SERVER', True)
+    (workdir / 'index.html').write_text('<html>hello</html>')
+    service, holder = _held_service(workdir, free_port)
+    cold_starts = metrics.IDLE_COLD_START_SECONDS.totals().get((), (0, 0))[0]
+    try:
+        assert deployment.is_held('svc1')
+        assert metrics._gauge_value(metrics.IDLE_HELD) >= 1
+        response = _request(free_port)
+        assert response.startswith(b'HTTP/1.1 200')
+        assert b'hello' in response
+        assert not deployment.is_held('svc1')
+        assert holder.poll() == 0
+        assert metrics.IDLE_COLD_START_SECONDS.totals()[()][0] == cold_starts + 1
+    finally:
+        deployment.stop_process('svc1')
+
+def test_failed_wake_releases_clients(workdir, free_port, monkeypatch):
+    def broken_launch(*args, **kwargs):
+        raise FileNotFoundError('venv/bin/python')
+    monkeypatch.setattr(idle, 'launch_service', broken_launch)
+    service, holder = _held_service(workdir, free_port, 'svc2')
+    failures = metrics.IDLE_WAKE_FAILURES.total()
+    try:
+        started = time.monotonic()
+        assert _request(free_port) == b''  # Closed instead of hanging
+        assert time.monotonic() - started < 5
+        assert holder.poll() == 1  # Exited, so the supervisor notices
+        assert not holder._waking
+        assert not deployment.is_held('svc2')
+        assert metrics.IDLE_WAKE_FAILURES.total() == failures + 1
+    finally:
+        deployment.processes.pop('svc2', None)
+
+def test_client_wait_is_bounded(workdir, free_port, monkeypatch):
+    monkeypatch.setattr(config, 'IDLE_CLIENT_WAIT_TIMEOUT', 0.5)
+    monkeypatch.setattr(idle, 'wake', lambda service_id: time.sleep(3))
+    service, holder = _held_service(workdir, free_port, 'svc3')
+    try:
+        started = time.monotonic()
+        assert _request(free_port) == b''
+        assert time.monotonic() - started < 2.5
+    finally:
+        holder.terminate()
+        deployment.processes.pop('svc3', None)
+
+def test_suspend_needs_the_proxy(monkeypatch):
+    monkeypatch.setattr(config, 'SHARED_STATIC_SERVER', True)
+    monkeypatch.setattr(idle, 'add_or_get_user', lambda user_id: {'is_premium': False})
+    service = {'service_id': 'svc4', 'user_id': 1, 'port': 1, 'project_type': 'python',
+               'last_request': '2000-01-01 00:00:00'}
+    monkeypatch.setattr(config, 'PROXY_ENABLED', True)
+    assert idle.should_start_held(service)
+    monkeypatch.setattr(config, 'PROXY_ENABLED', False)
+    assert not idle.should_start_held(service)
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import config
+import proxy
+
+# Runs the proxy and a backend that records every request it receives, then sends raw
+# request bytes through the proxy and returns (response, requests seen by the backend)
+async def _exchange(raw):
+    received = []
+
+    async def backend(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                length = next((int(line.split(':', 1)[1]) for line in lines
+                               if line.lower().startswith('content-length:')), 0)
+                body = await reader.readexactly(length) if length else b''
+                received.append((lines[0], body))
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    backend_server = await asyncio.start_server(backend, '127.0.0.1', 0)
+    proxy_server = await asyncio.start_server(proxy._handle_client, '127.0.0.1', 0)
+    proxy.set_route('svc', backend_server.sockets[0].getsockname()[1])
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy_server.sockets[0].getsockname()[1])
+        writer.write(raw)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response, received
+    finally:
+        proxy.remove_route('svc')
+        proxy_server.close()
+        backend_server.close()
+
+def _run(raw):
+    return asyncio.run(_exchange(raw))
+
+@pytest.fixture(autouse=True)
+def path_routing(monkeypatch):
+    monkeypatch.setattr(config, 'PROXY_DOMAIN', '')
+
+def test_content_length_body_is_forwarded():
+    response, received = _run(b'POST /s/svc/echo HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n'
+                              b'Connection: close\r\n\r\nhello')
+    assert response.startswith(b'HTTP/1.1 200')
+    assert received == [('POST /echo HTTP/1.1', b'hello')]
+
+@pytest.mark.parametrize('framing', [
+    b'Content-Length: 5\r\nTransfer-Encoding: chunked\r\n',
+    b'Transfer-Encoding: chunked\r\nContent-Length: 0\r\n',
+    b'Content-Length: 5\r\nContent-Length: 6\r\n',
+    b'Content-Length: +5\r\n',
+    b'Transfer-Encoding: gzip, chunked\r\n',
+    b'Transfer-Encoding: chunked\r\nTransfer-Encoding: identity\r\n',
+])
+def test_ambiguous_framing_is_rejected(framing):
+    # The tail would be a second, smuggled request if the two hops disagreed on the body length
+    raw = (b'POST /s/svc/ HTTP/1.1\r\nHost: x\r\n' + framing +
+           b'\r\n0\r\n\r\nGET /s/svc/admin HTTP/1.1\r\nHost: x\r\n\r\n')
+    response, received = _run(raw)
+    assert response.startswith(b'HTTP/1.1 400')
+    assert received == []
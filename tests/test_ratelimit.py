@@ -0,0 +1,79 @@
+import pytest
+
+import config
+import ratelimit
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    monkeypatch.setattr(config, 'RATE_LIMITS', {
+        'free': {'command': (3, 60), 'expensive': (2, 6)},  # Windows of 3s and 20s
+        'premium': {'command': (10, 60), 'expensive': (5, 15)},
+    })
+    monkeypatch.setattr(ratelimit, '_lanes', {})
+    monkeypatch.setattr(ratelimit, '_lane_of', {})
+    return clock
+
+def _drain(user_id, budget='command', tier='free'):
+    while ratelimit.consume(user_id, budget, tier)[0]:
+        pass
+
+def test_burst_then_refill(clock):
+    assert [ratelimit.consume(1, 'command')[0] for _ in range(4)] == [True, True, True, False]
+    allowed, wait = ratelimit.consume(1, 'command')
+    assert not allowed and wait == pytest.approx(1.0)
+    clock.now += 1.0
+    assert ratelimit.consume(1, 'command')[0]
+    assert not ratelimit.consume(1, 'command')[0]
+    clock.now += 10  # Refill is capped at the burst
+    assert [ratelimit.consume(1, 'command')[0] for _ in range(4)] == [True, True, True, False]
+
+def test_budgets_are_separate(clock):
+    _drain(1, 'expensive')
+    assert ratelimit.consume(1, 'command')[0]
+    assert ratelimit.consume(2, 'expensive')[0]
+
+def test_tier_change_moves_lanes(clock):
+    _drain(1)
+    assert ratelimit._lane_of[(1, 'command')] == 3.0
+    # An upgraded user keeps the (empty) bucket but refills at the premium rate and burst
+    clock.now += 1.0
+    assert ratelimit.consume(1, 'command', 'premium')[0]
+    assert ratelimit._lane_of[(1, 'command')] == 10.0
+    assert (1, 'command') not in ratelimit._lanes[3.0]
+
+def test_refilled_buckets_expire(clock):
+    ratelimit.consume(1, 'command')
+    ratelimit.consume(2, 'expensive')
+    clock.now += 5  # Past the command window, inside the expensive one
+    ratelimit.consume(3, 'command')
+    assert set(ratelimit._lane_of) == {(2, 'expensive'), (3, 'command')}
+    clock.now += 20
+    ratelimit.consume(3, 'command')
+    assert set(ratelimit._lane_of) == {(3, 'command')}
+
+def test_cap_evicts_cold_buckets_with_tokens(clock, monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMIT_MAX_ENTRIES', 3)
+    for user_id in range(5):
+        ratelimit.consume(user_id, 'command')
+    assert set(ratelimit._lane_of) == {(2, 'command'), (3, 'command'), (4, 'command')}
+
+def test_cap_never_evicts_depleted_buckets(clock, monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMIT_MAX_ENTRIES', 2)
+    for user_id in range(3):
+        _drain(user_id)
+    # Over the cap, but dropping any of them would hand its user a fresh burst
+    assert len(ratelimit._lane_of) == 3
+    assert not ratelimit.consume(0, 'command')[0]
+    # Once they refill they expire as usual
+    clock.now += 3
+    ratelimit.consume(9, 'command')
+    assert set(ratelimit._lane_of) == {(9, 'command')}
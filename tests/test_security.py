@@ -0,0 +1,69 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import config
+import security
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(config, 'SCAN_CHUNK_SIZE', 16)
+
+def _scan(data):
+    return security.scan_stream(io.BytesIO(data), 'app.py')
+
+@pytest.mark.parametrize('offset', range(0, 20))
+def test_keyword_found_at_every_chunk_offset(small_chunks, offset):
+    data = b'x' * offset + b'import subprocess' + b'y' * 40
+    findings = _scan(data)
+    assert [(f['keyword'], f['offset']) for f in findings] == [('subprocess', offset + 7)]
+
+def test_match_in_overlap_reported_once(small_chunks):
+    # 'bitcoin' straddles the first chunk boundary and lies entirely in the next tail
+    data = b'a' * 12 + b'bitcoin' + b'b' * 30
+    assert len(_scan(data)) == 1
+
+def test_case_insensitive_and_ordered(small_chunks):
+    data = b'EVAL(x)\n' + b'z' * 30 + b'Sudo rm -RF /'
+    findings = _scan(data)
+    assert [f['keyword'] for f in findings] == ['eval', 'sudo', 'rm -rf']
+    assert [f['offset'] for f in findings] == [0, 38, 43]
+
+def test_clean_file():
+    assert _scan(b'print("hello")\n' * 1000) == []
+
+def _zip(path, files):
+    with zipfile.ZipFile(path, 'w') as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return str(path)
+
+def _tree(root):
+    return {os.path.relpath(os.path.join(d, f), root).replace(os.sep, '/'): open(os.path.join(d, f)).read()
+            for d, _, files in os.walk(root) for f in files}
+
+def test_sync_archive_add_change_remove(tmp_path):
+    dest = tmp_path / 'app'
+    first = _zip(tmp_path / 'v1.zip', {'main.py': 'print(1)\n', 'lib/util.py': 'x = 1\n', 'old/gone.txt': 'bye'})
+    assert security.sync_archive(first, str(dest)) == {
+        'added': ['main.py', 'lib/util.py', 'old/gone.txt'], 'changed': [], 'removed': []}
+    (dest / 'venv').mkdir()
+    (dest / 'venv' / 'pyvenv.cfg').write_text('home = /usr')
+    unchanged = os.stat(dest / 'main.py').st_mtime_ns
+
+    second = _zip(tmp_path / 'v2.zip', {'main.py': 'print(1)\n', 'lib/util.py': 'x = 22\n', 'new.txt': 'hi'})
+    changes = security.sync_archive(second, str(dest), preserve=('venv',))
+    assert changes == {'added': ['new.txt'], 'changed': ['lib/util.py'], 'removed': ['old/gone.txt']}
+    assert _tree(dest) == {'main.py': 'print(1)\n', 'lib/util.py': 'x = 22\n', 'new.txt': 'hi',
+                           'venv/pyvenv.cfg': 'home = /usr'}
+    assert not (dest / 'old').exists()  # Emptied directories are pruned
+    assert os.stat(dest / 'main.py').st_mtime_ns == unchanged  # Identical files are not rewritten
+
+def test_sync_archive_same_size_change(tmp_path):
+    dest = tmp_path / 'app'
+    security.sync_archive(_zip(tmp_path / 'v1.zip', {'a.txt': 'aaaa'}), str(dest))
+    changes = security.sync_archive(_zip(tmp_path / 'v2.zip', {'a.txt': 'bbbb'}), str(dest))
+    assert changes['changed'] == ['a.txt']
+    assert (dest / 'a.txt').read_text() == 'bbbb'
@@ -0,0 +1,89 @@
+import gzip
+import os
+import socket
+import zipfile
+
+import pytest
+
+import config
+import static_server
+from security import sync_archive
+
+@pytest.fixture
+def site(workdir, free_port, monkeypatch):
+    monkeypatch.setattr(config, 'STATIC_META_CACHE_TTL', 0)
+    root = workdir / 'site'
+    root.mkdir()
+    (root / 'index.html').write_text('<html>' + 'hello ' * 1000 + '</html>')
+    (workdir / 'secret.txt').write_text('top secret')
+    site = static_server.serve_site('svc1', free_port, root)
+    yield site
+    site.terminate()
+    site.wait(5)
+
+def _get(port, path, headers=''):
+    with socket.create_connection(('127.0.0.1', port), timeout=10) as s:
+        s.sendall(f'GET {path} HTTP/1.1\r\nHost: x\r\nConnection: close\r\n{headers}\r\n'.encode())
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    return head.decode('latin-1'), body
+
+def test_serves_index(site):
+    head, body = _get(site.port, '/')
+    assert head.startswith('HTTP/1.1 200')
+    assert body.startswith(b'<html>hello')
+
+@pytest.mark.parametrize('path', ['/../secret.txt', '/%2e%2e/secret.txt', '/a/../../secret.txt', '/%2e%2e%2fsecret.txt'])
+def test_traversal_is_not_found(site, path):
+    head, body = _get(site.port, path)
+    assert head.startswith('HTTP/1.1 404')
+    assert b'top secret' not in body
+
+@pytest.mark.parametrize('path', ['/index.html%00', '/%00', '/index.html%00.txt'])
+def test_null_byte_is_not_found(site, path):
+    head, _ = _get(site.port, path)
+    assert head.startswith('HTTP/1.1 404')
+    # The connection handler survived
+    assert _get(site.port, '/')[0].startswith('HTTP/1.1 200')
+
+def test_variants_live_outside_the_site(site, workdir):
+    assert sorted(os.listdir(site.root)) == ['index.html']
+    head, body = _get(site.port, '/index.html', 'Accept-Encoding: gzip\r\n')
+    assert 'Content-Encoding: gzip' in head
+    assert gzip.decompress(body).startswith(b'<html>hello')
+
+def test_stale_variant_is_not_served(site):
+    index = os.path.join(site.root, 'index.html')
+    with open(index, 'w') as f:
+        f.write('<html>changed</html>')
+    os.utime(index, ns=(0, os.stat(index).st_mtime_ns + 10**9))
+    head, body = _get(site.port, '/index.html', 'Accept-Encoding: gzip\r\n')
+    assert 'Content-Encoding' not in head
+    assert body == b'<html>changed</html>'
+
+def test_precompress_prunes_removed_files(workdir):
+    root = workdir / 'site'
+    root.mkdir()
+    (root / 'app.js').write_text('x = 1;\n' * 500)
+    static_server.precompress_site('svc2', root)
+    variant = os.path.join(config.STATIC_VARIANT_DIR, 'svc2', 'app.js.gz')
+    assert os.path.exists(variant)
+    os.remove(root / 'app.js')
+    static_server.precompress_site('svc2', root)
+    assert not os.path.exists(variant)
+    static_server.delete_variants('svc2')
+    assert not os.path.exists(os.path.join(config.STATIC_VARIANT_DIR, 'svc2'))
+
+def test_sync_after_precompress_removes_nothing(workdir):
+    root = workdir / 'site'
+    root.mkdir()
+    (root / 'index.html').write_text('<p>x</p>' * 500)
+    static_server.precompress_site('svc3', root)
+    with zipfile.ZipFile(workdir / 'site.zip', 'w') as z:
+        z.writestr('index.html', '<p>x</p>' * 500)
+    assert sync_archive(str(workdir / 'site.zip'), str(root)) == {'added': [], 'changed': [], 'removed': []}
@@ -0,0 +1,146 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+from database import add_trace
+from metrics import DEPLOY_PHASE_SECONDS
+
+# Deploy tracing
+# A Trace follows one upload from the download in handle_document through the job
+# worker into deploy_project/update_project and start_process. Code marks its phases
+# with span(name); each span records its offset, duration and attributes such as byte
+# counts on the trace active in the current thread (and feeds the deploy_phase_seconds
+# histogram). Finished traces go to the deploy_traces table and, one JSON line each, to
+# TRACE_LOG. The admin can arm cProfile for the next job with /profilenext.
+
+_local = threading.local()
+_profile_next = threading.Event()
+
+class Trace:
+    def __init__(self, kind, user_id):
+        self.kind = kind
+        self.user_id = user_id
+        self.job_id = None
+        self.service_id = None
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self.spans = []  # {'name', 'start', 'seconds', **attrs}
+        self.result = None
+        self.profile_path = None
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def start_trace(kind, user_id):
+    return Trace(kind, user_id)
+
+def set_trace_service(service_id):
+    trace = current_trace()
+    if trace is not None:
+        trace.service_id = service_id
+
+# Time a phase; yields a dict for attributes (e.g. attrs['bytes'] = n)
+@contextmanager
+def span(name, **attrs):
+    trace = current_trace()
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = time.perf_counter() - started
+        if trace is not None:
+            # Only deploy jobs count; restarts and restores also pass through spawn
+            DEPLOY_PHASE_SECONDS.observe(seconds, phase=name)
+            trace.spans.append(dict(attrs, name=name, start=round(started - trace._origin, 4),
+                                    seconds=round(seconds, 4)))
+
+# Record a phase that was timed elsewhere (e.g. the download, before any thread had the trace)
+def add_span(trace, name, seconds, **attrs):
+    DEPLOY_PHASE_SECONDS.observe(seconds, phase=name)
+    trace.spans.append(dict(attrs, name=name, start=round(time.perf_counter() - trace._origin - seconds, 4),
+                            seconds=round(seconds, 4)))
+
+def profile_next_job():
+    _profile_next.set()
+
+# Make trace current in this thread for the duration of a job, then store it
+@contextmanager
+def activate(trace):
+    _local.trace = trace
+    profiler = None
+    if _profile_next.is_set():
+        _profile_next.clear()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield trace
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            trace.profile_path = _save_profile(profiler, trace)
+        _local.trace = None
+        finish_trace(trace)
+
+def _save_profile(profiler, trace):
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(config.PROFILE_DIR, f"job-{trace.job_id}-{int(trace.started)}.prof")
+    try:
+        profiler.dump_stats(path)
+    except OSError as e:
+        logging.error(f"Failed to save profile for job {trace.job_id}: {str(e)}")
+        return None
+    return path
+
+def finish_trace(trace):
+    total = round(time.perf_counter() - trace._origin, 4)
+    try:
+        add_trace(trace.job_id, trace.service_id, trace.user_id, trace.kind, trace.result,
+                  trace.started, total, json.dumps(trace.spans), trace.profile_path)
+    except Exception as e:
+        logging.error(f"Failed to store trace of job {trace.job_id}: {str(e)}")
+    try:
+        with open(config.TRACE_LOG, 'a') as f:
+            f.write(json.dumps({'job_id': trace.job_id, 'service_id': trace.service_id, 'user_id': trace.user_id,
+                                'kind': trace.kind, 'result': trace.result, 'started': trace.started,
+                                'seconds': total, 'spans': trace.spans}) + '\n')
+    except OSError as e:
+        logging.error(f"Failed to write trace log: {str(e)}")
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+# Text breakdown of a stored trace for /deploytrace
+def format_trace(trace):
+    spans = json.loads(trace['spans'] or '[]')
+    lines = [f"Job #{trace['job_id']} ({trace['kind']}, {trace['result'] or 'unknown'}) "
+             f"for {trace['service_id'] or 'no service'}: {trace['seconds']:.2f}s total"]
+    for item in spans:
+        share = item['seconds'] / trace['seconds'] * 100 if trace['seconds'] else 0
+        extra = f", {_format_bytes(item['bytes'])}" if 'bytes' in item else ''
+        lines.append(f"  {item['name']}: {item['seconds']:.2f}s ({share:.0f}%){extra}")
+    if trace['profile_path']:
+        lines.append(f"Profile: {trace['profile_path']}")
+        lines.append(profile_summary(trace['profile_path']))
+    return '\n'.join(lines)
+
+def profile_summary(path, limit=8):
+    try:
+        out = io.StringIO()
+        stats = pstats.Stats(path, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+    except (OSError, TypeError, ValueError) as e:
+        return f"(profile unreadable: {str(e)})"
+    # Keep the table, not the header
+    text = out.getvalue()
+    start = text.find('ncalls')
+    return text[start:].rstrip() if start >= 0 else text.strip()
@@ -0,0 +1,86 @@
+import os
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Upload downloads
+# Uploaded ZIPs are streamed from Telegram straight into a .part file in
+# UPLOAD_CHUNK_SIZE steps, so an upload never sits in the bot's memory, and run on a
+# small pool of UPLOAD_WORKERS threads so a slow download holds neither the update
+# frontend nor other users' handlers. The size Telegram announces is checked against
+# the user's tier before anything is fetched, and again while bytes arrive (the
+# announced size is optional). The file is renamed into place only once its length
+# matches and it opens as a ZIP; anything else removes it.
+
+DEFAULT_FILE_URL = 'https://api.telegram.org/file/bot{0}/{1}'
+
+_pool = ThreadPoolExecutor(max_workers=config.UPLOAD_WORKERS, thread_name_prefix='upload')
+
+class UploadError(Exception):
+    pass
+
+def max_upload_bytes(is_premium):
+    return config.MAX_UPLOAD_BYTES['premium' if is_premium else 'free']
+
+def _format_size(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+# Refuse early from the size in the message; returns an error text or None
+def check_upload_size(size, is_premium):
+    limit = max_upload_bytes(is_premium)
+    if size and size > limit:
+        return f"File is too large ({_format_size(size)}); the limit for your plan is {_format_size(limit)}."
+    return None
+
+def _file_url(bot, file_path):
+    template = config.TELEGRAM_FILE_URL
+    if not template:
+        try:
+            from telebot import apihelper
+            template = apihelper.FILE_URL or DEFAULT_FILE_URL
+        except ImportError:
+            template = DEFAULT_FILE_URL
+    return template.format(bot.token, file_path)
+
+# Stream a Telegram file to dest; returns the number of bytes written
+def download_to_file(bot, file_info, dest, max_bytes):
+    expected = getattr(file_info, 'file_size', None)
+    if expected and expected > max_bytes:
+        raise UploadError(f"file is too large ({_format_size(expected)})")
+    part = dest + '.part'
+    written = 0
+    try:
+        with urllib.request.urlopen(_file_url(bot, file_info.file_path), timeout=config.UPLOAD_TIMEOUT) as response, \
+                open(part, 'wb') as f:
+            while True:
+                chunk = response.read(config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadError(f"file is larger than {_format_size(max_bytes)}")
+                f.write(chunk)
+        if expected and written != expected:
+            raise UploadError(f"download incomplete ({written} of {expected} bytes)")
+        if not zipfile.is_zipfile(part):
+            raise UploadError("file is not a valid ZIP archive")
+        os.replace(part, dest)
+    except OSError as e:
+        _remove(part)
+        raise UploadError(str(e)) from e
+    except Exception:
+        _remove(part)
+        raise
+    return written
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Run fn(*args) on the upload pool; returns its Future
+def submit_upload(fn, *args):
+    return _pool.submit(fn, *args)
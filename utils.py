@@ -1,30 +1,61 @@
-import random
-import uuid
 import socket
+import threading
+import uuid
 
 import config
 from database import get_conn
+from metrics import PORTS_FREE
+
+class PortExhaustedError(RuntimeError):
+    pass
 
 def generate_service_id():
     # Generate a short unique ID using UUID
     return uuid.uuid4().hex[:8]
 
-def get_unused_port():
-    # Get used ports from DB
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT port FROM services')
+# Port allocation
+# Free ports in PORT_RANGE are kept in memory so handing one out is O(1).
+# A port leaves the free set the moment it is reserved, so concurrent deploys
+# can never receive the same port before add_service runs.
+_port_lock = threading.Lock()
+_free_ports = None  # Set of unassigned ports, loaded from the DB on first use
+
+# Rebuild the free set from the services table (called on startup)
+def load_ports():
+    global _free_ports
+    cursor = get_conn().execute('SELECT port FROM services')
     used_ports = {row[0] for row in cursor.fetchall()}
-    conn.close()
-    
-    # Find random unused port in range
+    with _port_lock:
+        _free_ports = set(range(config.PORT_RANGE[0], config.PORT_RANGE[1] + 1)) - used_ports
+
+def _port_is_bindable(port):
+    # Double-check the port is not held by something outside the bot
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('0.0.0.0', port))
+            return True
+        except OSError:
+            return False
+
+# Reserve a free port; release_port() must be called if it is not used
+def get_unused_port():
+    if _free_ports is None:
+        load_ports()
     while True:
-        port = random.randint(config.PORT_RANGE[0], config.PORT_RANGE[1])
-        if port not in used_ports:
-            # Double-check if port is free by trying to bind
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.bind(('0.0.0.0', port))
-                    return port
-                except OSError:
-                    continue
+        with _port_lock:
+            if not _free_ports:
+                raise PortExhaustedError(
+                    f"No free ports left in range {config.PORT_RANGE[0]}-{config.PORT_RANGE[1]}")
+            port = _free_ports.pop()
+        if _port_is_bindable(port):
+            return port
+        # Held by a foreign process: leave it out until the next load_ports()
+
+def release_port(port):
+    if _free_ports is None or port is None:
+        return
+    if config.PORT_RANGE[0] <= port <= config.PORT_RANGE[1]:
+        with _port_lock:
+            _free_ports.add(port)
+
+PORTS_FREE.set_callback(lambda: len(_free_ports) if _free_ports is not None else 0)
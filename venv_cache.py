@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+import config
+from metrics import (VENV_CACHE_BUILD_FAILURES, VENV_CACHE_BYTES, VENV_CACHE_ENTRIES, VENV_CACHE_EVICTIONS,
+                     VENV_CACHE_LOOKUPS)
+from tracing import span
+
+# Content-addressed cache of built virtualenvs
+# Entries live in VENV_CACHE_DIR/<key>, where key hashes the normalized requirements
+# plus the interpreter version. A deploy whose requirements match gets a copy of the
+# ready environment instead of a fresh venv + pip install. All pip runs share one
+# wheel cache, and least recently used entries are evicted past VENV_CACHE_MAX_BYTES.
+
+_key_locks = {}  # key: threading.Lock, so one key is only built once at a time
+_key_locks_lock = threading.Lock()
+_interpreter_tag = None
+
+# Requirement lines that pull in files from the project itself can't be keyed by text
+_LOCAL_PREFIXES = ('-r', '-c', '-e', '--requirement', '--constraint', '--editable', '.', '/', 'file:')
+
+def _get_interpreter_tag():
+    global _interpreter_tag
+    if _interpreter_tag is None:
+        result = subprocess.run(['python', '-c', 'import sys, platform; print(sys.version, platform.machine())'],
+                                capture_output=True, text=True, check=True)
+        _interpreter_tag = result.stdout.strip()
+    return _interpreter_tag
+
+# Returns the cache key for a requirements file, or None if it can't be cached
+def requirements_key(req_path):
+    lines = []
+    with open(req_path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith(_LOCAL_PREFIXES):
+                return None
+            lines.append(' '.join(line.lower().split()))
+    digest = hashlib.sha256(_get_interpreter_tag().encode())
+    for line in sorted(set(lines)):
+        digest.update(b'\n' + line.encode())
+    return digest.hexdigest()[:32]
+
+def _key_lock(key):
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+def _build_venv(req_path, venv_path):
+    with span('venv'):
+        subprocess.run(['python', '-m', 'venv', venv_path], check=True)
+    pip_path = os.path.join(venv_path, 'bin', 'pip')
+    os.makedirs(config.WHEEL_CACHE_DIR, exist_ok=True)
+    with span('pip'):
+        install_process = subprocess.run([pip_path, 'install', '--cache-dir',
+                                          os.path.abspath(config.WHEEL_CACHE_DIR), '-r', req_path])
+    return install_process.returncode == 0
+
+# Copy a cached venv to its new home and repoint scripts that embed the old path
+def _clone_venv(source, venv_path):
+    # Scripts embed the path the venv was built at
+    with open(os.path.join(source, '.prefix')) as f:
+        old_prefix = f.read()
+    copy_venv(source, venv_path, old_prefix)
+
+# Copy (or hardlink) the venv at source, built at old_prefix, to venv_path
+def copy_venv(source, venv_path, old_prefix):
+    copy_function = os.link if config.VENV_CACHE_HARDLINK else shutil.copy2
+    shutil.copytree(source, venv_path, symlinks=True, copy_function=copy_function,
+                    ignore=shutil.ignore_patterns('.size', '.prefix'))
+    old_prefix = old_prefix.encode()
+    new_prefix = os.path.abspath(venv_path).encode()
+    bin_dir = os.path.join(venv_path, 'bin')
+    for name in os.listdir(bin_dir):
+        path = os.path.join(bin_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if old_prefix in content:
+            os.remove(path)  # Break any hardlink before rewriting
+            with open(path, 'wb') as f:
+                f.write(content.replace(old_prefix, new_prefix))
+            shutil.copymode(os.path.join(source, 'bin', name), path)
+
+# Create venv_path with requirements installed, reusing a cached build when possible
+# Returns True on success
+def setup_venv(req_path, venv_path):
+    try:
+        key = requirements_key(req_path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Venv cache disabled for {req_path}: {str(e)}")
+        key = None
+    if key is None:
+        VENV_CACHE_LOOKUPS.inc(result='uncacheable')
+        return _build_venv(req_path, venv_path)
+
+    entry = os.path.join(config.VENV_CACHE_DIR, key)
+    with _key_lock(key):
+        if os.path.isdir(entry):
+            VENV_CACHE_LOOKUPS.inc(result='hit')
+        else:
+            VENV_CACHE_LOOKUPS.inc(result='miss')
+            os.makedirs(config.VENV_CACHE_DIR, exist_ok=True)
+            build_path = os.path.join(config.VENV_CACHE_DIR, f'.build-{key}-{uuid.uuid4().hex[:8]}')
+            build_path = os.path.abspath(build_path)
+            try:
+                ok = _build_venv(req_path, build_path)
+            except subprocess.CalledProcessError:
+                ok = False
+            if not ok:
+                VENV_CACHE_BUILD_FAILURES.inc()
+                shutil.rmtree(build_path, ignore_errors=True)
+                return False
+            with open(os.path.join(build_path, '.size'), 'w') as f:
+                f.write(str(_dir_size(build_path)))
+            with open(os.path.join(build_path, '.prefix'), 'w') as f:
+                f.write(build_path)
+            os.rename(build_path, entry)
+            logging.info(f"Built venv cache entry {key}")
+        os.utime(entry)  # Mark as recently used for LRU eviction
+        with span('venv_clone'):
+            _clone_venv(entry, venv_path)
+    evict_venv_cache()
+    return True
+
+def _entry_size(entry):
+    try:
+        with open(os.path.join(entry, '.size')) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return _dir_size(entry)
+
+def _list_entries():
+    entries = []
+    if not os.path.isdir(config.VENV_CACHE_DIR):
+        return entries
+    for name in os.listdir(config.VENV_CACHE_DIR):
+        path = os.path.join(config.VENV_CACHE_DIR, name)
+        if name.startswith('.') or not os.path.isdir(path) or path == os.path.normpath(config.WHEEL_CACHE_DIR):
+            continue
+        entries.append((os.stat(path).st_mtime, _entry_size(path), name, path))
+    return entries
+
+# Drop least recently used entries until the cache fits its disk budget
+def evict_venv_cache():
+    entries = sorted(_list_entries())
+    total = sum(entry[1] for entry in entries)
+    for _, size, key, path in entries:
+        if total <= config.VENV_CACHE_MAX_BYTES:
+            break
+        with _key_lock(key):
+            shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        VENV_CACHE_EVICTIONS.inc()
+        logging.info(f"Evicted venv cache entry {key}")
+
+VENV_CACHE_ENTRIES.set_callback(lambda: len(_list_entries()))
+VENV_CACHE_BYTES.set_callback(lambda: sum(entry[1] for entry in _list_entries()))